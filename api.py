@@ -14,11 +14,18 @@ import re
 
 from model import (Model, Content, Theme, Topic, Lesson, User, Practice,
                    Comment, Vote, ResetPasswordToken, Assessment, Survey,
-                   SurveyResult)
+                   SurveyResult, ContentIndex, ThemeOutline)
 import config
+import content_cache
+import search_queue
 import util
 
 
+# The datastore runs IN filters as one subquery per combination of values, and
+# won't run more than this many for one query.
+MAX_SUBQUERIES = 30
+
+
 class PermissionDenied(Exception):
     pass
 
@@ -38,6 +45,66 @@ class DuplicateUsername(Exception):
     pass
 
 
+class ResultPage(list):
+    """A page of results, which knows where the next page starts.
+
+    Behaves like a list, so callers that don't paginate needn't care.
+
+    Attributes:
+        cursor: str, opaque token to pass as the `cursor` param to get the
+            next page, or None if there are no more results or the results
+            can't be paged with cursors.
+    """
+
+    def __init__(self, results=(), cursor=None):
+        super(ResultPage, self).__init__(results)
+        self.cursor = cursor
+
+
+class QueryPlan(object):
+    """How Api.get() will run a query with IN filters. See Api.plan_query().
+
+    Attributes:
+        filters: dict, passed to the datastore in every query.
+        split_property: str, name of an IN filter which is split up to make
+            several queries, or None if there's only one query.
+        split_values: list of lists, values of split_property for each query.
+        post_filters: dict, IN filters applied in python to query results.
+    """
+
+    def __init__(self, filters, split_property=None, split_values=None,
+                 post_filters=None):
+        self.filters = filters
+        self.split_property = split_property
+        self.split_values = split_values or []
+        self.post_filters = post_filters or {}
+
+    def is_simple(self):
+        """Whether the datastore can do all the work in one query."""
+        return self.split_property is None and not self.post_filters
+
+    def get_queries(self, query, klass):
+        """Apply this plan's filters to a query, making one per split."""
+        for k, v in self.filters.items():
+            if type(v) is list:
+                query = query.filter(getattr(klass, k).IN(v))
+            else:
+                query = query.filter(getattr(klass, k) == v)
+        if self.split_property is None:
+            return [query]
+        prop = getattr(klass, self.split_property)
+        return [query.filter(prop.IN(v)) for v in self.split_values]
+
+    def __str__(self):
+        parts = ['{} queries'.format(max(len(self.split_values), 1))]
+        if self.split_property:
+            parts.append('split on {}'.format(self.split_property))
+        if self.post_filters:
+            parts.append('post-filter {}'.format(
+                ', '.join(sorted(self.post_filters))))
+        return '; '.join(parts)
+
+
 class Api:
     """The set of functions through which the outside world interacts with
     the Mindset Kit.
@@ -67,53 +134,160 @@ class Api:
                     .format(user))
         self.user = user
 
+    @classmethod
+    def fetch_page(klass, query, n, cursor=None, offset=0):
+        """Fetch a page of query results.
+
+        Cursors make deep pages as cheap as the first, where offsets still
+        scan every skipped result. Offsets are supported for older clients.
+
+        Args:
+            query: ndb.Query
+            n: int, page size
+            cursor: str, optional, from the `cursor` of a previous page.
+            offset: int, optional, results to skip; ignored given a cursor.
+        Returns:
+            ResultPage
+        """
+        if cursor:
+            results, next_cursor, more = query.fetch_page(
+                n, start_cursor=ndb.Cursor(urlsafe=cursor))
+        else:
+            results, next_cursor, more = query.fetch_page(n, offset=offset)
+        next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+        return ResultPage(results, next_cursor)
+
     @classmethod
     def post_process(klass, results, unsafe_filters):
-        """Assumes IN filters with list values, e.g. {'id', ['X', 'Y']}."""
-        logging.info(u'Api.post_process() handled unsafe filters:')
-        logging.info(u'{}'.format(unsafe_filters))
-        all_matching_sets = []
-        for k, v in unsafe_filters.items():
-            matches = set([e for e in results if getattr(e, k) in v])
-            all_matching_sets.append(matches)
-        return set.intersection(*all_matching_sets)
+        """Assumes IN filters with list values, e.g. {'id', ['X', 'Y']}.
+
+        Returns the results that match every filter, in their original order.
+        As with the datastore, a repeated property matches if any of its
+        values are in the filter's list.
+        """
+        def matches(entity, prop, values):
+            value = getattr(entity, prop)
+            if type(value) is list:
+                return any(v in values for v in value)
+            return value in values
+        return [e for e in results
+                if all(matches(e, k, v) for k, v in unsafe_filters.items())]
 
     @classmethod
-    def limit_subqueries(klass, filters):
-        # GAE limits us to 30 subqueries! This is a BIG problem, because
-        # stacking 'property IN list' filters MULTIPLIES the number of
-        # subqueries (since IN is shorthand for a bunch of = comparisions). My
-        # temporary solution is to detect unwieldy queries and do some post-
-        # processing in python.
-        # https://groups.google.com/forum/#!topic/google-appengine-python/ZlqZHwfznbQ
-        subqueries = 1
+    def plan_query(klass, filters):
+        """Decide which filters the datastore can handle.
+
+        GAE limits us to 30 subqueries! This is a BIG problem, because
+        stacking 'property IN list' filters MULTIPLIES the number of
+        subqueries (since IN is shorthand for a bunch of = comparisions).
+        https://groups.google.com/forum/#!topic/google-appengine-python/ZlqZHwfznbQ
+
+        So the smallest IN filters go to the datastore while they fit. Of
+        the rest, the smallest that can be split across at most
+        config.max_parallel_queries queries is, and any others are handled
+        in python. See Api.run_plan().
+
+        Returns:
+            QueryPlan
+        """
         safe_filters = {}
-        unsafe_filters = {}
-        in_filters = {}
+        in_filters = []
         for k, v in filters.items():
             if type(v) is list:
-                subqueries *= len(v)
-                in_filters[k] = v
+                in_filters.append((k, v))
             else:
                 safe_filters[k] = v
-        if subqueries > 30:
-            # mark in_filters as unsafe one by one, starting with the largest,
-            # until subqueries is small enough
-            s = subqueries
-            for k, v in sorted(in_filters.items(), key=lambda f: len(f[1]),
-                            reverse=True):
-                if s < 30:
-                    safe_filters[k] = v
-                else:
-                    unsafe_filters[k] = v
-                s /= len(v)
-        else:
-            safe_filters.update(in_filters)
-        if len(unsafe_filters) > 0:
-            logging.info(u'Api.limit_subqueries() marked filters as unsafe '
-                         'because they would generate too many subqueries:')
-            logging.info(u'{}'.format(unsafe_filters))
-        return (safe_filters, unsafe_filters)
+
+        # An empty IN filter makes no subqueries, but also matches nothing;
+        # it may as well go to the datastore.
+        subqueries = 1
+        unsafe_filters = []
+        for k, v in sorted(in_filters, key=lambda f: len(f[1])):
+            if subqueries * max(len(v), 1) <= MAX_SUBQUERIES:
+                safe_filters[k] = v
+                subqueries *= max(len(v), 1)
+            else:
+                unsafe_filters.append((k, v))
+
+        split_property = None
+        split_values = None
+        chunk_size = MAX_SUBQUERIES / subqueries
+        for k, v in unsafe_filters:
+            num_queries = (len(v) + chunk_size - 1) / chunk_size
+            if num_queries <= config.max_parallel_queries:
+                split_property = k
+                split_values = [v[i:i + chunk_size]
+                                for i in range(0, len(v), chunk_size)]
+                break
+
+        post_filters = {k: v for k, v in unsafe_filters
+                        if k != split_property}
+        return QueryPlan(safe_filters, split_property, split_values,
+                         post_filters)
+
+    @classmethod
+    def run_plan(klass, queries, plan, n, offset=0, order=None):
+        """Run the queries of a plan in parallel and merge their results.
+
+        Each query over-fetches until it has enough results that survive
+        post-processing, so pages aren't silently short.
+
+        Args:
+            queries: list of ndb.Query, from plan.get_queries().
+            plan: QueryPlan
+            n: int, page size
+            offset: int, optional, results to skip.
+            order: tuple of (property name, descending), optional, which the
+                queries are already sorted by.
+        Returns:
+            list of entities
+        """
+        limit = offset + n
+        futures = [klass._fetch_matching_async(q, limit, plan.post_filters)
+                   for q in queries]
+        results = [e for f in futures for e in f.get_result()]
+
+        if len(queries) > 1:
+            # A repeated property can match more than one split.
+            unique = {e.key: e for e in results}
+            # Like the datastore, break ties by key.
+            results = sorted(unique.values(), key=lambda e: e.key.pairs())
+            if order:
+                prop, descending = order
+                results.sort(key=lambda e: getattr(e, prop),
+                             reverse=descending)
+
+        return results[offset:limit]
+
+    @classmethod
+    @ndb.tasklet
+    def _fetch_matching_async(klass, query, limit, post_filters):
+        """Fetch up to limit results of a query which pass post_filters."""
+        if not post_filters:
+            results = yield query.fetch_async(limit)
+            raise ndb.Return(results)
+
+        # Each batch continues from the last one's cursor, rather than
+        # rescanning an offset. Queries with IN filters can only be resumed
+        # if ordered by key, which otherwise just breaks ties.
+        query = query.order(Model.key)
+        matches = []
+        scanned = 0
+        cursor = None
+        batch_size = max(limit * 2, 20)
+        while len(matches) < limit:
+            if scanned >= config.max_post_filter_scan:
+                logging.warning(u"Api.get() stopped after reading {} "
+                                "entities for post-processing; results may be "
+                                "short.".format(scanned))
+                break
+            batch, cursor, more = yield query.fetch_page_async(
+                batch_size, start_cursor=cursor)
+            scanned += len(batch)
+            matches.extend(klass.post_process(batch, post_filters))
+            if not more:
+                break
+        raise ndb.Return(matches[:limit])
 
     @ndb.transactional(xg=True)
     def associate(self, parent, child, position=None):
@@ -184,6 +358,8 @@ class Api:
         if should_save_child:
             child.put()
 
+        ThemeOutline.refresh_for([parent, child])
+
         return (parent, child)
 
     def check_reset_password_token(self, token_id):
@@ -271,6 +447,9 @@ class Api:
         # now we're done, so we can put all the changes to the new entity
         entity.put()
 
+        if isinstance(entity, (Theme, Topic, Lesson)):
+            ThemeOutline.refresh_for([entity])
+
         return entity
 
     def delete(self, id):
@@ -297,8 +476,12 @@ class Api:
         entity.put()
 
         if isinstance(entity, (Lesson, Practice)):
-            logging.info("Removing soft-deleted content from search.")
-            search.Index(config.content_index).delete(entity.uid)
+            logging.info("Queueing soft-deleted content for removal from "
+                         "search.")
+            search_queue.enqueue(entity.uid)
+
+        if isinstance(entity, (Theme, Topic, Lesson)):
+            ThemeOutline.refresh_for([entity])
 
         entity_kind = Model.get_kind(entity)
 
@@ -326,7 +509,7 @@ class Api:
             raise PermissionDenied("Only admins working on a localhost "
                                    "server can delete everything.")
         util.delete_everything()
-        util.delete_all_in_index(config.content_index)
+        util.delete_all_in_index(ContentIndex.get().active_name)
 
     def get(self, kind, ancestor=None, **kwargs):
         """Query entities in the datastore.
@@ -373,16 +556,23 @@ class Api:
             # Speedy and simple by default. If you want more, specify n!
             n = 20
 
+        order = None
         if 'order' in kwargs:
             # Uses '-' in order to indicate reverse direction,
             # otherwise standard sorting is used
             if '-' in kwargs['order']:
                 kwargs['order'] = kwargs['order'].replace('-', '')
                 query = query.order(-getattr(klass, kwargs['order']))
+                order = (kwargs['order'], True)
             else:
                 query = query.order(getattr(klass, kwargs['order']))
+                order = (kwargs['order'], False)
             del kwargs['order']
 
+        # Pagination using a 'cursor' argument picks up where the previous
+        # page left off. See ResultPage.
+        cursor = kwargs.pop('cursor', None)
+
         # Pagination using a 'page' argument pulls n arguments offset by n*page
         # pull first set of results with page=0
         if 'page' in kwargs:
@@ -394,30 +584,37 @@ class Api:
         # Now that all the non-standard kwargs have been removed (n, order...)
         # we process all the rest as parameters/filters on the query.
 
-        safe_kwargs, unsafe_kwargs = Api.limit_subqueries(kwargs)
+        plan = Api.plan_query(kwargs)
+        queries = plan.get_queries(query, klass)
 
-        for k, v in safe_kwargs.items():
-            if type(v) is list:
-                query = query.filter(getattr(klass, k).IN(v))
-            else:
-                query = query.filter(getattr(klass, k) == v)
-
-        results = query.fetch(n, offset=offset)
-
-        # post-processing, if necessary
-        if len(unsafe_kwargs) > 0:
-            results = Api.post_process(results, unsafe_kwargs)
+        if plan.is_simple() and not any(type(v) is list
+                                        for v in plan.filters.values()):
+            results = Api.fetch_page(queries[0], n, cursor=cursor,
+                                     offset=offset)
+        else:
+            # IN filters make several queries, which can't be resumed with a
+            # cursor unless ordered by key.
+            logging.info(u"Api.get() plan for {}: {}".format(kind, plan))
+            util.profiler.add_event("Query plan: {}".format(plan))
+            results = ResultPage(
+                Api.run_plan(queries, plan, n, offset=offset, order=order))
 
         return results
 
     def get_by_id(self, id_or_ids):
         """Strongly consistent key fetch, available to anyone, even public."""
+        return self.get_by_id_async(id_or_ids).get_result()
+
+    @ndb.tasklet
+    def get_by_id_async(self, id_or_ids):
+        """Asynchronous version of get_by_id(); returns a future."""
         # The only exception is that deleted entries are never returned.
-        result = Model.get_by_id(id_or_ids)
+        result = yield Model.get_by_id_async(id_or_ids)
         if type(result) is list:
-            return [e for e in result if e is not None and not e.deleted]
+            raise ndb.Return(
+                [e for e in result if e is not None and not e.deleted])
         else:
-            return None if not result or result.deleted else result
+            raise ndb.Return(None if not result or result.deleted else result)
 
     @ndb.transactional(xg=True)
     def disassociate(self, parent, child):
@@ -464,6 +661,8 @@ class Api:
         parent.put()
         child.put()
 
+        ThemeOutline.refresh_for([parent, child])
+
         return (parent, child)
 
     def reorder(self, parent, child, move_up=True):
@@ -504,6 +703,8 @@ class Api:
         setattr(parent, prop_info['child_list'], child_list)
         parent.put()
 
+        ThemeOutline.refresh_for([parent])
+
         return parent
 
     def _stringify_search_params(self, params):
@@ -545,11 +746,14 @@ class Api:
         if max_grade is not None:
             type_strings.append('min_grade <= {}'.format(max_grade))
 
-        for field_name in params:
+        # Sort fields and values so that equivalent searches have identical
+        # query strings, which lets them share cached results.
+        for field_name in sorted(params):
             # Make everything else a list.
             values = params[field_name]
             if type(values) is not list:
                 values = [values]
+            values = sorted(values)
             if len(values) > 0:  # protect against empty lists
                 value_strings = []  # e.g. 'tag:foo'
                 for value in values:
@@ -567,37 +771,32 @@ class Api:
     def _annotate_search_content(self, result_dicts):
         """Add data re: content authors and current user to search results."""
 
-        # Content authors
+        # Content authors, keyed by uid. Content is in an entity group under
+        # its author, if it has one.
 
-        content_keys = [Model.id_to_key(d['uid']) for d in result_dicts]
-        parent_ids = [k.parent().id() for k in content_keys if k.parent()]
+        parent_ids = [Model.id_to_key(d['uid']).parent() for d in result_dicts]
+        parent_ids = [k.id() if k else None for k in parent_ids]
         # A single datastore read for all parents.
-        parents = self.get_by_id(parent_ids) or []
+        parents = self.get_by_id(list(set(filter(None, parent_ids)))) or []
+        parent_dicts = {p.uid: p.to_client_dict() for p in parents}
 
         # Votes and comments by the current user (who may not be signed in).
 
         if self.user:
-            users_votes_for = self.get('Vote', ancestor=self.user)
-            content_user_voted_for = ([v.lesson_id for v in users_votes_for] +
-                                      [v.practice_id for v in users_votes_for])
-            users_comments = self.get('Comment', ancestor=self.user)
-            content_user_commented = ([c.lesson_id for c in users_comments] +
-                                      [c.practice_id for c in users_comments])
+            interactions = self.user.get_content_interactions()
+            content_user_voted_for = interactions['Vote']
+            content_user_commented = interactions['Comment']
         else:
             # The user is not signed in.
-            content_user_voted_for = []
-            content_user_commented = []
+            content_user_voted_for = set()
+            content_user_commented = set()
 
         # Loop through search results and modify.
 
-        for d in result_dicts:
-            # Find and add content authors.
-            for p in parents:
-                # I don't love this way of testing if a user is a parent of a
-                # given content entity, b/c it relies on our uid conventions,
-                # but it's awfully convenient.
-                if p.uid in d['uid']:
-                    d['user'] = p.to_client_dict()
+        for d, parent_id in zip(result_dicts, parent_ids):
+            # Add content authors.
+            if parent_id in parent_dicts:
+                d['user'] = parent_dicts[parent_id]
             # Check if the current user voted for or commented on this.
             if d['uid'] in content_user_voted_for:
                 d['user_voted_for'] = True
@@ -611,7 +810,6 @@ class Api:
         return result_dicts
 
     def search_content(self, params):
-        index = search.Index(config.content_index)
         search_text = ''
 
         # This search_results objects has properties `number_found`, `results`,
@@ -622,6 +820,10 @@ class Api:
         # search.QueryOptions docs:
         # https://cloud.google.com/appengine/docs/python/search/queryoptionsclass
 
+        # Pagination using a 'cursor' argument picks up where the previous
+        # page left off. See ResultPage.
+        cursor = params.pop('cursor', None)
+
         # Pagination using a 'page' argument pulls n arguments offset by n*page
         # pull first set of results with page=0
         page_size = 20
@@ -629,26 +831,47 @@ class Api:
         if 'page' in params:
             offset = int(params.pop('page')) * page_size
 
-        # Build the SortOptions with 2 sort keys
-        sort1 = search.SortExpression(expression='promoted', direction=search.SortExpression.DESCENDING, default_value='A')
-        sort2 = search.SortExpression(expression='created', direction=search.SortExpression.DESCENDING, default_value=0)
-        sort_opts = search.SortOptions(expressions=[sort1, sort2])
-
-        search_results = index.search(search.Query(
-            query_string=self._stringify_search_params(params),
-            options=search.QueryOptions(
-                limit=page_size,
-                offset=offset,
-                snippeted_fields=['summary', 'body'],
-                sort_options= sort_opts,
-            )
-        ))
-        result_dicts = [util.search_document_to_dict(doc)
-                        for doc in search_results.results]
+        query_string = self._stringify_search_params(params)
+
+        def run_search():
+            index = search.Index(ContentIndex.get().active_name)
+
+            # Build the SortOptions with 2 sort keys
+            sort1 = search.SortExpression(expression='promoted', direction=search.SortExpression.DESCENDING, default_value='A')
+            sort2 = search.SortExpression(expression='created', direction=search.SortExpression.DESCENDING, default_value=0)
+            sort_opts = search.SortOptions(expressions=[sort1, sort2])
+
+            # The search API can't combine offsets and cursors. Only start
+            # returning cursors when not using offsets.
+            if cursor or not offset:
+                page_options = {
+                    'cursor': search.Cursor(web_safe_string=cursor)}
+            else:
+                page_options = {'offset': offset}
+
+            search_results = index.search(search.Query(
+                query_string=query_string,
+                options=search.QueryOptions(
+                    limit=page_size,
+                    snippeted_fields=['summary', 'body'],
+                    sort_options= sort_opts,
+                    **page_options
+                )
+            ))
+            result_dicts = [util.search_document_to_dict(doc)
+                            for doc in search_results.results]
+            next_cursor = (search_results.cursor.web_safe_string
+                           if search_results.cursor else None)
+            return (result_dicts, next_cursor)
+
+        # Results are the same for everyone until they're annotated, so share
+        # them through memcache.
+        result_dicts, next_cursor = content_cache.get_search_results(
+            u'{}:{}:{}'.format(query_string, offset, cursor), run_search)
 
         result_dicts = self._annotate_search_content(result_dicts)
 
-        return result_dicts
+        return ResultPage(result_dicts, next_cursor)
 
     def update(self, id, **kwargs):
         if not self.user:
@@ -724,6 +947,11 @@ class Api:
             setattr(entity, k, v)
 
         entity.put()
+
+        # Names and colors appear in outlines.
+        if isinstance(entity, (Theme, Topic, Lesson)):
+            ThemeOutline.refresh_for([entity])
+
         return entity
 
     def populate(self, n=None):
@@ -21,7 +21,7 @@ import traceback
 import webapp2
 import urllib
 
-from api import Api
+from api import Api, ResultPage
 from base_handler import BaseHandler
 from model import (Model, User, Practice, Lesson, ResetPasswordToken, Vote,
                    Survey, SecretValue)
@@ -82,19 +82,64 @@ class ApiHandler(BaseHandler):
 
         else:
             # If everything about the request worked out, but no data was
-            # returned, put out a standard empty response.
-            if not self.response.body:
+            # returned, put out a standard empty response. A 304 Not Modified
+            # must stay empty.
+            if not self.response.body and self.response.status_int != 304:
                 self.write(None)
 
     def write(self, obj):
-        # In the extremely common cases where we want to return an entity or
-        # a list of entities, translate them to JSON-serializable dictionaries.
+        response = {'error': False}
+        # Every list comes with a cursor for the next page, if there is one.
+        # See api.ResultPage.
+        if isinstance(obj, list):
+            response['cursor'] = getattr(obj, 'cursor', None)
+        # The extremely common cases are returning an entity or a list of
+        # entities.
+        if isinstance(obj, Model):
+            entities = [obj]
+        elif (isinstance(obj, list) and
+              all(isinstance(x, Model) for x in obj)):
+            entities = obj
+        else:
+            entities = None
+
+        # Entities are versioned by their modified time, so a client that
+        # already has them needn't wait for them to be serialized again.
+        if (entities is not None and self.request.method == 'GET' and
+                self.etag_matches(entities, response.get('cursor'))):
+            return
+
+        # Translate entities to JSON-serializable dictionaries.
         if isinstance(obj, Model):
             obj = obj.to_client_dict()
-        elif type(obj) is list and all([isinstance(x, Model) for x in obj]):
+        elif entities is not None:
             obj = [x.to_client_dict() for x in obj]
+        response['data'] = obj
         self.response.write(json.dumps(
-            {'error': False, 'data': obj}, default=util.json_dumps_default))
+            response, default=util.json_dumps_default))
+
+    def join_authors(self, entities):
+        """Serialize entities, each with the client dict of its author.
+
+        Entities are expected to be children of their authors, like practices
+        and comments. Each author is fetched and serialized only once, however
+        many entities they wrote. Entities whose author can't be found (e.g.
+        deleted users) are left out.
+
+        Returns a ResultPage with the same cursor as entities, if any.
+        """
+        user_ids = list(set(e.key.parent().id() for e in entities))
+        # Api.get_by_id() gives None, rather than [], for no ids.
+        user_dicts = {u.uid: u.to_client_dict()
+                      for u in self.api.get_by_id(user_ids) or []}
+        response = ResultPage(cursor=getattr(entities, 'cursor', None))
+        for e in entities:
+            user_dict = user_dicts.get(e.key.parent().id())
+            if user_dict is not None:
+                entity_dict = e.to_client_dict()
+                entity_dict['user'] = user_dict
+                response.append(entity_dict)
+        return response
 
     def process_json_body(self):
         """Enable webob request to accept JSON data in a request body."""
@@ -431,16 +476,7 @@ class Practices(RestfulHandler):
         else:
             params = self.get_params()
             practices = self.api.get('Practice', **params)
-            user_ids = [p.uid.split('.')[1] for p in practices]
-            response = []
-            users = self.api.get_by_id(user_ids)
-            for p in practices:
-                for user in users:
-                    if user.uid == p.uid.split('.')[1]:
-                        practice_dict = p.to_client_dict()
-                        practice_dict['user'] = user.to_client_dict()
-                        response.append(practice_dict)
-                        break
+            response = self.join_authors(practices)
         self.write(response)
 
     def get_popular(self):
@@ -491,7 +527,8 @@ class Users(RestfulHandler):
         else:
             offset = 0
 
-        self.write(query.fetch(n, offset=offset))
+        self.write(Api.fetch_page(query, n, cursor=params.get('cursor'),
+                                  offset=offset))
 
     def get_votes(self, id):
         # @todo: add pagination
@@ -507,8 +544,9 @@ class Users(RestfulHandler):
             else:
                 offset = 0
 
-            votes = query.fetch(n, offset=offset)
-            content = []
+            votes = Api.fetch_page(query, n, cursor=params.get('cursor'),
+                                   offset=offset)
+            content = ResultPage(cursor=votes.cursor)
             for vote in votes:
                 if vote.lesson_id is not None:
                     content.append(self.api.get_by_id(vote.lesson_id))
@@ -601,13 +639,13 @@ class Lessons(RestfulHandler):
             topics = self.api.get_by_id(lesson.topics)
             themes = [theme for topic in topics for theme in topic.themes]
             lesson_themes = self.api.get_by_id(themes)
+            # The lesson's topic in each theme, the last if there are many.
+            topics_by_theme = {theme_uid: t for t in topics
+                               for theme_uid in t.themes}
             response = []
             for theme in lesson_themes:
                 theme_dict = theme.to_client_dict()
-                topic = None
-                for t in topics:
-                    if theme.uid in t.themes:
-                        topic = t
+                topic = topics_by_theme.get(theme.uid)
                 if theme.name != 'Growth Mindset for Teachers':
                     theme_dict['lesson_link'] = '/' + theme.short_uid + '/' + topic.short_uid + '/' + lesson.short_uid
                 else:
@@ -624,17 +662,7 @@ class Comments(RestfulHandler):
     def get(self):
         params = self.get_params()
         comments = self.api.get('Comment', **params)
-        user_ids = [c.parent_user_id() for c in comments]
-        response = []
-        users = self.api.get_by_id(user_ids)
-        for c in comments:
-            for user in users:
-                if user.uid == c.parent_user_id():
-                    comment_dict = c.to_client_dict()
-                    comment_dict['user'] = user.to_client_dict()
-                    response.append(comment_dict)
-                    break
-        self.write(response)
+        self.write(self.join_authors(comments))
 
     def post(self):
         self.rest_post('Comment')
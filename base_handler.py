@@ -1,11 +1,12 @@
 from google.appengine.api import users as app_engine_users
 from pyfb import Pyfb as Facebook
 from webapp2_extras import sessions
+import hashlib
 import logging
 import webapp2
 
 from api import Api, PermissionDenied
-from model import User, DuplicateUser, Email
+from model import Model, User, DuplicateUser, Email
 from passlib.hash import sha256_crypt
 import config
 import datetime
@@ -22,6 +23,7 @@ class BaseHandler(webapp2.RequestHandler):
 
         * Manages sessions
         * Manages request profiling
+        * Scopes the identity map of fetched entities to the request
         """
         # ** Code to run before all handlers goes here. ** #
 
@@ -31,6 +33,10 @@ class BaseHandler(webapp2.RequestHandler):
         util.profiler.clear()
         util.profiler.add_event('START')
 
+        # Entities fetched by id are remembered until the end of the request.
+        # See model.IdentityMap.
+        Model.begin_identity_map()
+
         # Get a session store for this request.
         self.session_store = sessions.get_store(request=self.request)
 
@@ -67,6 +73,37 @@ class BaseHandler(webapp2.RequestHandler):
             # Save all sessions.
             self.session_store.save_sessions(self.response)
 
+            Model.end_identity_map()
+
+    def etag_matches(self, entities, *extra):
+        """Tag the response with a version of the entities it's made from.
+
+        The ETag combines the app version, each entity's uid and modified
+        time, and any extra values (e.g. a content generation), so it changes
+        when any of them do.
+
+        Args:
+            entities: list of entities, None is ignored.
+            extra: anything else the response depends on, as strings.
+        Returns:
+            True if the client's copy is current, according to its
+            If-None-Match header, in which case the response is set to 304 Not
+            Modified and the caller should write nothing else.
+        """
+        parts = [os.environ.get('CURRENT_VERSION_ID', '')]
+        parts += [unicode(x) for x in extra]
+        for e in entities:
+            if e is not None:
+                modified = e.modified.isoformat() if e.modified else ''
+                parts.append(u'{}@{}'.format(e.uid, modified))
+        etag = hashlib.md5(u'|'.join(parts).encode('utf-8')).hexdigest()
+
+        self.response.etag = etag
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return True
+        return False
+
     def clean_up_users(self, session_key):
         """Brings the three representations of users into alignment: the entity
         in the datastore, the id in the session, and the cached object saved as
@@ -35,13 +35,85 @@ allowed_relationships = {
                           'parent_list': 'popular_in'}
 }
 
+# Writing any of these kinds bumps the content generation, invalidating
+# cached navigation. See content_cache.py.
+content_generation_models = ['Theme', 'Topic']
+
+# Writing any of these kinds bumps the outline generation, so theme outlines
+# are rebuilt when next read, however the content was written. See
+# model.ThemeOutline.
+outline_generation_models = ['Theme', 'Topic', 'Lesson']
+
+# How long memcache should hold the navigation tree. Entries are keyed by
+# content generation, so this only bounds how long dead entries linger.
+navigation_cache_seconds = 60 * 60  # 1 hour
+
+# How long memcache should hold rendered pages for signed-out visitors, and
+# how many differently-rendered copies of each page to keep, since pages
+# include random samples of related practices. Edits to practices don't
+# invalidate cached pages, so keep this short. See
+# content_cache.get_page_key().
+page_cache_seconds = 5 * 60  # 5 minutes
+page_cache_variants = 3
+
+# How long memcache should remember which version of each entity was last
+# indexed, so the search queue and the incremental indexer don't both index
+# it. See Indexer.skip_indexed().
+indexed_marker_seconds = 24 * 60 * 60  # 1 day
+
+# How long memcache should hold search results. They're also dropped whenever
+# the search index changes. See content_cache.get_search_results().
+search_cache_seconds = 60 * 60  # 1 hour
+
+# How long memcache should hold the ids of content each user has voted for and
+# commented on. See User.get_content_interactions().
+content_interactions_cache_seconds = 60 * 60  # 1 hour
+
+# How many of the most recent practices to sample related practices from, per
+# theme, topic, or lesson, and popular practices from, for the landing page;
+# and how long memcache should hold these pools. They're updated as practices
+# are saved. See Practice.get_pool_async().
+related_practice_pool_size = 15
+promoted_practice_pool_size = 20
+practice_pool_cache_seconds = 24 * 60 * 60  # 1 day
+
+# If True, page views are counted in memcache and periodically flushed to the
+# datastore by a cron job, rather than written to the datastore on every view.
+# See view_counter.py.
+buffer_view_counts = True
+
+# Shards of view counters are added when increments retry this many times
+# within the given number of seconds, up to a maximum. Instances cache shard
+# counts for a while, so other instances see changes eventually. Only applies
+# when buffer_view_counts is False; flushes don't contend.
+# See view_counter.increment_async().
+view_shard_contention_threshold = 5
+view_shard_contention_seconds = 60
+max_view_shards = 200
+view_shard_config_cache_seconds = 60
+
+# Counter name prefixes for which the most viewed counters are periodically
+# ranked. See view_counter.rank().
+ranked_view_counters = ['Lesson_', 'Practice_', 'Topic_']
+
+# Api.get() runs filters that would need too many datastore subqueries as up
+# to this many queries in parallel, and filters any the rest in python,
+# reading at most this many entities per query. See Api.plan_query().
+max_parallel_queries = 5
+max_post_filter_scan = 500
+
 # Locales available
 available_locales = ['en', 'es']
 default_locale = 'en'
 
 # The name of the full text search index that we maintain for content entities.
+# Rebuilding the index switches to a new one; see model.indexer.ContentIndex.
 content_index = 'content_2015'
 
+# How many key ranges of each kind are indexed in parallel when rebuilding the
+# search index. See Indexer.start_rebuild().
+index_rebuild_shards = 8
+
 # at least 8 characters, ascii only
 # http://stackoverflow.com/questions/5185326/java-script-regular-expression-for-detecting-non-ascii-characters
 password_pattern = r'^[\040-\176]{8,}$'
@@ -0,0 +1,252 @@
+"""A module implementing a versioned cache of curated content.
+
+Every page shows the same navigation tree of courses (themes) and their
+topics. Rather than rebuilding it from the datastore on every request, we cache
+it under a "content generation" number which is bumped whenever a Theme or
+Topic is written (see model.Model._post_put_hook). Old cache entries are never
+invalidated explicitly; they simply stop being looked up.
+
+There are two tiers:
+1. Instance memory, which is free but local to one App Engine instance.
+2. Memcache, shared by all instances.
+
+Search results are cached the same way, in memcache only, under a separate
+"search generation" which is bumped whenever the search index is written
+(see model.indexer.Indexer). Theme outlines are stored in the datastore, but
+checked against an "outline generation", bumped whenever a Theme, Topic, or
+Lesson is written (see model.ThemeOutline).
+
+Whole rendered pages are cached in memcache for signed-out visitors, under
+the content and outline generations, for a short time (see
+mindsetkit.ViewHandler).
+"""
+
+from google.appengine.api import memcache
+import hashlib
+import logging
+import os
+import random
+import time
+
+import config
+import util
+
+
+GENERATION_KEY = 'content-generation'
+NAVIGATION_KEY_TEMPLATE = 'navigation:{}:{}'
+SEARCH_GENERATION_KEY = 'search-generation'
+OUTLINE_GENERATION_KEY = 'outline-generation'
+SEARCH_KEY_TEMPLATE = 'search:{}:{}'
+PAGE_KEY_TEMPLATE = 'page:{}:{}:{}:{}:{}'
+
+# Instance memory tier. Only ever holds entries for one generation.
+_local_navigation = {}
+_local_generation = None
+
+# Running totals for this instance, reported through util.profiler.
+stats = {
+    'local_hits': 0,
+    'memcache_hits': 0,
+    'misses': 0,
+    'search_hits': 0,
+    'search_misses': 0,
+    'page_hits': 0,
+    'page_misses': 0,
+}
+
+
+def get_generation(key=GENERATION_KEY):
+    """The current content generation number.
+
+    If memcache has lost the number, start a new one based on the clock so
+    that no instance can confuse it with a generation it has cached before.
+
+    Args:
+        key: str, optional, which generation, e.g. SEARCH_GENERATION_KEY.
+    """
+    generation = memcache.get(key)
+    if generation is None:
+        memcache.add(key, int(time.time() * 1000))
+        generation = memcache.get(key)
+    return generation
+
+
+def bump_generation(key=GENERATION_KEY):
+    """Mark all cached content as stale.
+
+    Args:
+        key: str, optional, which generation, e.g. SEARCH_GENERATION_KEY.
+    """
+    generation = memcache.incr(key, initial_value=int(time.time() * 1000))
+    logging.info("Generation {} bumped to {}.".format(key, generation))
+    return generation
+
+
+def _build_navigation(api):
+    """Fetch all themes and topics for navigation from the datastore.
+
+    Returns a tuple of (courses, topics).
+    """
+    courses = api.get('Theme')
+    topics = []
+    if courses:
+        course_topic_ids = [id for course in courses for id in course.topics]
+        topics = api.get_by_id(course_topic_ids)
+    return (courses, topics)
+
+
+def _associate_navigation(courses, topics):
+    """Associate topics with appropriate courses.
+
+    Returns the topics of the "Teachers" kit, or None if there isn't one.
+    """
+    teacher_topics = None
+    topics_by_uid = util.index_by(topics or [], 'uid')
+    for course in courses:
+        course.associate_topics(topics_by_uid)
+        # Special case for "Teachers" kit
+        if course.name == 'Growth Mindset for Teachers':
+            teacher_topics = course.topics_list
+    return teacher_topics
+
+
+def get_navigation(api):
+    """Get the course/topic navigation tree visible to an api's user.
+
+    Admins see unlisted courses, so they get their own cache entry.
+
+    Returns a tuple of (courses, teacher_topics), where each course has a
+    `topics_list` attribute. See Theme.associate_topics().
+    """
+    global _local_generation
+
+    audience = 'admin' if api.user and api.user.is_admin else 'public'
+    generation = get_generation()
+    if generation is None:
+        # Memcache is unavailable, so there's no way to know if anything we
+        # have cached is fresh.
+        logging.warning("No content generation; skipping navigation cache.")
+        courses, topics = _build_navigation(api)
+        return (courses, _associate_navigation(courses, topics))
+
+    cache_key = NAVIGATION_KEY_TEMPLATE.format(generation, audience)
+
+    if generation != _local_generation:
+        _local_navigation.clear()
+        _local_generation = generation
+
+    if cache_key in _local_navigation:
+        stats['local_hits'] += 1
+        util.profiler.add_event(
+            "Nav cache local hit: {}".format(stats['local_hits']))
+        return _local_navigation[cache_key]
+
+    # Entities are pickled through their protocol buffers, which drops
+    # ephemeral attributes like topics_list, so memcache holds the raw
+    # entities and we associate them again here.
+    cached = memcache.get(cache_key)
+    if cached is not None:
+        stats['memcache_hits'] += 1
+        util.profiler.add_event(
+            "Nav cache memcache hit: {}".format(stats['memcache_hits']))
+        courses, topics = cached
+    else:
+        stats['misses'] += 1
+        util.profiler.add_event(
+            "Nav cache miss: {}".format(stats['misses']))
+        courses, topics = _build_navigation(api)
+        memcache.set(cache_key, (courses, topics),
+                     time=config.navigation_cache_seconds)
+
+    teacher_topics = _associate_navigation(courses, topics)
+    _local_navigation[cache_key] = (courses, teacher_topics)
+    return (courses, teacher_topics)
+
+
+def get_search_results(query_key, run_search):
+    """Get search results, from memcache if the index hasn't changed.
+
+    Results should not be specific to a user, because they're shared by
+    everyone making the same search.
+
+    Args:
+        query_key: unicode, normalized query string and page of the search.
+        run_search: function which takes no arguments and returns search
+            results to cache, called if there are none cached.
+    Returns:
+        The search results.
+    """
+    generation = get_generation(SEARCH_GENERATION_KEY)
+    if generation is None:
+        logging.warning("No search generation; skipping search cache.")
+        return run_search()
+
+    # Memcache keys are limited to 250 bytes; queries may be longer.
+    query_hash = hashlib.md5(query_key.encode('utf-8')).hexdigest()
+    cache_key = SEARCH_KEY_TEMPLATE.format(generation, query_hash)
+
+    results = memcache.get(cache_key)
+    if results is not None:
+        stats['search_hits'] += 1
+        util.profiler.add_event(
+            "Search cache hit: {}".format(stats['search_hits']))
+        return results
+
+    stats['search_misses'] += 1
+    util.profiler.add_event(
+        "Search cache miss: {}".format(stats['search_misses']))
+    results = run_search()
+    memcache.set(cache_key, results, time=config.search_cache_seconds)
+    return results
+
+
+def get_page_key(url):
+    """Memcache key for a cached copy of the page at a url.
+
+    Pages may include a random sample of content, like related practices, so
+    each url has config.page_cache_variants copies, each rendered with its
+    own sample, and this picks one at random. Pages list lessons from theme
+    outlines, so copies are also keyed by the outline generation, and lesson
+    edits show up right away.
+
+    Returns None if memcache is unavailable.
+    """
+    generation = get_generation()
+    outline_generation = get_generation(OUTLINE_GENERATION_KEY)
+    if generation is None or outline_generation is None:
+        return None
+    # Memcache keys are limited to 250 bytes; urls may be longer.
+    url_hash = hashlib.md5(url.encode('utf-8')).hexdigest()
+    variant = random.randrange(config.page_cache_variants)
+    return PAGE_KEY_TEMPLATE.format(
+        os.environ.get('CURRENT_VERSION_ID', ''), generation,
+        outline_generation, url_hash, variant)
+
+
+def get_page(key):
+    """Get a cached page, or None. See set_page()."""
+    page = memcache.get(key)
+    if page is None:
+        stats['page_misses'] += 1
+        util.profiler.add_event(
+            "Page cache miss: {}".format(stats['page_misses']))
+    else:
+        stats['page_hits'] += 1
+        util.profiler.add_event(
+            "Page cache hit: {}".format(stats['page_hits']))
+    return page
+
+
+def set_page(key, page):
+    """Cache a page for config.page_cache_seconds.
+
+    Args:
+        key: str, from get_page_key().
+        page: dict with 'body' (the html), 'etag', and 'views' (names of
+            view counters to increment each time it's served).
+    """
+    try:
+        memcache.set(key, page, time=config.page_cache_seconds)
+    except ValueError:
+        # Values over memcache's size limit are rejected.
+        logging.warning("Page too large to cache: {}".format(key))
@@ -3,13 +3,14 @@
 from google.appengine.ext import ndb
 import cloudstorage
 
-import datetime
 import logging
 
 from api import PermissionDenied
-from model import (Email, ErrorChecker, Indexer, User)
+from model import (Email, ErrorChecker, Indexer, Lesson, User)
 import config
+import templating
 import util
+import view_counter
 
 
 class Cron:
@@ -34,6 +35,45 @@ class Cron:
         checker.put()
         return result
 
+    def check_lesson_templates(self):
+        """Report lessons without templates, which can't be viewed, and
+        templates without lessons, which are dead weight.
+        See templating.get_lesson_templates().
+        """
+        lesson_uids = set(
+            Lesson.convert_uid(k.id())
+            for k in Lesson.query(Lesson.deleted == False).iter(
+                keys_only=True))
+        template_uids = set(templating.get_lesson_templates())
+
+        report = {
+            'lessons_without_templates': sorted(lesson_uids - template_uids),
+            'templates_without_lessons': sorted(template_uids - lesson_uids),
+        }
+        for k, uids in report.items():
+            if uids:
+                logging.warning(u"{}: {}".format(k, uids))
+        return report
+
+    def compact_view_counts(self, cursor=None):
+        """Merge the shards of view counters that are no longer viewed.
+        See view_counter.compact() for full description.
+        """
+        return view_counter.compact(cursor)
+
+    def flush_view_counts(self):
+        """Save views buffered in memcache to the datastore.
+        See view_counter.flush() for full description.
+        """
+        return view_counter.flush()
+
+    def rank_views(self):
+        """Rank the most viewed content of each kind.
+        See view_counter.rank() for full description.
+        """
+        return {prefix: len(view_counter.rank(prefix).names)
+                for prefix in config.ranked_view_counters}
+
     def send_pending_email(self):
         """Send any email in the queue.
         Must be called with internal_api for full permissions.
@@ -65,81 +105,41 @@ class Cron:
         return changed_users
 
     def index_all(self):
-        """Cron job to index all content. Should only be run as
-        a job because it will likely timeout otherwise. Comes in handy
-        for production where updates are constantly being made.
+        """Cron job to rebuild the search index from all content. Runs as
+        many tasks, which switch searches to the new index when done.
+        See Indexer.start_rebuild() for full description.
         """
         indexer = Indexer.get_or_insert('the-indexer')
-        index = indexer.get_index()
+        return indexer.start_rebuild()
 
-        entities = indexer.get_all_content_entities()
-        indexed_count = 0
-        for entity in entities:
-            # Added redundancy (we really don't want these!!)
-            if getattr(entity, 'listed') is True:
-                index.put(entity.to_search_document())
-                indexed_count += 1
+    def index_all_shard(self, **params):
+        """Task to index one range of content into a rebuilt index.
+        See Indexer.rebuild_shard() for full description.
+        """
+        indexer = Indexer.get_or_insert('the-indexer')
+        return indexer.rebuild_shard(**params)
 
-        # Update last_check on indexer to now
-        now = datetime.datetime.now()
-        indexer.last_check = (
-            now
-        )
-        indexer.put()
+    def index_all_cleanup(self, index_name):
+        """Task to delete a search index that's been replaced or abandoned.
+        See Indexer.cleanup_index() for full description.
+        """
+        indexer = Indexer.get_or_insert('the-indexer')
+        return indexer.cleanup_index(index_name)
 
-        return indexed_count
+    def index_queued(self):
+        """Index content queued by Model._post_put_hook().
+        See Indexer.index_queued() for full description.
+        """
+        indexer = Indexer.get_or_insert('the-indexer')
+        return indexer.index_queued()
 
     def index(self):
         """Index content entities for text search.
         Must be called with internal_api for full permissions.
-        See named_model@Index for full description.
+        See Indexer.index_changed() for full description.
         """
-
         indexer = Indexer.get_or_insert('the-indexer')
-        index = indexer.get_index()
-        # Now and the max modified time of indexed entites
-        # will be used to update last_check.  Basically the
-        # last check should either be now time if no items
-        # were found to update or the age of the last item
-        # that was updated.
-        #
-        # The reason that we cannot always use now time is
-        # because we may not index all of the enties between
-        # the last check and now if there are many of them.
-        now = datetime.datetime.now()
-        max_modified_time_of_indexed_entity = None
-
-        # get changes
-        changed_entities = indexer.get_changed_content_entities()
-
-        # post changes
-        for entity in changed_entities:
-            # Added redundancy (we really don't want these!!)
-            if getattr(entity, 'listed') is True:
-                index.put(entity.to_search_document())
-
-                # Update the most recent modification time for an
-                # indexed entity
-                if max_modified_time_of_indexed_entity is None:
-                    max_modified_time_of_indexed_entity = entity.modified
-                else:
-                    max_modified_time_of_indexed_entity = max(
-                        max_modified_time_of_indexed_entity,
-                        entity.modified
-                    )
-
-        # Update last_check so that future calls to index no longer
-        # try to index these same items.  The logic of what to set
-        # last_check to is articulated above.
-        any_updates = max_modified_time_of_indexed_entity is not None
-        indexer.last_check = (
-            now if not
-            any_updates
-            else max_modified_time_of_indexed_entity
-        )
-        indexer.put()
-
-        return changed_entities
+        return indexer.index_changed()
 
     def clean_gcs_bucket(self, bucket):
         """Deletes all files in a given GCS bucket.
@@ -96,6 +96,34 @@ class CleanGcsBucketHandler(CronHandler):
         self.write(self.cron.clean_gcs_bucket(bucket))
 
 
+class CheckLessonTemplates(CronHandler):
+    """See Cron.check_lesson_templates() for details."""
+    def get(self):
+        self.write(self.cron.check_lesson_templates())
+
+
+class CompactViewCounts(CronHandler):
+    """See view_counter.compact() for details."""
+    def get(self):
+        self.write(self.cron.compact_view_counts())
+
+    def post(self):
+        """Task queue handler, continuing from a cursor."""
+        self.write(self.cron.compact_view_counts(self.request.get('cursor')))
+
+
+class FlushViewCounts(CronHandler):
+    """See view_counter.flush() for details."""
+    def get(self):
+        self.write(self.cron.flush_view_counts())
+
+
+class RankViews(CronHandler):
+    """See view_counter.rank() for details."""
+    def get(self):
+        self.write(self.cron.rank_views())
+
+
 class SendPendingEmail(CronHandler):
     """See id_model@email for details."""
     def get(self):
@@ -103,7 +131,7 @@ class SendPendingEmail(CronHandler):
 
 
 class IndexContent(CronHandler):
-    """See api.index() for details."""
+    """See Indexer.index_changed() for details."""
 
     def delete(self):
         indexer = Indexer.get_or_insert('the-indexer')
@@ -115,13 +143,33 @@ class IndexContent(CronHandler):
         self.write(self.cron.index())
 
 
+class IndexQueuedContent(CronHandler):
+    """See Indexer.index_queued() for details."""
+    def get(self):
+        self.write(self.cron.index_queued())
+
+
 class IndexAllContent(CronHandler):
-    """See api.index_all() for details."""
+    """See Indexer.start_rebuild() for details."""
 
     def get(self):
-        num_indexed = self.cron.index_all()
-        self.write("Indexed {} entities in the search index."
-                   .format(num_indexed))
+        self.write(self.cron.index_all())
+
+
+class IndexAllShard(CronHandler):
+    """Task queue handler. See Indexer.rebuild_shard() for details."""
+
+    def post(self):
+        params = {k: self.request.get(k) for k in self.request.arguments()}
+        self.write(self.cron.index_all_shard(**params))
+
+
+class IndexAllCleanup(CronHandler):
+    """Task queue handler. See Indexer.cleanup_index() for details."""
+
+    def post(self):
+        self.write(self.cron.index_all_cleanup(
+            self.request.get('index_name')))
 
 
 class AssignUsernames(CronHandler):
@@ -211,7 +259,14 @@ application = webapp2.WSGIApplication([
     ('/cron/clean_gcs_bucket/(.*)', CleanGcsBucketHandler),
     # ('/cron/run_unit_tests', UnitTestHandler),
     ('/cron/send_pending_email', SendPendingEmail),
+    ('/cron/flush_view_counts', FlushViewCounts),
+    ('/cron/rank_views', RankViews),
+    ('/cron/compact_view_counts', CompactViewCounts),
+    ('/cron/check_lesson_templates', CheckLessonTemplates),
     ('/cron/index', IndexContent),
+    ('/cron/index_queued', IndexQueuedContent),
     ('/cron/index_all', IndexAllContent),
+    ('/cron/index_all/shard', IndexAllShard),
+    ('/cron/index_all/cleanup', IndexAllCleanup),
     ('/cron/assign_usernames', AssignUsernames),
 ], config=webapp2_config, debug=debug)
@@ -25,17 +25,57 @@ import webapp2_extras.appengine.auth.models
 
 from api import Api, PermissionDenied
 from base_handler import BaseHandler
-from model import User, Practice, Theme, Topic, Lesson, ResetPasswordToken
+from model import (Model, User, Practice, Theme, Topic, Lesson,
+                   ResetPasswordToken, ThemeOutline)
 import config
+import content_cache
 import util
 import view_counter
 import mandrill
 import locales
+import templating
 
 
 # Make sure this is off in production, it exposes exception messages.
 debug = util.is_development()
 
+# Marks where the server time goes in pages that are cached, so each copy
+# served gets its own. See ViewHandler.write().
+SERVER_TIME_MARKER = re.compile(u'\ue000server_time(?:\\.(\\w+))?\ue000')
+
+
+class CachedServerTime(object):
+    """Stands in for server_time when rendering a page to cache.
+
+    Renders as markers, e.g. {{ server_time.year }} as a marker of the year,
+    which fill_in_server_time() replaces as the page is served.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            # E.g. jinja checking for __html__.
+            raise AttributeError(name)
+        return u'\ue000server_time.{}\ue000'.format(name)
+
+    def __unicode__(self):
+        return u'\ue000server_time\ue000'
+
+
+def get_server_time():
+    return datetime.datetime.today().replace(microsecond=0)
+
+
+def fill_in_server_time(body):
+    """Replace the markers left by CachedServerTime with the current time."""
+    server_time = get_server_time()
+
+    def replace(match):
+        if match.group(1) is None:
+            return unicode(server_time)
+        return unicode(getattr(server_time, match.group(1)))
+
+    return SERVER_TIME_MARKER.sub(replace, body)
+
 
 class MetaView(type):
     """Allows code to be run before and after get and post methods.
@@ -72,6 +112,10 @@ class MetaView(type):
                     self.handle_google_response()
                 return
 
+            # Signed-out visitors may get a copy of the page from cache.
+            if self.serve_cached_page():
+                return
+
             ## INHERITING GET HANDLER RUNS HERE ##
 
             return_value = method(self, *args, **kwargs)
@@ -96,63 +140,19 @@ class ViewHandler(BaseHandler):
 
     __metaclass__ = MetaView
 
+    # Handlers whose pages are the same for every signed-out visitor can opt
+    # in to having them cached. See serve_cached_page().
+    cache_anonymous_pages = False
+
     def get_jinja_environment(self, template_path='templates'):
-        return jinja2.Environment(
-            autoescape=True,
-            extensions=['jinja2.ext.autoescape'],
-            loader=jinja2.FileSystemLoader(template_path),
-        )
+        """The environment is shared, so templates are only compiled once per
+        instance. See templating.py."""
+        return templating.get_environment(template_path)
 
     def write(self, template_filename, template_path='templates', **kwargs):
         util.profiler.add_event("Begin ViewHandler:write")
         jinja_environment = self.get_jinja_environment(template_path)
 
-        # Jinja environment filters:
-
-        @jinja2.evalcontextfilter
-        def jinja_json_filter(eval_context, value):
-            """Seralize value as JSON and mark as safe for jinja."""
-            return jinja2.Markup(json.dumps(value))
-
-        jinja_environment.filters['to_json'] = jinja_json_filter
-
-        def nl2br(value):
-            """Replace new lines with <br> for html view"""
-            return value.replace('\n', '<br>\n')
-
-        jinja_environment.filters['nl2br'] = nl2br
-
-        def format_datetime(value):
-            # Formats datetime as Ex: "January 9, 2015"
-            return '{dt:%B} {dt.day}, {dt.year}'.format(dt=value)
-
-        jinja_environment.filters['datetime'] = format_datetime
-
-        def format_ampescape(value):
-            return value.replace('&', '%26')
-
-        jinja_environment.filters['ampescape'] = format_ampescape
-
-        def format_filetype(value):
-            if value.split('/')[0] in ['application']:
-                if value.split('/')[1] in ['pdf']:
-                    formatted_type = 'pdf file'
-                elif value.split('/')[1].find('wordprocessing') > -1:
-                    formatted_type = 'word document'
-                elif value.split('/')[1].find('presentation') > -1:
-                    formatted_type = 'presentation'
-                else:
-                    formatted_type = 'document'
-            elif value.split('/')[0] in ['image']:
-                formatted_type = 'image file'
-            else:
-                formatted_type = value.split('/')[0]
-            return formatted_type
-
-        jinja_environment.filters['filetype'] = format_filetype
-
-        util.profiler.add_event("Begin ViewHandler:add_jinja_filters")
-
         user = self.get_current_user()
 
         util.profiler.add_event("Begin ViewHandler:get_current_user()")
@@ -178,7 +178,11 @@ class ViewHandler(BaseHandler):
         kwargs['hosting_domain'] = os.environ['HOSTING_DOMAIN']
         kwargs['share_url'] = self.request.url
         kwargs['google_client_id'] = config.google_client_id
-        kwargs['server_time'] = datetime.datetime.today().replace(microsecond=0)
+        if self._page_cache_key:
+            # Anything per-request must be filled in as each copy is served.
+            kwargs['server_time'] = CachedServerTime()
+        else:
+            kwargs['server_time'] = get_server_time()
 
 
         util.profiler.add_event("Begin ViewHandler:set_user_params")
@@ -198,19 +202,8 @@ class ViewHandler(BaseHandler):
 
         util.profiler.add_event("Begin ViewHandler:start_fetching_themes")
 
-        # Fetch all themes and topics for navigation
-        courses = self.api.get('Theme')
-        if courses:
-            # Fetch all topics for courses
-            course_topic_ids = [id for course in courses for id in course.topics]
-            course_topics = self.api.get_by_id(course_topic_ids)
-            # Associate topics with appropriate courses
-            for course in courses:
-                course.associate_topics(course_topics)
-                # Special case for "Teachers" kit
-                if course.name == 'Growth Mindset for Teachers':
-                    kwargs['teacher_topics'] = course.topics_list
-        kwargs['courses'] = courses
+        # Get all themes and topics for navigation, usually from cache.
+        self.add_navigation(kwargs)
 
         util.profiler.add_event("Begin ViewHandler:finish_fetching_themes")
 
@@ -225,7 +218,103 @@ class ViewHandler(BaseHandler):
             return self.http_not_found()
 
         # Render the template with data and write it to the HTTP response.
-        self.response.write(template.render(kwargs))
+        body = template.render(kwargs)
+
+        if self._page_cache_key:
+            content_cache.set_page(self._page_cache_key, {
+                'body': body,
+                'etag': self.response.etag,
+                'views': self._counted_views,
+            })
+            body = fill_in_server_time(body)
+        self.response.write(body)
+
+    def serve_cached_page(self):
+        """Write a cached copy of the page, if there is one.
+
+        Only for handlers with cache_anonymous_pages, and signed-out visitors
+        without query string parameters. If there's no copy, write() will
+        cache the page it renders. The server time is filled in as each copy
+        is served; view counts are incremented again.
+
+        Returns True if the page was served from cache.
+        """
+        if (not self.cache_anonymous_pages or self.request.query_string or
+                self.get_current_user()):
+            return False
+
+        key = content_cache.get_page_key(self.request.path_url)
+        if key is None:
+            return False
+        page = content_cache.get_page(key)
+        if page is None:
+            self._page_cache_key = key
+            return False
+
+        # Views of cached pages still count.
+        ndb.Future.wait_all(
+            [view_counter.increment_async(n) for n in page['views']])
+
+        if page['etag']:
+            self.response.etag = page['etag']
+            if page['etag'] in self.request.if_none_match:
+                self.response.set_status(304)
+                return True
+        self.response.write(fill_in_server_time(page['body']))
+        return True
+
+    def get_lesson_template(self, lesson_id):
+        """Name of the template for a lesson, or None if it doesn't have one.
+
+        Args:
+            lesson_id: str, short or long uid of the lesson.
+        """
+        long_uid = Lesson.get_long_uid(lesson_id)
+        if long_uid is None:
+            return None
+        return templating.get_lesson_templates().get(
+            Lesson.convert_uid(long_uid))
+
+    def count_view_async(self, name):
+        """Increment a view counter, and again whenever a cached copy of this
+        page is served. See view_counter.increment_async()."""
+        self._counted_views.append(name)
+        return view_counter.increment_async(name)
+
+    def not_modified(self, *entities):
+        """Whether the client already has the current version of this page.
+
+        Call after loading the entities a page shows and before rendering it.
+        Every page also shows the navigation tree and the current user, so
+        those are accounted for here. Randomly sampled content, like related
+        practices, is left out; otherwise pages would never match.
+
+        Args:
+            entities: entities, outlines, or lists of entities the page is
+                made from.
+        Returns:
+            True if the response is now a 304 Not Modified, and the handler
+            should return without writing.
+        """
+        flat_entities = [self.get_current_user(),
+                         self.get_current_user(method='normal')]
+        for e in entities:
+            if type(e) is list:
+                flat_entities.extend(e)
+            elif isinstance(e, (Model, ThemeOutline)):
+                flat_entities.append(e)
+        return self.etag_matches(flat_entities,
+                                 content_cache.get_generation())
+
+    def add_navigation(self, template_kwargs):
+        """Add the course/topic navigation tree to template variables.
+
+        See content_cache.get_navigation().
+        """
+        courses, teacher_topics = content_cache.get_navigation(self.api)
+        template_kwargs['courses'] = courses
+        if teacher_topics is not None:
+            template_kwargs['teacher_topics'] = teacher_topics
 
     def handle_google_response(self):
         """Figure out the results of the user's interaction with google.
@@ -274,6 +363,9 @@ class ViewHandler(BaseHandler):
         self.redirect(refresh_url)
 
     def dispatch(self):
+        # See serve_cached_page().
+        self._page_cache_key = None
+        self._counted_views = []
         try:
             logging.info("ViewHandler.dispatch()")
             # Call the overridden dispatch(), which has the effect of running
@@ -337,19 +429,8 @@ class ViewHandler(BaseHandler):
             kwargs['facebook_app_id'] = config.facebook_app_id
             kwargs['facebook_app_secret'] = config.facebook_app_secret
 
-        # Fetch all themes and topics for navigation
-        courses = self.api.get('Theme')
-        if courses:
-            # fetch topics for each theme
-            course_topic_ids = [id for course in courses for id in course.topics]
-            course_topics = self.api.get_by_id(course_topic_ids)
-            # associate topics with appropriate courses
-            for course in courses:
-                course.associate_topics(course_topics)
-                # Special case for "Teachers" kit
-                if course.name == 'Growth Mindset for Teachers':
-                    kwargs['teacher_topics'] = course.topics_list
-        kwargs['courses'] = courses
+        # Get all themes and topics for navigation, usually from cache.
+        self.add_navigation(kwargs)
 
         self.error(404)
         jinja_environment = self.get_jinja_environment()
@@ -538,11 +619,14 @@ class PracticePage(ViewHandler):
 
             # Get color from associated content
             color = '#51516c'  # default color
+            associated_content = None
             if practice.associated_content:
                 associated_content = self.api.get_by_id(practice.associated_content)
                 color = associated_content.color
 
             creator = practice.key.parent().get()
+            if self.not_modified(practice, creator, associated_content):
+                return
             self.write(
                 'practice.html',
                 practice=practice,
@@ -597,30 +681,17 @@ class SurveyInstructions(ViewHandler):
 
 class ThemeHandler(ViewHandler):
 
+    cache_anonymous_pages = True
+
     def get(self, theme_id):
         id = Theme.get_long_uid(theme_id)
+        # Topics and lessons come from the theme's outline, read alongside
+        # the theme, so the page needs one round of reads however big the
+        # course is. See ThemeOutline.
+        outline_future = ThemeOutline.get_async(id)
         theme = self.api.get_by_id(id)
-        first_lesson_link = ''
         if theme is not None:
-            # fetch topics for theme
-            topics = []
-            if theme.topics:
-                topics = self.api.get_by_id(theme.topics)
-                # fetch lessons for each topic
-                topic_lesson_ids = [id for topic in topics for id in topic.lessons]
-                theme_lessons = self.api.get_by_id(topic_lesson_ids)
-                # associate lessons with appropriate topics
-                for topic in topics:
-                    topic.lessons_list = [l for l in theme_lessons if l.uid in topic.lessons]
-
-                # get first lesson for CTA
-                first_lesson_link = '/{}'.format(theme.short_uid)
-                has_first_lesson = topics[0] and topics[0].lessons_list and topics[0].lessons_list[0]
-                if has_first_lesson:
-                    first_lesson_link = '/{}/{}/{}'.format(
-                        first_lesson_link,
-                        topics[0].short_uid,
-                        topics[0].lessons_list[0].short_uid)
+            outline = outline_future.get_result()
 
             # Get related practices
             related_practices = Practice.get_related_practices(theme, 6)
@@ -631,11 +702,13 @@ class ThemeHandler(ViewHandler):
             else:
                 locale = default_locale
 
+            if self.not_modified(theme, outline):
+                return
             self.write(
                 'theme.html',
                 theme=theme,
-                topics=topics,
-                first_lesson_link=first_lesson_link,
+                topics=outline.topics,
+                first_lesson_link=outline.first_lesson_link,
                 audience=theme.target_audience,
                 related_practices=related_practices,
                 locale=locale,
@@ -685,32 +758,54 @@ class OldSpanishThemeHandler(ViewHandler):
 
 class TopicHandler(ViewHandler):
 
-    def get(self, topic_id):
-        full_topic_id = Topic.get_long_uid(topic_id)
-        topic = self.api.get_by_id(full_topic_id)
+    cache_anonymous_pages = True
 
-        # check all content objects were found
-        if topic is not None:
+    @ndb.tasklet
+    def load_async(self, full_topic_id):
+        """Load everything the page needs. Once the topic is known, the rest
+        of the reads are independent and run concurrently:
 
-            # Increment view counts on the topic
-            view_counter.increment(full_topic_id)
+            topic -+-> lessons
+                   +-> related practices
+                   +-> view count
 
-            # find lessons in topic
-            lessons = []
-            if topic.lessons:
-                lessons = self.api.get_by_id(topic.lessons)
+        Returns a dictionary of template values, or None if the topic doesn't
+        exist.
+        """
+        topic = yield self.api.get_by_id_async(full_topic_id)
+        if topic is None:
+            raise ndb.Return(None)
 
-            # Get related practices
-            related_practices = Practice.get_related_practices(topic, 6)
+        # Increment view counts on the topic
+        view_count_future = self.count_view_async(full_topic_id)
 
-            self.write(
-                'topic.html',
-                topic=topic,
-                lessons=lessons,
-                color=topic.color,
-                related_practices=related_practices,
-            )
+        # find lessons in topic
+        lessons_future = self.api.get_by_id_async(topic.lessons or [])
+
+        # Get related practices
+        related_practices_future = Practice.get_related_practices_async(
+            topic, 6)
 
+        lessons, related_practices, _ = yield (
+            lessons_future, related_practices_future, view_count_future)
+
+        raise ndb.Return({
+            'topic': topic,
+            'lessons': lessons or [],
+            'color': topic.color,
+            'related_practices': related_practices,
+        })
+
+    def get(self, topic_id):
+        full_topic_id = Topic.get_long_uid(topic_id)
+        template_values = self.load_async(full_topic_id).get_result()
+
+        # check all content objects were found
+        if template_values is not None:
+            if self.not_modified(template_values['topic'],
+                                 template_values['lessons']):
+                return
+            self.write('topic.html', **template_values)
         else:
             # 404 if topic cannot be found
             return self.http_not_found()
@@ -739,194 +834,237 @@ class OldTopicHandler(ViewHandler):
 
 class LessonHandler(ViewHandler):
 
-    def get(self, theme_id, topic_id, lesson_id):
-        full_lesson_id = Lesson.get_long_uid(lesson_id)
-        lesson = self.api.get_by_id(full_lesson_id)
+    cache_anonymous_pages = True
 
-        full_theme_id = Theme.get_long_uid(theme_id)
-        theme = self.api.get_by_id(full_theme_id)
+    @ndb.tasklet
+    def load_async(self, full_theme_id, full_topic_id, full_lesson_id):
+        """Load everything the page needs in one round of reads:
 
-        full_topic_id = Topic.get_long_uid(topic_id)
-        topic = self.api.get_by_id(full_topic_id)
+            lesson, theme, topic, theme outline -> view counts
+
+        Neighboring lessons and topics come from the theme's outline, rather
+        than reading them all. See ThemeOutline.
+
+        Returns a dictionary of template values, or None if any of the lesson,
+        theme, or topic don't exist.
+        """
+        lesson, theme, topic, outline = yield (
+            self.api.get_by_id_async(full_lesson_id),
+            self.api.get_by_id_async(full_theme_id),
+            self.api.get_by_id_async(full_topic_id),
+            ThemeOutline.get_async(full_theme_id),
+        )
 
         # check all content objects were found
-        if lesson is not None and topic is not None and theme is not None:
-
-            # Increment view counts on the lesson
-            view_counter.increment(full_lesson_id)
-            view_counter.increment('{}:{}:{}'.format(
-                full_theme_id, full_topic_id, full_lesson_id))
-
-            # Get other topics in theme for navigating
-            topics = []
-            if theme.topics:
-                topics = self.api.get_by_id(theme.topics)
-
-            # get other lessons in topic for navigating
-            lessons = []
-            # first check for bad topic--lesson match
-            if topic.lessons:
-                lessons = self.api.get_by_id(topic.lessons)
-
-                # get lesson index and previous and next lessons
-                lesson_index = 0
-                topic_index = 0
-                if topic.uid in theme.topics:
-                    topic_index = theme.topics.index(topic.uid)
-                if lesson.uid in topic.lessons:
-                    lesson_index = topic.lessons.index(lesson.uid)
-
-                # get next lesson from current or next topic
-                next_lesson = ''
-                next_lesson_url = ''
-                next_topic = ''
-                next_topic_url = ''
-                next_url = ''
-                if lesson_index < len(lessons) - 1:
-                    next_lesson = lessons[lesson_index + 1]
-                    next_lesson_url = '/{}/{}/{}'.format(
-                        theme.short_uid, topic.short_uid, next_lesson.short_uid)
-                    next_url = next_lesson_url
-                elif topic_index < len(theme.topics) - 1:
-                    next_topic = topics[topic_index + 1]
-                    next_topic_url = '/{}/{}'.format(
-                        theme.short_uid, next_topic.short_uid)
-                    next_url = next_topic_url
+        if (lesson is None or topic is None or theme is None or
+                outline is None):
+            raise ndb.Return(None)
+
+        # Increment view counts on the lesson
+        view_count_futures = [
+            self.count_view_async(full_lesson_id),
+            self.count_view_async('{}:{}:{}'.format(
+                full_theme_id, full_topic_id, full_lesson_id)),
+        ]
+
+        # Other lessons in topic and the next topic, for navigating
+        navigation = outline.get_navigation(topic.uid, lesson.uid)
+        lessons = navigation['lessons']
+        lesson_index = navigation['lesson_index']
+
+        # get next lesson from current or next topic
+        next_lesson = ''
+        next_lesson_url = ''
+        next_topic = ''
+        next_topic_url = ''
+        next_url = ''
+        # first check for bad topic--lesson match
+        if lessons:
+            if navigation['next_lesson']:
+                next_lesson = navigation['next_lesson']
+                next_lesson_url = '/{}/{}/{}'.format(
+                    theme.short_uid, topic.short_uid, next_lesson.short_uid)
+                next_url = next_lesson_url
+            elif navigation['next_topic']:
+                next_topic = navigation['next_topic']
+                next_topic_url = '/{}/{}'.format(
+                    theme.short_uid, next_topic.short_uid)
+                next_url = next_topic_url
+
+        # Get translated text and locale
+        if theme.locale in config.available_locales:
+            locale = theme.locale
+        else:
+            locale = config.default_locale
 
-            # Get translated text and locale
-            if theme.locale in config.available_locales:
-                locale = theme.locale
-            else:
-                locale = config.default_locale
+        yield view_count_futures
+
+        raise ndb.Return({
+            'theme': theme,
+            'outline': outline,
+            'topic': topic,
+            'lesson': lesson,
+            'lessons': lessons,
+            'lesson_index': lesson_index,
+            'next_lesson': next_lesson,
+            'next_lesson_url': next_lesson_url,
+            'next_topic': next_topic,
+            'next_topic_url': next_topic_url,
+            'next_url': next_url,
+            'color': topic.color,
+            'audience': theme.target_audience,
+            'locale': locale,
+            'translation': locales.translations[locale]["lessons"],
+        })
 
-            if os.path.isfile('templates/lessons/' + lesson.short_uid + '.html'):
-                self.write(
-                    '/lessons/{}.html'.format(lesson.short_uid),
-                    theme=theme,
-                    topic=topic,
-                    lesson=lesson,
-                    lessons=lessons,
-                    lesson_index=lesson_index,
-                    next_lesson=next_lesson,
-                    next_lesson_url=next_lesson_url,
-                    next_topic=next_topic,
-                    next_topic_url=next_topic_url,
-                    next_url=next_url,
-                    color=topic.color,
-                    audience=theme.target_audience,
-                    locale=locale,
-                    translation=locales.translations[locale]["lessons"],
-                )
-            else:
-                # 404 if lesson html cannot be found
-                return self.http_not_found()
+    def get(self, theme_id, topic_id, lesson_id):
+        # 404 if lesson html cannot be found, before reading anything else
+        template_name = self.get_lesson_template(lesson_id)
+        if template_name is None:
+            return self.http_not_found()
 
-        else:
+        template_values = self.load_async(
+            Theme.get_long_uid(theme_id),
+            Topic.get_long_uid(topic_id),
+            Lesson.get_long_uid(lesson_id),
+        ).get_result()
+
+        if template_values is None:
             # 404 if lesson cannot be found
             return self.http_not_found()
 
+        if self.not_modified(*[template_values[k] for k in (
+                'theme', 'topic', 'lesson', 'outline')]):
+            return
+        self.write(template_name, **template_values)
+
 
 class TopicLessonHandler(ViewHandler):
 
-    def get(self, topic_id, lesson_id):
-        full_lesson_id = Lesson.get_long_uid(lesson_id)
-        lesson = self.api.get_by_id(full_lesson_id)
+    cache_anonymous_pages = True
 
-        full_topic_id = Topic.get_long_uid(topic_id)
-        topic = self.api.get_by_id(full_topic_id)
+    @ndb.tasklet
+    def load_async(self, full_topic_id, full_lesson_id):
+        """Load everything the page needs, starting each read as soon as what
+        it depends on is known:
 
-        # check all content objects were found
-        if not (lesson is None or topic is None):
+            lesson, topic -+-> theme, theme outline
+                           +-> related practices
+                           +-> view counts
 
-            # Increment view counts on the lesson
-            view_counter.increment(full_lesson_id)
-            view_counter.increment(
-                '{}:{}'.format(full_topic_id, full_lesson_id))
+        Neighboring lessons and topics come from the outline of the topic's
+        first theme, rather than reading them all. See ThemeOutline.
 
-            theme = self.api.get_by_id(topic.themes[0])
-            # Determines if current theme is for Teachers or not
-            # 'teacher_theme' variable affects the UI
-            teacher_theme = (theme.short_uid in ['growth-mindset', 'growth-mindset-teachers'])
+        Returns a dictionary of template values, or None if the lesson or
+        topic doesn't exist.
+        """
+        lesson, topic = yield (
+            self.api.get_by_id_async(full_lesson_id),
+            self.api.get_by_id_async(full_topic_id),
+        )
 
-            # Get related practices
-            related_practices = Practice.get_related_practices(topic, 4)
-
-            # get other lessons in topic for navigating
-            lessons = []
-            # first check for bad topic--lesson match
-            if topic.lessons:
-                lessons = self.api.get_by_id(topic.lessons)
-
-                # get lesson index and previous and next lessons
-                lesson_index = 0
-                if lesson.uid in topic.lessons:
-                    lesson_index = topic.lessons.index(lesson.uid)
-
-                next_topic = ''
-                related_topics = []
-
-                # get next lesson from current or next topic
-                next_lesson = ''
-                next_lesson_url = ''
-                next_url = ''
-                if lesson_index < len(lessons) - 1:
-                    next_lesson = lessons[lesson_index + 1]
-                    next_lesson_url = '/topics/{}/{}'.format(
-                        topic.short_uid, next_lesson.short_uid)
-                    next_url = next_lesson_url
-                else:
-                    # fetch next topic for final lesson
-                    topic_index = 0
-                    if topic.uid in theme.topics:
-                        topic_index = theme.topics.index(topic.uid)
-                    if topic_index < len(theme.topics) - 1:
-                        next_topic = self.api.get_by_id(theme.topics[topic_index + 1])
-                        next_url = '/topics/{}'.format(next_topic.short_uid)
-
-                    # get list of 3 other topics
-                    related_topic_ids = []
-                    for idx, val in enumerate(theme.topics):
-                        if next_topic:
-                            if val != topic.uid and val != next_topic.uid:
-                                related_topic_ids.append(val)
-                        elif val != topic.uid:
-                            related_topic_ids.append(val)
-                    if related_topic_ids:
-                        related_topics = self.api.get_by_id(related_topic_ids)
-                        if len(related_topics) >= 3:
-                            related_topics = random.sample(related_topics, 3)
-
-            # All topic lessons use default locale
-            locale = config.default_locale
+        # check all content objects were found
+        if lesson is None or topic is None:
+            raise ndb.Return(None)
+
+        # Increment view counts on the lesson
+        view_count_futures = [
+            self.count_view_async(full_lesson_id),
+            self.count_view_async(
+                '{}:{}'.format(full_topic_id, full_lesson_id)),
+        ]
+
+        # Get related practices
+        related_practices_future = Practice.get_related_practices_async(
+            topic, 4)
+
+        # get the theme, and its outline for navigating
+        theme, outline = yield (
+            self.api.get_by_id_async(topic.themes[0]),
+            ThemeOutline.get_async(topic.themes[0]),
+        )
+        if theme is None or outline is None:
+            raise ndb.Return(None)
+
+        # Determines if current theme is for Teachers or not
+        # 'teacher_theme' variable affects the UI
+        teacher_theme = (theme.short_uid in ['growth-mindset', 'growth-mindset-teachers'])
+
+        navigation = outline.get_navigation(topic.uid, lesson.uid)
+        lessons = navigation['lessons']
+        lesson_index = navigation['lesson_index']
+
+        next_topic = ''
+        related_topics = []
+
+        # get next lesson from current or next topic
+        next_lesson = ''
+        next_lesson_url = ''
+        next_url = ''
+        # first check for bad topic--lesson match
+        if lessons:
+            if navigation['next_lesson']:
+                next_lesson = navigation['next_lesson']
+                next_lesson_url = '/topics/{}/{}'.format(
+                    topic.short_uid, next_lesson.short_uid)
+                next_url = next_lesson_url
+            else:
+                # next topic and list of 3 other topics for final lesson
+                if navigation['next_topic']:
+                    next_topic = navigation['next_topic']
+                    next_url = '/topics/{}'.format(next_topic.short_uid)
+
+                other_topics = navigation['other_topics']
+                related_topics = [t for t in other_topics
+                                  if not next_topic or t.uid != next_topic.uid]
+                if len(related_topics) >= 3:
+                    related_topics = random.sample(related_topics, 3)
+
+        # All topic lessons use default locale
+        locale = config.default_locale
+
+        related_practices = yield related_practices_future
+        yield view_count_futures
+
+        raise ndb.Return({
+            'theme': theme,
+            'outline': outline,
+            'teacher_theme': teacher_theme,
+            'topic': topic,
+            'lesson': lesson,
+            'lessons': lessons,
+            'lesson_index': lesson_index,
+            'next_lesson': next_lesson,
+            'next_lesson_url': next_lesson_url,
+            'next_url': next_url,
+            'next_topic': next_topic,
+            'color': topic.color,
+            'related_topics': related_topics,
+            'related_practices': related_practices,
+            'locale': locale,
+            'translation': locales.translations[locale]["lessons"],
+        })
 
-            if os.path.isfile('templates/lessons/' + lesson.short_uid + '.html'):
-                self.write(
+    def get(self, topic_id, lesson_id):
+        # 404 if lesson html cannot be found, before reading anything else
+        template_name = self.get_lesson_template(lesson_id)
+        if template_name is None:
+            return self.http_not_found()
 
-                    '/lessons/{}.html'.format(lesson.short_uid),
-                    theme=theme,
-                    teacher_theme=teacher_theme,
-                    topic=topic,
-                    lesson=lesson,
-                    lessons=lessons,
-                    lesson_index=lesson_index,
-                    next_lesson=next_lesson,
-                    next_lesson_url=next_lesson_url,
-                    next_url=next_url,
-                    next_topic=next_topic,
-                    color=topic.color,
-                    related_topics=related_topics,
-                    related_practices=related_practices,
-                    locale=locale,
-                    translation=locales.translations[locale]["lessons"],
-                )
-            else:
-                # 404 if lesson html cannot be found
-                return self.http_not_found()
+        template_values = self.load_async(
+            Topic.get_long_uid(topic_id),
+            Lesson.get_long_uid(lesson_id),
+        ).get_result()
 
-        else:
+        if template_values is None:
             # 404 if lesson cannot be found
             return self.http_not_found()
 
+        if self.not_modified(*[template_values[k] for k in (
+                'theme', 'topic', 'lesson', 'outline')]):
+            return
+        self.write(template_name, **template_values)
+
 
 class OldLessonHandler(ViewHandler):
     """Redirects old lesson routes in 'math' and 'teachers' theme"""
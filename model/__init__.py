@@ -10,8 +10,9 @@ from .content import Content
 from .email import Email
 from .errorchecker import ErrorChecker
 from .feedback import Feedback
-from .indexer import Indexer
+from .indexer import Indexer, ContentIndex
 from .lesson import Lesson
+from .outline import ThemeOutline, TopicSummary, LessonSummary
 from .model import Model
 from .practice import Practice
 from .theme import Theme
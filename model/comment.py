@@ -149,6 +149,17 @@ class Comment(Model):
 
         return comment
 
+    def _post_put_hook(self, future):
+        """Extends Model._post_put_hook() to track the user's interactions."""
+        super(Comment, self)._post_put_hook(future)
+        User.record_content_interaction(self)
+
+    @classmethod
+    def _post_delete_hook(klass, key, future):
+        """Extends Model._post_delete_hook(); see _post_put_hook()."""
+        super(Comment, klass)._post_delete_hook(key, future)
+        User.clear_content_interactions(key.parent().id())
+
     @classmethod
     def convert_uid(klass, short_or_long_uid):
         """Changes long-form uid's to short ones, and vice versa.
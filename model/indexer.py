@@ -5,12 +5,17 @@ Indexer Model
 Model for searchable content indexer
 """
 
+from google.appengine.api import memcache
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 import datetime
 import logging
+import time
 
 import config
+import content_cache
+import search_queue
 import util
 
 from .lesson import Lesson
@@ -18,6 +23,52 @@ from .model import Model
 from .practice import Practice
 
 
+# Memcache key of the modified time at which an entity was last indexed, by
+# uid. See Indexer.skip_indexed().
+INDEXED_KEY_PREFIX = 'search-indexed:'
+
+
+class IndexWatermark(ndb.Model):
+    """The last entity of a kind indexed by Indexer.index_changed().
+
+    Entities are indexed in order of (modified, key), so both are needed to
+    resume exactly, even when many entities share a modified time.
+    """
+    kind = ndb.StringProperty()
+    modified = ndb.DateTimeProperty()
+    last_key = ndb.KeyProperty()
+
+
+class ContentIndex(ndb.Model):
+    """Which search index holds content, and any index being rebuilt.
+
+    Kept apart from Indexer, which is saved constantly by cron jobs, so that
+    switching indexes can't be overwritten by them. See
+    Indexer.start_rebuild().
+    """
+    # The index searched for content. If not set, config.content_index.
+    name = ndb.StringProperty()
+    # The index being built by Indexer.start_rebuild(), if any.
+    rebuild_name = ndb.StringProperty()
+    # Ids of rebuild shards which haven't finished.
+    pending_shards = ndb.StringProperty(repeated=True)
+
+    @classmethod
+    def get(cls):
+        return cls.get_or_insert('content')
+
+    @property
+    def active_name(self):
+        return self.name or config.content_index
+
+    def get_names(self):
+        """Names of all indexes which should be kept up to date."""
+        names = [self.active_name]
+        if self.rebuild_name:
+            names.append(self.rebuild_name)
+        return names
+
+
 class Indexer(ndb.Model):
     """Update content search index with recently modified entities.
 
@@ -26,55 +77,455 @@ class Indexer(ndb.Model):
     """
 
     # Data
+    # Deprecated; only used to start watermarks for kinds which don't have
+    # them yet.
     last_check = ndb.DateTimeProperty()
-    # Limit the number of items we are willing to index
-    max_entities_to_index = 10
+    watermarks = ndb.LocalStructuredProperty(IndexWatermark, repeated=True)
+
+    # Push queue for rebuild tasks. See start_rebuild().
+    rebuild_queue = 'index-all'
+    rebuild_url = '/cron/index_all/shard'
+    # Tasks, on the same queue, which empty indexes no longer used. See
+    # cleanup_index().
+    cleanup_url = '/cron/index_all/cleanup'
 
     def get_index(self):
-        return search.Index(name=config.content_index)
+        return search.Index(name=ContentIndex.get().active_name)
+
+    def get_indexes(self):
+        """Every index being kept up to date, including one being rebuilt."""
+        return [search.Index(name=name)
+                for name in ContentIndex.get().get_names()]
+
+    def update_index(self, entities):
+        """Put listed entities in the index and remove the rest.
+
+        Documents are written in as few calls as the search service allows.
+
+        Args:
+            entities: List of indexable entities.
+        Returns:
+            The number of documents put in the index.
+        """
+        documents = [e.to_search_document() for e in entities
+                     if e.listed and not e.deleted]
+        removed_ids = [e.uid for e in entities
+                       if not e.listed or e.deleted]
+        self.delete_documents(removed_ids)
+        for index in self.get_indexes():
+            self.put_documents(index, documents)
+        return len(documents)
+
+    def put_documents(self, index, documents):
+        """Put documents in an index in as few calls as possible."""
+        batch_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+        for i in range(0, len(documents), batch_size):
+            index.put(documents[i:i + batch_size])
+        if documents:
+            self.bump_search_generation()
+
+    def delete_documents(self, document_ids):
+        """Delete documents from the indexes in as few calls as possible."""
+        batch_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+        for index in self.get_indexes():
+            for i in range(0, len(document_ids), batch_size):
+                index.delete(document_ids[i:i + batch_size])
+        if document_ids:
+            self.bump_search_generation()
+
+    def skip_indexed(self, entities):
+        """Leave out entities already indexed as they are now.
+
+        Content is indexed both from the queue (see index_queued()) and by
+        scanning for changes (see index_changed()). Whichever gets to an
+        entity first records the modified time it indexed, so the other can
+        skip it. Memcache may forget, which only means indexing twice.
+
+        Args:
+            entities: List of indexable entities.
+        Returns:
+            List of those not indexed since they were last modified.
+        """
+        indexed = memcache.get_multi([e.uid for e in entities],
+                                     key_prefix=INDEXED_KEY_PREFIX)
+        return [e for e in entities if indexed.get(e.uid) != e.modified]
+
+    def mark_indexed(self, entities):
+        """Record the versions of entities just indexed. See skip_indexed()."""
+        memcache.set_multi({e.uid: e.modified for e in entities},
+                           key_prefix=INDEXED_KEY_PREFIX,
+                           time=config.indexed_marker_seconds)
+
+    def bump_search_generation(self):
+        """Drop cached search results. See content_cache.py."""
+        content_cache.bump_generation(content_cache.SEARCH_GENERATION_KEY)
+
+    def index_queued(self, time_limit=30):
+        """Index content waiting in the search queue.
+
+        See search_queue.py. Leases queued uids until the queue is empty or
+        the time limit has passed.
+
+        Args:
+            time_limit: int, seconds after which no more uids are leased.
+        Returns:
+            The number of distinct uids indexed, or removed from the index.
+        """
+        start = time.time()
+        num_indexed = 0
+        while time.time() - start < time_limit:
+            tasks, uids = search_queue.lease()
+            if not tasks:
+                break
+            entities = ndb.get_multi([Model.id_to_key(uid) for uid in uids])
+            # Hard-deleted entities don't exist to be updated.
+            missing_uids = [uid for uid, e in zip(uids, entities) if e is None]
+            self.delete_documents(missing_uids)
+            changed = self.skip_indexed([e for e in entities if e is not None])
+            self.update_index(changed)
+            self.mark_indexed(changed)
+            search_queue.delete(tasks)
+            num_indexed += len(missing_uids) + len(changed)
+        return num_indexed
 
     def get_all_content_classes(self):
         Klasses = [Model.get_class(k) for k in ndb.metadata.get_kinds()]
         # Exclude kinds not defined in our code (show up as None in the list)
         # and anything that isn't set to be indexed (see config).
-        return filter(lambda k: k and k in config.indexed_models, Klasses)
+        return filter(lambda k: k and k.__name__ in config.indexed_models,
+                      Klasses)
+
+    def get_split_keys(self, klass, num_shards):
+        """Keys which split a kind into roughly equal ranges.
+
+        Uses the datastore's __scatter__ property, which is set on a random
+        sample of entities, the same way map reduce input readers do.
+
+        Returns:
+            Sorted list of up to num_shards - 1 keys.
+        """
+        oversampling = 32
+        keys = (klass.query()
+                     .order(ndb.GenericProperty('__scatter__'))
+                     .fetch(num_shards * oversampling, keys_only=True))
+        keys.sort(key=lambda k: k.pairs())
+        if len(keys) < num_shards:
+            return keys
+        stride = len(keys) / float(num_shards)
+        return [keys[int(stride * i)] for i in range(1, num_shards)]
+
+    def start_rebuild(self, num_shards=None):
+        """Start building a new content index from scratch.
+
+        Each indexed kind is split into key ranges, and each range is indexed
+        by its own task on the rebuild queue (see rebuild_shard()), so the
+        work is done in parallel without holding all the content in memory.
+        Changes made meanwhile are written to both indexes (see
+        get_indexes()). When the last shard finishes, searches switch to the
+        new index.
+
+        Starting a rebuild abandons any rebuild already running, and queues
+        its index to be deleted. See cleanup_index().
 
-    def get_all_content_entities(self):
-        Klasses = self.get_all_content_classes()
+        Args:
+            num_shards: int, optional, how many ranges to split each kind
+                into. Defaults to config.index_rebuild_shards.
+        Returns:
+            Dictionary with the name of the new index and the number of
+            shards started.
+        """
+        if num_shards is None:
+            num_shards = config.index_rebuild_shards
+        index_name = 'content_{}'.format(
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+
+        tasks = []
+        for klass in self.get_all_content_classes():
+            kind = klass.__name__
+            bounds = [None] + self.get_split_keys(klass, num_shards) + [None]
+            for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+                tasks.append(taskqueue.Task(url=self.rebuild_url, params={
+                    'index_name': index_name,
+                    'shard_id': '{}-{}'.format(kind, i),
+                    'kind': kind,
+                    'start': start.urlsafe() if start else '',
+                    'end': end.urlsafe() if end else '',
+                }))
+
+        self._start_rebuild(index_name,
+                            [t.extract_params()['shard_id'] for t in tasks])
+
+        if tasks:
+            queue = taskqueue.Queue(self.rebuild_queue)
+            for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+                queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        else:
+            self.switch_index(index_name)
+
+        logging.info("Rebuilding search index {} with {} shards."
+                     .format(index_name, len(tasks)))
+        return {'index_name': index_name, 'num_shards': len(tasks)}
+
+    @ndb.transactional
+    def _start_rebuild(self, index_name, shard_ids):
+        """Record a new rebuild, queueing any abandoned one for cleanup."""
+        content_index = ContentIndex.get()
+        if content_index.rebuild_name:
+            logging.info("Abandoning rebuild of {}."
+                         .format(content_index.rebuild_name))
+            self.queue_cleanup(content_index.rebuild_name)
+        content_index.rebuild_name = index_name
+        content_index.pending_shards = shard_ids
+        content_index.put()
+
+    def rebuild_shard(self, index_name, shard_id, kind, start='', end='',
+                      cursor='', time_limit=300):
+        """Index one key range of one kind into a rebuilding index.
+
+        Streams entities with a query cursor, one page of documents per call
+        to the search service. If the time limit passes, queues a task to
+        continue from the cursor, so no task runs too long to finish.
+
+        Args:
+            index_name: str, the index being built.
+            shard_id: str, identifies this shard to ContentIndex.
+            kind: str, the kind of content to index.
+            start: str, optional, urlsafe key at which the range begins.
+            end: str, optional, urlsafe key before which the range ends.
+            cursor: str, optional, urlsafe cursor to resume from.
+            time_limit: int, seconds after which to continue in a new task.
+        Returns:
+            The number of documents put in the index.
+        """
+        if ContentIndex.get().rebuild_name != index_name:
+            logging.info("Rebuild of {} was abandoned.".format(index_name))
+            return 0
 
-        entities = [
-            e for klass in Klasses
-            for e in (klass.query(getattr(klass, 'listed') == True)
-                      .order(getattr(klass, 'modified')))
-        ]
+        klass = Model.get_class(kind)
+        query = klass.query()
+        if start:
+            query = query.filter(klass.key >= ndb.Key(urlsafe=start))
+        if end:
+            query = query.filter(klass.key < ndb.Key(urlsafe=end))
+        query = query.order(klass.key)
 
-        return entities
+        index = search.Index(name=index_name)
+        page_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+        start_time = time.time()
+        num_indexed = 0
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        more = True
+        while more:
+            if time.time() - start_time > time_limit:
+                taskqueue.Queue(self.rebuild_queue).add(taskqueue.Task(
+                    url=self.rebuild_url, params={
+                        'index_name': index_name,
+                        'shard_id': shard_id,
+                        'kind': kind,
+                        'start': start,
+                        'end': end,
+                        'cursor': cursor.urlsafe(),
+                    }))
+                return num_indexed
+            entities, cursor, more = query.fetch_page(
+                page_size, start_cursor=cursor)
+            documents = [e.to_search_document() for e in entities
+                         if e.listed and not e.deleted]
+            self.put_documents(index, documents)
+            num_indexed += len(documents)
 
-    def get_changed_content_entities(self):
-        Klasses = self.get_all_content_classes()
+        self.finish_shard(index_name, shard_id)
+        # Not only if this finished the last shard: a retry of the task that
+        # did may be the first to get this far.
+        self.switch_index(index_name)
+        return num_indexed
+
+    @ndb.transactional
+    def finish_shard(self, index_name, shard_id):
+        """Mark a rebuild shard as done.
+
+        Returns:
+            True if this was the last shard of the rebuild.
+        """
+        content_index = ContentIndex.get()
+        if (content_index.rebuild_name != index_name or
+                shard_id not in content_index.pending_shards):
+            # Abandoned, or a retried task finishing again.
+            return False
+        content_index.pending_shards.remove(shard_id)
+        content_index.put()
+        return not content_index.pending_shards
+
+    def switch_index(self, index_name):
+        """Make a rebuilt index the one searched, once all its shards are
+        done, and queue the old one for cleanup. Safe to call repeatedly."""
+        old_name = self._switch_index(index_name)
+        if old_name:
+            self.bump_search_generation()
+            logging.info("Switched search index from {} to {}."
+                         .format(old_name, index_name))
+
+    @ndb.transactional
+    def _switch_index(self, index_name):
+        """Returns the name of the index switched from, if switched."""
+        content_index = ContentIndex.get()
+        if (content_index.rebuild_name != index_name or
+                content_index.pending_shards):
+            return None
+        old_name = content_index.active_name
+        content_index.name = index_name
+        content_index.rebuild_name = None
+        content_index.put()
+        self.queue_cleanup(old_name)
+        return old_name
+
+    def queue_cleanup(self, index_name):
+        """Queue a task to delete an index, with the current transaction if
+        there is one, so it's queued exactly when the index stops being
+        used. See cleanup_index()."""
+        taskqueue.add(url=self.cleanup_url, queue_name=self.rebuild_queue,
+                      params={'index_name': index_name},
+                      transactional=ndb.in_transaction())
+
+    def cleanup_index(self, index_name, time_limit=300):
+        """Delete an index that's no longer searched or being rebuilt.
+
+        Idempotent, so the task can be retried: an index that's already gone
+        has nothing left to delete. If the time limit passes, queues a task
+        to carry on. Indexes still in use are left alone.
+
+        Args:
+            index_name: str, the index to delete.
+            time_limit: int, seconds after which to continue in a new task.
+        Returns:
+            The number of documents deleted.
+        """
+        if index_name in ContentIndex.get().get_names():
+            logging.warning("Not deleting search index {}; it's in use."
+                            .format(index_name))
+            return 0
 
+        index = search.Index(name=index_name)
+        start_time = time.time()
+        num_deleted = 0
+        while True:
+            if time.time() - start_time > time_limit:
+                self.queue_cleanup(index_name)
+                return num_deleted
+            document_ids = [document.doc_id
+                            for document in index.get_range(ids_only=True)]
+            if not document_ids:
+                break
+            index.delete(document_ids)
+            num_deleted += len(document_ids)
+
+        # An index without documents or a schema no longer exists.
+        index.delete_schema()
+        logging.info("Deleted search index {} ({} documents)."
+                     .format(index_name, num_deleted))
+        return num_deleted
+
+    def get_watermark(self, kind):
+        """The watermark of a kind, created if necessary."""
+        for watermark in self.watermarks:
+            if watermark.kind == kind:
+                return watermark
         # If the last check timestamp isn't set, set it to the earliest
         # possible time, forcing it to start over and index all content
         # regardless of its age.
-        if not self.last_check:
-            self.last_check = datetime.datetime(1, 1, 1)
+        watermark = IndexWatermark(
+            kind=kind,
+            modified=self.last_check or datetime.datetime(1, 1, 1),
+        )
+        self.watermarks.append(watermark)
+        return watermark
 
-        entities = [
-            e for klass in Klasses
-            for e in (klass.query(getattr(klass, 'modified') > self.last_check)
-                      .order(getattr(klass, 'modified'))
-                      .filter(getattr(klass, 'listed') == True)
-                      .fetch(self.max_entities_to_index))
-        ]
+    def get_changed_queries(self, klass, watermark):
+        """Queries for entities changed after a watermark, in index order.
 
-        return entities
+        The datastore can't filter on (modified, key) > (m, k) directly, so
+        this is split into entities modified at m with keys greater than k,
+        and then entities modified after m.
+        """
+        queries = []
+        if watermark.last_key:
+            queries.append(klass.query(klass.modified == watermark.modified,
+                                       klass.key > watermark.last_key)
+                                .order(klass.key))
+        queries.append(klass.query(klass.modified > watermark.modified)
+                            .order(klass.modified, klass.key))
+        return queries
+
+    def index_changed(self, time_limit=30):
+        """Index content modified since the last run.
+
+        Walks each indexed kind in (modified, key) order with query cursors,
+        one page of documents per call to the search service, until all
+        changes are indexed or the time limit has passed. The watermark of
+        each kind is saved after every page, so a run that runs out of time
+        (or dies) resumes where it left off.
 
-    def delete_all_content(self):
-        """Deletes all the documents in the content index.
+        Most content is indexed sooner, when it's saved (see search_queue.py);
+        this catches anything written without the put hook. Entities the
+        queue already indexed are skipped. See skip_indexed().
+
+        Args:
+            time_limit: int, seconds after which no more pages are fetched.
+        Returns:
+            Dictionary of stats: number of documents indexed and removed,
+            seconds taken, documents per second, and whether every change was
+            indexed.
+        """
+        start = time.time()
+        page_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+        num_indexed = 0
+        num_removed = 0
+        complete = True
+
+        for klass in self.get_all_content_classes():
+            kind = klass.__name__
+            watermark = self.get_watermark(kind)
+            for query in self.get_changed_queries(klass, watermark):
+                cursor = None
+                more = True
+                while more:
+                    if time.time() - start > time_limit:
+                        complete = False
+                        break
+                    entities, cursor, more = query.fetch_page(
+                        page_size, start_cursor=cursor)
+                    if not entities:
+                        break
+                    changed = self.skip_indexed(entities)
+                    num_added = self.update_index(changed)
+                    self.mark_indexed(changed)
+                    num_indexed += num_added
+                    num_removed += len(changed) - num_added
+                    watermark.modified = entities[-1].modified
+                    watermark.last_key = entities[-1].key
+                    self.put()
+
+        seconds = time.time() - start
+        stats = {
+            'num_indexed': num_indexed,
+            'num_removed': num_removed,
+            'seconds': round(seconds, 3),
+            'docs_per_second': round(
+                (num_indexed + num_removed) / seconds, 1) if seconds else None,
+            'complete': complete,
+        }
+        logging.info("Indexer.index_changed(): {}".format(stats))
+        return stats
+
+    def delete_all_content(self, index_name=None):
+        """Deletes all the documents in the content index, or the named one.
 
         https://cloud.google.com/appengine/docs/python/search/#Python_Deleting_documents_from_an_index
         """
-        index = self.get_index()
+        if index_name:
+            index = search.Index(name=index_name)
+        else:
+            index = self.get_index()
 
         # Looping because get_range by default returns up to 100 documents at a
         # time.
@@ -90,4 +541,7 @@ class Indexer(ndb.Model):
             index.delete(document_ids)
             num_deleted += len(document_ids)
 
+        if num_deleted:
+            self.bump_search_generation()
+
         return num_deleted
\ No newline at end of file
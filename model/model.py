@@ -16,12 +16,36 @@ import random
 import re
 import string
 import sys
+import threading
 
 import config
+import content_cache
+import search_queue
 import util
 import searchable_properties as sndb
 
 
+class IdentityMap(threading.local):
+    """Entities already fetched by id during the current request.
+
+    Instances are thread-local because the app is threadsafe; each thread
+    serves one request at a time. The map is only active between calls to
+    Model.begin_identity_map() and Model.end_identity_map(), which
+    BaseHandler.dispatch() makes around every request. Everywhere else (e.g.
+    unit tests), Model.get_by_id() always reads from the datastore.
+    """
+    # Maps uid strings to entities, or to None if the entity doesn't exist.
+    entities = None
+
+
+identity_map = IdentityMap()
+
+
+def bump_outline_generation():
+    """Mark all theme outlines stale. See outline.ThemeOutline.get_async()."""
+    content_cache.bump_generation(content_cache.OUTLINE_GENERATION_KEY)
+
+
 class Model(ndb.Model):
     """Superclass for all others; contains generic properties and methods."""
 
@@ -219,13 +243,49 @@ class Model(ndb.Model):
         return ndb.Key(pairs=reversed(pairs))
 
     @classmethod
-    def get_by_id(klass, id_or_list):
-        """The main way to get entities with known ids.
+    def begin_identity_map(klass):
+        """Start remembering entities fetched with get_by_id()."""
+        identity_map.entities = {}
 
-        Args:
-            id_or_list: A single perts id string, or a list of such strings,
-                of any kind or mixed kinds.
-        Returns an entity or list of entities, depending on input.
+    @classmethod
+    def end_identity_map(klass):
+        """Forget remembered entities and stop remembering new ones."""
+        identity_map.entities = None
+
+    @classmethod
+    @ndb.tasklet
+    def _fetch_by_ids_async(klass, ids):
+        """Get entities for a list of ids, in order, with None for misses.
+
+        When the identity map is active, ids are deduplicated, those already
+        known are served from memory, and the rest are fetched in a single
+        batch.
+        """
+        entities = identity_map.entities
+        if entities is None:
+            results = yield ndb.get_multi_async(
+                [Model.id_to_key(id) for id in ids])
+            raise ndb.Return(results)
+
+        missing_ids = []
+        seen = set()
+        for id in ids:
+            if id not in entities and id not in seen:
+                seen.add(id)
+                missing_ids.append(id)
+        if missing_ids:
+            fetched = yield ndb.get_multi_async(
+                [Model.id_to_key(id) for id in missing_ids])
+            entities.update(zip(missing_ids, fetched))
+        raise ndb.Return([entities[id] for id in ids])
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_id_async(klass, id_or_list):
+        """Asynchronous version of get_by_id(); returns a future.
+
+        Lets callers start fetching entities while other work, like
+        queries, is in flight.
         """
 
         # Sanitize input to a list of strings.
@@ -237,23 +297,31 @@ class Model(ndb.Model):
             # I don't think we should be blocking code here
             # Problem was occuring when you search a bad id or just None
             # Ex. "/topics/foobar."
-            return None
-            raise Exception("Invalid id / id: {}.".format(
-                id_or_list))
+            raise ndb.Return(None)
 
-        # Iterate through the list, generating a key for each id
-        keys = []
-        for id in ids:
-            keys.append(Model.id_to_key(id))
-        results = ndb.get_multi(keys)
+        results = yield klass._fetch_by_ids_async(ids)
 
         # Wrangle results into expected structure.
         if len(results) is 0:
-            return None
+            raise ndb.Return(None)
         if type(id_or_list) in [str, unicode]:
-            return results[0]
+            raise ndb.Return(results[0])
         if type(id_or_list) is list:
-            return results
+            raise ndb.Return(results)
+
+    @classmethod
+    def get_by_id(klass, id_or_list):
+        """The main way to get entities with known ids.
+
+        Within a request, entities are served from the identity map when
+        possible. See IdentityMap.
+
+        Args:
+            id_or_list: A single perts id string, or a list of such strings,
+                of any kind or mixed kinds.
+        Returns an entity or list of entities, depending on input.
+        """
+        return klass.get_by_id_async(id_or_list).get_result()
 
     def __str__(self):
         """A string represenation of the entity. Goal is to be readable.
@@ -310,7 +378,10 @@ class Model(ndb.Model):
     def _post_put_hook(self, future):
         """Executes after an entity is put.
 
-        1. Updates search index
+        1. Updates the request's identity map
+        2. Bumps the content and outline generations, if navigation content
+           changed, once any transaction commits
+        3. Queues the entity to be indexed for search (see search_queue.py)
 
         To allow for batch processing (i.e. doing the stuff this function does
         for many entities all at once, instead of doing it here one by one),
@@ -322,28 +393,52 @@ class Model(ndb.Model):
             for e in entities:
                 e.forbid_post_put_hook = True
             ndb.put_multi(entities)
+
+        The identity map and generations are always updated, even when the
+        hook is forbidden, because soft-deleting content (see Api.delete())
+        must not leave it in cached navigation or outlines.
         """
+        if identity_map.entities is not None:
+            if ndb.in_transaction():
+                # The transaction might not commit, so don't trust this copy.
+                identity_map.entities.pop(self.uid, None)
+            else:
+                identity_map.entities[self.uid] = self
+
+        if self.get_kind(self) in config.content_generation_models:
+            # Bumping before commit would let navigation be rebuilt from the
+            # old content and cached under the new generation. Outside a
+            # transaction, this bumps immediately.
+            ndb.get_context().call_on_commit(content_cache.bump_generation)
+
+        if self.get_kind(self) in config.outline_generation_models:
+            ndb.get_context().call_on_commit(bump_outline_generation)
+
         if getattr(self, 'forbid_post_put_hook', False):
             return
 
         if self.get_kind(self) in config.indexed_models:
-            index = search.Index(config.content_index)
-            if self.listed:
-                logging.info("Indexing content for search.")
-                index.put(self.to_search_document())
-            else:
-                # Unlisted entities should be actively removed from search.
-                logging.info("Removing unlisted content from search.")
-                index.delete(self.uid)
+            # Unlisted entities are actively removed from search when the
+            # queue is processed. See Indexer.index_queued().
+            search_queue.enqueue(self.uid)
 
     @classmethod
     def _post_delete_hook(klass, key, future):
         """We rarely truely delete entities, but when we do, we prefer Dos
         Equis. I mean, we want to delete them from the search index."""
+        if identity_map.entities is not None:
+            identity_map.entities.pop(key.id(), None)
+
+        if klass.get_kind(key) in config.content_generation_models:
+            ndb.get_context().call_on_commit(content_cache.bump_generation)
+
+        if klass.get_kind(key) in config.outline_generation_models:
+            ndb.get_context().call_on_commit(bump_outline_generation)
+
         if klass.get_kind(key) in config.indexed_models:
-            logging.info("Removing hard-deleted content from search: {}"
-                         .format(key.id()))
-            search.Index(config.content_index).delete(key.id())
+            logging.info("Queueing hard-deleted content for removal from "
+                         "search: {}".format(key.id()))
+            search_queue.enqueue(key.id())
 
     def to_client_dict(self, override=None):
         """Convert an app engine entity to a dictionary.
@@ -357,69 +452,132 @@ class Model(ndb.Model):
            which JSON.dumps() doesn't know how to handle. We'll convert them
            to ISO strings (e.g. "2010-04-20T20:08:21.634121")
 
+        Which properties get which treatment is worked out once per class,
+        so converting an entity is a single pass over its properties. See
+        _get_client_schema().
+
         Args:
             override: obj, if provided, method turns this object into
                 a dictionary, rather than self.
         """
-        output = self.to_dict()
+        if self._properties is type(self)._properties:
+            schema = self._get_client_schema()
+        else:
+            # Ndb gives an entity its own properties when it's loaded with
+            # values the class doesn't define.
+            schema = self._compile_client_schema(self._properties)
+
+        output = collections.OrderedDict()
+        for key, prop, is_date in schema:
+            if prop is None:
+                output[key] = self.json_properties
+                continue
+            # This is how ndb's to_dict() gets values, e.g. structured
+            # properties become dictionaries.
+            value = prop._get_for_dict(self)
+            if is_date and value is not None:
+                value = value.isoformat()
+            output[key] = value
+        return output
 
-        output['json_properties'] = self.json_properties
-        del output['json_properties_string']
+    @classmethod
+    def _get_client_schema(klass):
+        """How the properties of a class become client dictionary items.
 
-        for k, v in output.items():
-            if hasattr(v, 'isoformat'):
-                output[k] = v.isoformat()
+        Cached on the class itself, like _get_search_schema().
+        """
+        if '_client_schema' not in klass.__dict__:
+            klass._client_schema = klass._compile_client_schema(
+                klass._properties)
+        return klass._client_schema
 
-        client_safe_output = {}
-        for k, v in output.items():
-            if k in config.client_private_properties:
-                client_safe_output['_' + k] = v
-            elif k not in config.client_hidden_properties:
-                client_safe_output[k] = v
+    @staticmethod
+    def _compile_client_schema(properties):
+        """Work out how properties become client dictionary items.
 
+        Args:
+            properties: dict of ndb properties, as in Model._properties.
+        Returns:
+            List of tuples of (dictionary key, property, whether it's a date
+            to convert to a string), sorted by key. The property of the
+            json_properties item is None.
+        """
+        date_types = (ndb.DateTimeProperty, ndb.DateProperty,
+                      ndb.TimeProperty)
+        schema = [('json_properties', None, False)]
+        for prop in properties.values():
+            name = prop._code_name
+            if name == 'json_properties_string':
+                continue
+            if name in config.client_private_properties:
+                key = '_' + name
+            elif name not in config.client_hidden_properties:
+                key = name
+            else:
+                continue
+            is_date = isinstance(prop, date_types) and not prop._repeated
+            schema.append((key, prop, is_date))
         # order them so they're easier to read
-        ordered_dict = collections.OrderedDict(
-            sorted(client_safe_output.items(), key=lambda t: t[0]))
+        schema.sort(key=lambda f: f[0])
+        return schema
+
+    @classmethod
+    def _get_search_schema(klass):
+        """Which properties of a class become which search document fields.
 
-        return ordered_dict
+        Scanning the class definition is slow, and the answer never changes,
+        so it's done once per class and cached on the class itself.
+
+        Returns:
+            List of tuples of (property name, search field class, whether
+            booleans should be converted to strings).
+        """
+        # Check the class's own __dict__, because subclasses would otherwise
+        # find the schema of their superclass.
+        if '_search_schema' not in klass.__dict__:
+            schema = []
+            # Scan the properties in the class definition for information on
+            # how entities should be converted to search documents.
+            # Properties can have search field types defined; we use those to
+            # construct the document.
+            for prop_name in dir(klass):
+                # This is the abstract property object in the class
+                # definition. E.g. sndb.StringProperty()
+                prop = getattr(klass, prop_name)
+                # This is (maybe) the type of search field the property should
+                # be converted to.
+                search_type = getattr(prop, 'search_type', None)
+
+                # The dir() function iterates all object attributes; only deal
+                # with those which 1) are datastore properties, 2) aren't
+                # private, and 3) have a search type defined.
+                is_field = (isinstance(prop, ndb.model.Property) and
+                            not prop_name.startswith('_') and search_type)
+
+                if is_field:
+                    # It will probably be common to put a boolean in a search
+                    # document. The easiest way is to make it a string in an
+                    # atom field.
+                    bool_to_string = search_type is search.AtomField
+                    schema.append((prop_name, search_type, bool_to_string))
+            klass._search_schema = schema
+        return klass._search_schema
 
     def _get_search_fields(self):
         fields = []
-        klass = self.__class__
-
-        # Scan the properties in entity's class definition for information on
-        # how the entity should be converted to a search document. Properties
-        # can have search field types defined; we use those to construct the
-        # document.
-        for prop_name in dir(klass):
-            # This is the abstract property object in the class definition.
-            # E.g. sndb.StringProperty()
-            prop = getattr(klass, prop_name)
+        schema = self._get_search_schema()
+        for prop_name, search_type, bool_to_string in schema:
             # This is the actual data defined on the entity
             value = getattr(self, prop_name)
-            # This is (maybe) the type of search field the property should be
-            # converted to.
-            search_type = getattr(prop, 'search_type', None)
-
-            # The dir() function iterates all object attributes; only deal with
-            # those which 1) are datastore properties, 2) aren't private, and
-            # 3) have a search type defined.
-            is_field = (isinstance(prop, ndb.model.Property) and
-                        not prop_name.startswith('_') and search_type)
-
-            if is_field:
-                # Search documents field names aren't unique; storing a list of
-                # values means making many fields of the same name. For
-                # brevity, make everything as a (possibly single-element) list.
-                if not type(value) is list:
-                    value = [value]
-                for v in value:
-                    # It will probably be common to put a boolean in a search
-                    # document. The easiest way is to make it a string in an
-                    # atom field.
-                    if type(v) is bool and search_type is search.AtomField:
-                        v = 'true' if v else 'false'
-                    fields.append(search_type(name=prop_name, value=v))
+            # Search documents field names aren't unique; storing a list of
+            # values means making many fields of the same name. For brevity,
+            # make everything as a (possibly single-element) list.
+            if not type(value) is list:
+                value = [value]
+            for v in value:
+                if bool_to_string and type(v) is bool:
+                    v = 'true' if v else 'false'
+                fields.append(search_type(name=prop_name, value=v))
 
         return fields
 
@@ -0,0 +1,233 @@
+"""
+Outline Model
+===========
+
+Denormalized outline of a theme's topics and lessons
+"""
+
+from google.appengine.ext import ndb
+import logging
+
+from .model import Model
+import content_cache
+
+
+class LessonSummary(ndb.Model):
+    """What navigation and course pages need to know about a lesson."""
+    uid = ndb.StringProperty()
+    short_uid = ndb.StringProperty()
+    name = ndb.StringProperty()
+    summary = ndb.TextProperty(default='')
+    listed = ndb.BooleanProperty(default=False)
+    type = ndb.StringProperty(default='text')
+    youtube_id = ndb.StringProperty(default='')
+
+    @classmethod
+    def from_lesson(klass, lesson):
+        return klass(uid=lesson.uid, short_uid=lesson.short_uid,
+                     name=lesson.name, summary=lesson.summary,
+                     listed=lesson.listed, type=lesson.type,
+                     youtube_id=lesson.youtube_id)
+
+
+class TopicSummary(ndb.Model):
+    """What navigation and course pages need to know about a topic, and its
+    lessons in order."""
+    uid = ndb.StringProperty()
+    short_uid = ndb.StringProperty()
+    name = ndb.StringProperty()
+    summary = ndb.TextProperty(default='')
+    listed = ndb.BooleanProperty(default=False)
+    color = ndb.StringProperty()
+    lessons = ndb.LocalStructuredProperty(LessonSummary, repeated=True)
+
+    @classmethod
+    def from_topic(klass, topic, lessons):
+        """Args:
+            topic: Topic entity
+            lessons: dict of uids to Lesson entities, which may have more
+                lessons than the topic's, or be missing some (e.g. if they're
+                deleted).
+        """
+        return klass(
+            uid=topic.uid, short_uid=topic.short_uid, name=topic.name,
+            summary=topic.summary, listed=topic.listed, color=topic.color,
+            lessons=[LessonSummary.from_lesson(lessons[uid])
+                     for uid in topic.lessons if uid in lessons])
+
+
+class ThemeOutline(ndb.Model):
+    """The topics of a theme and the lessons of each, in order.
+
+    Lesson pages navigate to the next lesson or topic, and course pages list
+    every lesson of every topic, which otherwise means reading the theme, all
+    its topics, and all their lessons. Instead, that's all summarized here,
+    in one entity per theme, with the theme's uid as its id.
+
+    Outlines are rebuilt when content changes through the api (see
+    refresh_for()), or when they're found missing or out of date. Any write
+    of a theme, topic, or lesson, including ones outside the api, bumps the
+    outline generation (see Model._post_put_hook()), and outlines built
+    before the current generation are rebuilt when read.
+    """
+    # Increment when summaries gain properties, so old outlines are rebuilt
+    # rather than shown with blanks.
+    SCHEMA_VERSION = 2
+
+    schema_version = ndb.IntegerProperty(default=SCHEMA_VERSION)
+    # The outline generation when this was built. See get_async().
+    generation = ndb.IntegerProperty()
+    short_uid = ndb.StringProperty()
+    topics = ndb.LocalStructuredProperty(TopicSummary, repeated=True)
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+    @property
+    def uid(self):
+        return self.key.id()
+
+    @property
+    def lesson_count(self):
+        return sum(len(t.lessons) for t in self.topics)
+
+    @property
+    def first_lesson_link(self):
+        """Where a course's call to action goes: its first lesson, the course
+        page itself if its first topic has no lessons, or '' if it has no
+        topics."""
+        if not self.topics:
+            return ''
+        link = '/{}'.format(self.short_uid)
+        if self.topics[0].lessons:
+            link = '{}/{}/{}'.format(link, self.topics[0].short_uid,
+                                     self.topics[0].lessons[0].short_uid)
+        return link
+
+    @classmethod
+    @ndb.tasklet
+    def get_async(klass, theme_uid):
+        """Get a theme's outline, building it if there isn't a current one.
+
+        Returns None if the theme doesn't exist.
+        """
+        outline = yield klass.get_by_id_async(theme_uid)
+        generation = content_cache.get_generation(
+            content_cache.OUTLINE_GENERATION_KEY)
+        if (outline is None or
+                outline.schema_version != klass.SCHEMA_VERSION or
+                outline.generation != generation):
+            theme = yield Model.get_by_id_async(theme_uid)
+            if theme is None or theme.deleted:
+                raise ndb.Return(None)
+            outline = yield klass.build_async(theme)
+        raise ndb.Return(outline)
+
+    @classmethod
+    @ndb.tasklet
+    def build_async(klass, theme):
+        """Read a theme's topics and lessons and save an outline of them.
+
+        Lessons are matched to topics through a dictionary, so this takes
+        time in proportion to the number of lessons, however they're spread
+        among topics. Like Api.get_by_id(), deleted topics and lessons are
+        left out.
+
+        The generation is read first, so content written while this reads
+        bumps it past the outline's, and the outline is rebuilt again.
+        """
+        generation = content_cache.get_generation(
+            content_cache.OUTLINE_GENERATION_KEY)
+        # Model.get_by_id_async() gives None, rather than [], for no ids.
+        topics = yield Model.get_by_id_async(theme.topics or [])
+        topics = [t for t in topics or [] if t is not None and not t.deleted]
+        lesson_uids = [uid for t in topics for uid in t.lessons]
+        lessons = yield Model.get_by_id_async(lesson_uids)
+        lessons = {l.uid: l for l in lessons or []
+                   if l is not None and not l.deleted}
+
+        outline = klass(
+            id=theme.uid, short_uid=theme.short_uid, generation=generation,
+            topics=[TopicSummary.from_topic(t, lessons) for t in topics])
+        yield outline.put_async()
+        raise ndb.Return(outline)
+
+    @classmethod
+    def refresh_for(klass, entities):
+        """Rebuild the outlines of any themes these entities are part of.
+
+        Waits until the current transaction, if any, commits, since outlines
+        read more entity groups than a transaction can.
+
+        Args:
+            entities: list of themes, topics, and/or lessons.
+        """
+        def refresh():
+            theme_uids = set()
+            lesson_topic_uids = set()
+            for e in entities:
+                kind = Model.get_kind(e)
+                if kind == 'Theme':
+                    theme_uids.add(e.uid)
+                elif kind == 'Topic':
+                    theme_uids.update(e.themes)
+                elif kind == 'Lesson':
+                    lesson_topic_uids.update(e.topics)
+            topics = Model.get_by_id(list(lesson_topic_uids)) or []
+            for topic in topics:
+                if topic is not None:
+                    theme_uids.update(topic.themes)
+
+            themes = Model.get_by_id(list(theme_uids)) or []
+            futures = [klass.build_async(theme) for theme in themes
+                       if theme is not None and not theme.deleted]
+            ndb.Future.wait_all(futures)
+            logging.info(u"Refreshed outlines of {}".format(theme_uids))
+
+        ndb.get_context().call_on_commit(refresh)
+
+    def get_topic_index(self, topic_uid):
+        """Position of a topic in the theme, or None if it isn't in it."""
+        for i, topic in enumerate(self.topics):
+            if topic.uid == topic_uid:
+                return i
+        return None
+
+    def get_navigation(self, topic_uid, lesson_uid):
+        """Everything a lesson page needs to link to its neighbors.
+
+        Returns:
+            dict with:
+            * lessons: list of LessonSummary, all lessons in the topic
+            * lesson_index: int, position of the lesson in the topic
+            * next_lesson: LessonSummary, or None if it's the last lesson
+            * next_topic: TopicSummary, the next topic in the theme, or None
+            * other_topics: list of TopicSummary, the topics of the theme
+              besides this one
+        """
+        topic_index = self.get_topic_index(topic_uid)
+        if topic_index is None:
+            # A url may combine a topic with a theme it isn't part of.
+            return {'lessons': [], 'lesson_index': 0, 'next_lesson': None,
+                    'next_topic': None, 'other_topics': list(self.topics)}
+
+        lessons = self.topics[topic_index].lessons
+        lesson_index = 0
+        for i, lesson in enumerate(lessons):
+            if lesson.uid == lesson_uid:
+                lesson_index = i
+                break
+
+        next_lesson = None
+        if lesson_index < len(lessons) - 1:
+            next_lesson = lessons[lesson_index + 1]
+        next_topic = None
+        if topic_index < len(self.topics) - 1:
+            next_topic = self.topics[topic_index + 1]
+
+        return {
+            'lessons': lessons,
+            'lesson_index': lesson_index,
+            'next_lesson': next_lesson,
+            'next_topic': next_topic,
+            'other_topics': [t for i, t in enumerate(self.topics)
+                             if i != topic_index],
+        }
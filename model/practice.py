@@ -7,7 +7,9 @@ Subclass of Content Model
 Always in a group under a user
 """
 
+from google.appengine.api import memcache
 from google.appengine.api import search
+from google.appengine.ext import ndb
 import logging
 import os
 import config
@@ -20,6 +22,14 @@ from .content import Content
 from .model import Model
 
 
+# Memcache key of a pool of practices, by pool name. See get_pool_async().
+POOL_KEY_TEMPLATE = 'practice-pool:{}'
+# Pool of all listed practices, for practices without associated content.
+ALL_POOL = 'all'
+# Pool of promoted practices, for the landing page.
+PROMOTED_POOL = 'promoted'
+
+
 class Practice(Content):
     """Always in a group under a User."""
 
@@ -99,29 +109,23 @@ class Practice(Content):
 
         Will default to random pratices if none found.
         """
-        related_practices = []
-        query = Practice.query(
-            Practice.deleted == False,
-            Practice.listed == True,
-        )
-        if content.uid:
-            if Model.get_kind(content.uid) == 'Practice':
-                if content.associated_content:
-                    query = query.filter(Practice.associated_content == content.associated_content)
-                query = query.filter(Practice.uid != content.uid)
-            else:
-                query = query.filter(Practice.associated_content == content.uid)
-        query.order(-Practice.created)
-        # Pull a 'bucket' of practices to sample from
-        related_practices_bucket = query.fetch(15)
-        # Only return a random selection of the practices
-        if len(related_practices_bucket) > count:
-            related_practices = random.sample(related_practices_bucket, count)
-        elif len(related_practices_bucket) <= 0:
-            related_practices = []
+        return klass.get_related_practices_async(content, count).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_related_practices_async(klass, content, count):
+        """Asynchronous version of get_related_practices(); returns a future.
+
+        Samples from a cached pool of the content's most recent practices, so
+        only the sampled practices are read. See get_pool_async().
+        """
+        if Model.get_kind(content) == 'Practice':
+            pool_name = content.associated_content or ALL_POOL
         else:
-            related_practices = related_practices_bucket
-        return related_practices
+            pool_name = content.uid
+        related_practices = yield klass.sample_pool_async(
+            pool_name, count, exclude=content.uid)
+        raise ndb.Return(related_practices)
 
     @classmethod
     def get_popular_practices(klass):
@@ -131,16 +135,144 @@ class Practice(Content):
         - Possibly adding a field to practices and flagging x practices / week
         - Needs more discussion
         """
-        practices = []
-        query = Practice.query(
-            Practice.deleted == False,
-            Practice.listed == True,
-            Practice.promoted == True,)
-        query.order(-Practice.created)
-        practices = query.fetch(20)
-        if len(practices) > 6:
-            practices = random.sample(practices, 6)
-        return practices
+        return klass.sample_pool_async(PROMOTED_POOL, 6).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def sample_pool_async(klass, pool_name, count, exclude=None):
+        """Read a random selection of practices from a pool.
+
+        Args:
+            pool_name: str, see get_pool_async().
+            count: int, most practices to return.
+            exclude: str, optional, uid of a practice to leave out.
+        """
+        pool = yield klass.get_pool_async(pool_name)
+        uids = [uid for created, uid in pool if uid != exclude]
+        if len(uids) > count:
+            uids = random.sample(uids, count)
+        practices = yield Model.get_by_id_async(uids)
+        # Pools can lag behind edits made elsewhere, e.g. by another
+        # instance, so check the practices still belong.
+        current = [p for p in practices or []
+                   if p is not None and p.in_pool(pool_name)]
+        if len(current) < len(uids):
+            # Have the pool rebuilt, so the next sample doesn't come up short.
+            yield ndb.get_context().memcache_delete(
+                POOL_KEY_TEMPLATE.format(pool_name))
+        raise ndb.Return(current)
+
+    @classmethod
+    @ndb.tasklet
+    def get_pool_async(klass, pool_name):
+        """The most recent practices in a pool, from memcache if possible.
+
+        Pools are kept up to date as practices are saved, rather than queried
+        on every page view. See update_pools(). Empty pools are queried
+        again, in case practices have been added since.
+
+        Args:
+            pool_name: str, the uid of a theme, topic, or lesson, for
+                practices associated with it, or ALL_POOL, or PROMOTED_POOL.
+        Returns:
+            list of (created, uid) tuples, newest first.
+        """
+        context = ndb.get_context()
+        cache_key = POOL_KEY_TEMPLATE.format(pool_name)
+        pool = yield context.memcache_get(cache_key)
+        if not pool:
+            query = klass.query(klass.deleted == False, klass.listed == True)
+            if pool_name == PROMOTED_POOL:
+                query = query.filter(klass.promoted == True)
+            elif pool_name != ALL_POOL:
+                query = query.filter(klass.associated_content == pool_name)
+            query = query.order(-klass.created)
+            practices = yield query.fetch_async(klass.pool_size(pool_name))
+            pool = [(p.created, p.uid) for p in practices]
+            yield context.memcache_set(
+                cache_key, pool, time=config.practice_pool_cache_seconds)
+        raise ndb.Return(pool)
+
+    @classmethod
+    def pool_size(klass, pool_name):
+        if pool_name == PROMOTED_POOL:
+            return config.promoted_practice_pool_size
+        return config.related_practice_pool_size
+
+    def in_pool(self, pool_name):
+        """Whether this practice should be sampled from a pool."""
+        if self.deleted or not self.listed:
+            return False
+        if pool_name == ALL_POOL:
+            return True
+        if pool_name == PROMOTED_POOL:
+            return self.promoted
+        return self.associated_content == pool_name
+
+    @classmethod
+    def update_pools(klass, practice):
+        """Add or remove a saved practice from the cached pools it affects.
+
+        Pools that aren't cached are left alone; they'll include the practice
+        when they're queried. A practice moved to other content is only
+        removed from its old pool as it's sampled. See sample_pool_async().
+        """
+        pool_names = [ALL_POOL, PROMOTED_POOL]
+        if practice.associated_content:
+            pool_names.append(practice.associated_content)
+        for pool_name in pool_names:
+            entry = None
+            if practice.in_pool(pool_name):
+                entry = (practice.created, practice.uid)
+            klass._update_pool(pool_name, practice.uid, entry)
+
+    @classmethod
+    def _update_pool(klass, pool_name, uid, entry=None):
+        """Replace a practice's entry in a cached pool.
+
+        Args:
+            pool_name: str, see get_pool_async().
+            uid: str, of the practice.
+            entry: tuple of (created, uid), or None to remove the practice.
+        """
+        client = memcache.Client()
+        cache_key = POOL_KEY_TEMPLATE.format(pool_name)
+        pool_size = klass.pool_size(pool_name)
+        for attempt in range(3):
+            pool = client.gets(cache_key)
+            if pool is None:
+                # Nothing cached; it will include this when it is.
+                return
+            new_pool = [(c, u) for c, u in pool if u != uid]
+            if entry is not None:
+                new_pool.append(entry)
+                new_pool.sort(reverse=True)
+                new_pool = new_pool[:pool_size]
+            if len(pool) >= pool_size and len(new_pool) < pool_size:
+                # A full pool lost a practice; only a query knows which is
+                # the next most recent.
+                break
+            if client.cas(cache_key, new_pool,
+                          time=config.practice_pool_cache_seconds):
+                return
+        # Too much contention to update it, or it needs refilling, so let it
+        # be rebuilt.
+        memcache.delete(cache_key)
+
+    def _post_put_hook(self, future):
+        """Extends Model._post_put_hook() to keep practice pools current,
+        including when practices are deleted."""
+        super(Practice, self)._post_put_hook(future)
+        Practice.update_pools(self)
+
+    @classmethod
+    def _post_delete_hook(klass, key, future):
+        """Extends Model._post_delete_hook() to remove hard-deleted practices
+        from pools. Which content a practice was associated with is gone with
+        it, so that pool is only corrected as it's sampled."""
+        super(Practice, klass)._post_delete_hook(key, future)
+        for pool_name in (ALL_POOL, PROMOTED_POOL):
+            klass._update_pool(pool_name, key.id())
 
     def add_file_data(self, file_dicts):
         """Save dictionaries of uploaded file meta data."""
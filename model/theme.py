@@ -23,15 +23,17 @@ class Theme(Content):
     locale = sndb.StringProperty(default='en')
 
     def associate_topics(self, topics):
-        """Takes a list of topic objects and adds them to the course
-        as an array of children 'course.topics_list' if they are a child
+        """Takes topic objects and adds them to the course as an array of
+        children 'course.topics_list' if they are a child
 
         Creates an empty array if none are children of this course
+
+        Args:
+            topics: list of topics, or a dictionary of topics by uid, as from
+                util.index_by(). When associating many courses, index the
+                topics once and pass the dictionary to each.
         """
-        self.topics_list = []
-        for topic_uid in self.topics:
-            for topic in topics:
-                # Breaks after match to prevent repeats
-                if topic.uid == topic_uid:
-                    self.topics_list.append(topic)
-                    break
+        if type(topics) is not dict:
+            topics = util.index_by(topics, 'uid')
+        self.topics_list = [topics[uid] for uid in self.topics
+                            if uid in topics]
@@ -5,6 +5,7 @@ User Model
 
 from google.appengine.ext import ndb
 from google.appengine.api import images
+from google.appengine.api import memcache
 from webapp2_extras.appengine.auth.models import Unique
 import datetime
 import json
@@ -21,6 +22,10 @@ import searchable_properties as sndb
 from .model import Model
 
 
+# Memcache key for the content a user has voted for and commented on.
+INTERACTIONS_KEY_TEMPLATE = 'content-interactions:{}'
+
+
 class DuplicateUser(Exception):
     """A user with the provided email already exists."""
     pass
@@ -242,6 +247,77 @@ class User(Model):
                                  .format(username))
         return unique
 
+    def get_content_interactions(self):
+        """Ids of content this user has voted for and commented on.
+
+        Cached in memcache and kept up to date as votes and comments are
+        saved. See record_content_interaction().
+
+        Returns:
+            Dictionary with keys 'Vote' and 'Comment', each a set of content
+            uids.
+        """
+        cache_key = INTERACTIONS_KEY_TEMPLATE.format(self.uid)
+        interactions = memcache.get(cache_key)
+        if interactions is None:
+            interactions = {}
+            for kind in ['Vote', 'Comment']:
+                klass = Model.get_class(kind)
+                entities = klass.query(klass.deleted == False,
+                                       ancestor=self.key).fetch()
+                interactions[kind] = set(
+                    id for e in entities for id in (e.practice_id, e.lesson_id)
+                    if id)
+            memcache.set(cache_key, interactions,
+                         time=config.content_interactions_cache_seconds)
+        return interactions
+
+    @classmethod
+    def record_content_interaction(klass, entity):
+        """Update cached interactions when a Vote or Comment is saved.
+
+        New interactions are added to the cache. Deleting one might not mean
+        the user no longer interacts with that content (e.g. they may have
+        commented twice), so the cache is dropped instead.
+
+        Waits until the current transaction, if any, commits, so a rolled
+        back save isn't cached as an interaction.
+        """
+        ndb.get_context().call_on_commit(
+            lambda: klass._record_content_interaction(entity))
+
+    @classmethod
+    def _record_content_interaction(klass, entity):
+        user_id = entity.key.parent().id()
+        if entity.deleted:
+            klass.clear_content_interactions(user_id)
+            return
+
+        kind = Model.get_kind(entity)
+        content_ids = [id for id in (entity.practice_id, entity.lesson_id)
+                       if id]
+        cache_key = INTERACTIONS_KEY_TEMPLATE.format(user_id)
+        client = memcache.Client()
+        for attempt in range(3):
+            interactions = client.gets(cache_key)
+            if interactions is None:
+                # Nothing cached; it will include this when it is.
+                return
+            interactions[kind].update(content_ids)
+            if client.cas(cache_key, interactions,
+                          time=config.content_interactions_cache_seconds):
+                return
+        # Too much contention to update it, so let it be rebuilt.
+        klass.clear_content_interactions(user_id)
+
+    @classmethod
+    def clear_content_interactions(klass, user_id):
+        """Drop a user's cached interactions, so they're rebuilt when next
+        needed. Like record_content_interaction(), waits for any current
+        transaction to commit, so they aren't rebuilt from before it."""
+        cache_key = INTERACTIONS_KEY_TEMPLATE.format(user_id)
+        ndb.get_context().call_on_commit(lambda: memcache.delete(cache_key))
+
     def remove_unique_properties(self):
         """Runs on delete to allow email and username to be reused."""
         uniqueness_key_email = 'User.email:' + self.email
@@ -17,6 +17,7 @@ import searchable_properties as sndb
 from .lesson import Lesson
 from .model import Model
 from .practice import Practice
+from .user import User
 
 
 class Vote(Model):
@@ -61,5 +62,16 @@ class Vote(Model):
 
         return vote
 
+    def _post_put_hook(self, future):
+        """Extends Model._post_put_hook() to track the user's interactions."""
+        super(Vote, self)._post_put_hook(future)
+        User.record_content_interaction(self)
+
+    @classmethod
+    def _post_delete_hook(klass, key, future):
+        """Extends Model._post_delete_hook(); see _post_put_hook()."""
+        super(Vote, klass)._post_delete_hook(key, future)
+        User.clear_content_interactions(key.parent().id())
+
     def parent_user_id(self):
         return self.key.parent().id()
\ No newline at end of file
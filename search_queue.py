@@ -0,0 +1,49 @@
+"""A pull queue of content waiting to be (re)indexed for search.
+
+Rather than making every write of searchable content wait on the search
+service, Model._post_put_hook() adds the entity's uid to this queue. A cron
+job then leases the queued uids and indexes them in batches; see
+Indexer.index_queued(). Queueing the same uid many times is harmless, because
+uids are deduplicated when leased.
+"""
+
+from google.appengine.api import taskqueue
+import logging
+
+
+QUEUE_NAME = 'search-index'
+
+
+def enqueue(uid):
+    """Queue an entity to be indexed, or removed from the index.
+
+    Failing to queue is logged rather than raised: the entity has already been
+    saved, and the incremental indexer (see Cron.index()) will catch up with
+    it anyway.
+    """
+    try:
+        taskqueue.Queue(QUEUE_NAME).add(
+            taskqueue.Task(payload=uid, method='PULL'))
+    except taskqueue.Error as e:
+        logging.error("Could not queue {} for indexing: {}".format(uid, e))
+
+
+def lease(max_tasks=1000, lease_seconds=60):
+    """Lease queued tasks.
+
+    Args:
+        max_tasks: int, the most tasks to lease, at most 1000.
+        lease_seconds: int, how long before the tasks are available to be
+            leased again, if they aren't deleted.
+    Returns:
+        Tuple of (leased tasks, list of unique uids in those tasks).
+    """
+    tasks = taskqueue.Queue(QUEUE_NAME).lease_tasks(lease_seconds, max_tasks)
+    uids = list(set(task.payload for task in tasks))
+    return (tasks, uids)
+
+
+def delete(tasks):
+    """Remove tasks from the queue once their uids have been indexed."""
+    if tasks:
+        taskqueue.Queue(QUEUE_NAME).delete_tasks(tasks)
@@ -0,0 +1,127 @@
+"""The jinja environment that renders pages.
+
+Creating an environment throws away jinja's cache of compiled templates, so
+there's one per template path per instance, created on first use. Compiled
+templates are also shared between instances through memcache, so a cold
+instance needn't recompile them either.
+
+Lessons each have their own template, named for the lesson's short uid. The
+lesson templates that exist are listed once per instance, so requests for
+lessons without templates can be turned away before reading the datastore.
+"""
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    # Templates are precompiled outside of App Engine.
+    memcache = None
+import jinja2
+import json
+import os
+
+
+TEMPLATE_PATH = 'templates'
+BYTECODE_KEY_PREFIX = 'jinja2-bytecode:'
+LESSON_TEMPLATE_DIR = 'lessons'
+
+# One environment per template path, e.g. 'templates'.
+_environments = {}
+
+# Lesson short uids to template names. See get_lesson_templates().
+_lesson_templates = None
+
+
+@jinja2.evalcontextfilter
+def jinja_json_filter(eval_context, value):
+    """Seralize value as JSON and mark as safe for jinja."""
+    return jinja2.Markup(json.dumps(value))
+
+
+def nl2br(value):
+    """Replace new lines with <br> for html view"""
+    return value.replace('\n', '<br>\n')
+
+
+def format_datetime(value):
+    # Formats datetime as Ex: "January 9, 2015"
+    return '{dt:%B} {dt.day}, {dt.year}'.format(dt=value)
+
+
+def format_ampescape(value):
+    return value.replace('&', '%26')
+
+
+def format_filetype(value):
+    if value.split('/')[0] in ['application']:
+        if value.split('/')[1] in ['pdf']:
+            formatted_type = 'pdf file'
+        elif value.split('/')[1].find('wordprocessing') > -1:
+            formatted_type = 'word document'
+        elif value.split('/')[1].find('presentation') > -1:
+            formatted_type = 'presentation'
+        else:
+            formatted_type = 'document'
+    elif value.split('/')[0] in ['image']:
+        formatted_type = 'image file'
+    else:
+        formatted_type = value.split('/')[0]
+    return formatted_type
+
+
+def create_environment(loader, bytecode_cache=None):
+    """A new jinja environment with our settings and filters."""
+    environment = jinja2.Environment(
+        autoescape=True,
+        extensions=['jinja2.ext.autoescape'],
+        loader=loader,
+        bytecode_cache=bytecode_cache,
+    )
+    environment.filters['to_json'] = jinja_json_filter
+    environment.filters['nl2br'] = nl2br
+    environment.filters['datetime'] = format_datetime
+    environment.filters['ampescape'] = format_ampescape
+    environment.filters['filetype'] = format_filetype
+    return environment
+
+
+def get_environment(template_path=TEMPLATE_PATH):
+    """The shared environment for a template path.
+
+    Args:
+        template_path: str, optional, directory of templates.
+    """
+    if template_path not in _environments:
+        loader = jinja2.FileSystemLoader(template_path)
+
+        # Bytecode is keyed by a checksum of the template source, so changed
+        # templates are never confused with old ones.
+        bytecode_cache = None
+        if memcache is not None:
+            bytecode_cache = jinja2.MemcachedBytecodeCache(
+                memcache, prefix=BYTECODE_KEY_PREFIX)
+
+        _environments[template_path] = create_environment(
+            loader, bytecode_cache)
+    return _environments[template_path]
+
+
+def get_lesson_templates():
+    """Which lessons have templates.
+
+    Templates are deployed with the code, so the list can't change while an
+    instance is running and is only read from disk once.
+
+    Returns:
+        dict of lesson short uids to template names, e.g.
+        {'mindset-intro': 'lessons/mindset-intro.html'}
+    """
+    global _lesson_templates
+    if _lesson_templates is None:
+        lesson_path = os.path.join(TEMPLATE_PATH, LESSON_TEMPLATE_DIR)
+        file_names = []
+        if os.path.isdir(lesson_path):
+            file_names = os.listdir(lesson_path)
+        _lesson_templates = {
+            name[:-len('.html')]: '{}/{}'.format(LESSON_TEMPLATE_DIR, name)
+            for name in file_names if name.endswith('.html')}
+    return _lesson_templates
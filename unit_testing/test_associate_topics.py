@@ -0,0 +1,83 @@
+"""Unit tests and a benchmark for Theme.associate_topics()."""
+
+import logging
+import timeit
+
+from model import Theme, Topic
+from unit_test_helper import PertsTestCase
+import content_cache
+import util
+
+
+def reference_associate_topics(theme, topics):
+    """How associate_topics() worked before it indexed topics, for
+    comparison."""
+    theme.topics_list = []
+    for topic_uid in theme.topics:
+        for topic in topics:
+            if topic.uid == topic_uid:
+                theme.topics_list.append(topic)
+                break
+
+
+class AssociateTopicsTest(PertsTestCase):
+    """Test attaching topics to courses for navigation."""
+
+    def make_courses(self, num_themes, topics_per_theme):
+        """Unsaved themes, each with its own topics, in reverse order so
+        lookups can't get lucky."""
+        themes = []
+        topics = []
+        for x in range(num_themes):
+            theme_topics = [
+                Topic(id='Topic_{:02d}{:02d}'.format(x, y),
+                      name=u'Topic {} {}'.format(x, y))
+                for y in range(topics_per_theme)]
+            themes.append(Theme(
+                id='Theme_{:02d}'.format(x), name=u'Theme {}'.format(x),
+                topics=[t.uid for t in theme_topics]))
+            topics.extend(theme_topics)
+        topics.reverse()
+        return themes, topics
+
+    def test_order_and_missing(self):
+        """Topics follow the theme's order, and missing ones are skipped."""
+        themes, topics = self.make_courses(1, 3)
+        theme = themes[0]
+        theme.topics.insert(1, 'Topic_missing')
+        theme.associate_topics(topics)
+        self.assertEqual([t.uid for t in theme.topics_list],
+                         ['Topic_0000', 'Topic_0001', 'Topic_0002'])
+
+        # A shared index gives the same result.
+        theme.associate_topics(util.index_by(topics, 'uid'))
+        self.assertEqual(len(theme.topics_list), 3)
+
+    def test_benchmark_50_themes_40_topics(self):
+        """Associating navigation for 50 courses of 40 topics each gives the
+        same topics as before.
+
+        Timings are logged for comparison, not asserted, since they depend on
+        the load of the machine running the tests.
+        """
+        themes, topics = self.make_courses(50, 40)
+
+        def indexed():
+            content_cache._associate_navigation(themes, topics)
+
+        def reference():
+            for theme in themes:
+                reference_associate_topics(theme, topics)
+
+        indexed_seconds = min(timeit.repeat(indexed, number=1, repeat=3))
+        reference_seconds = min(timeit.repeat(reference, number=1, repeat=3))
+        logging.info("50 themes x 40 topics associated: {:.3f}s indexed, "
+                     "{:.3f}s reference.".format(indexed_seconds,
+                                                 reference_seconds))
+
+        indexed()
+        indexed_uids = [[t.uid for t in theme.topics_list] for theme in themes]
+        reference()
+        reference_uids = [[t.uid for t in theme.topics_list]
+                          for theme in themes]
+        self.assertEqual(indexed_uids, reference_uids)
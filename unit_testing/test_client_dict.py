@@ -0,0 +1,94 @@
+"""Unit tests and a benchmark for Model.to_client_dict()."""
+
+from google.appengine.ext import ndb
+import collections
+import datetime
+import logging
+import os
+import timeit
+
+from model import Model, Practice
+from unit_test_helper import PertsTestCase
+import config
+
+
+def reference_client_dict(entity):
+    """How to_client_dict() worked before it was compiled, for comparison."""
+    output = entity.to_dict()
+
+    output['json_properties'] = entity.json_properties
+    del output['json_properties_string']
+
+    for k, v in output.items():
+        if hasattr(v, 'isoformat'):
+            output[k] = v.isoformat()
+
+    client_safe_output = {}
+    for k, v in output.items():
+        if k in config.client_private_properties:
+            client_safe_output['_' + k] = v
+        elif k not in config.client_hidden_properties:
+            client_safe_output[k] = v
+
+    return collections.OrderedDict(
+        sorted(client_safe_output.items(), key=lambda t: t[0]))
+
+
+class ClientDictTest(PertsTestCase):
+    """Test that compiled client dicts match ndb's to_dict()."""
+
+    def set_up(self):
+        self.testbed.init_datastore_v3_stub()
+        # Putting practices queues them for search indexing.
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))
+
+    def make_practices(self, num):
+        now = datetime.datetime.now()
+        user_key = ndb.Key('User', 'User_benchmark')
+        return [
+            Practice(
+                key=ndb.Key('Practice',
+                            'Practice_{:04d}.User_benchmark'.format(x),
+                            parent=user_key),
+                name=u'Practice {}'.format(x), tags=['one', 'two'],
+                json_properties_string='{"files": []}',
+                created=now, modified=now)
+            for x in range(num)]
+
+    def test_matches_reference(self):
+        """Same keys, values, and order as the original conversion."""
+        practice = self.make_practices(1)[0]
+        self.assertEqual(practice.to_client_dict().items(),
+                         reference_client_dict(practice).items())
+        self.assertIn('_modified', practice.to_client_dict())
+
+    def test_schema_per_class(self):
+        """Subclasses don't share their parent's schema."""
+        Practice._get_client_schema()
+        self.assertNotIn('_client_schema', Model.__dict__)
+        keys = [key for key, prop, is_date in Practice._get_client_schema()]
+        self.assertIn('votes_for', keys)
+
+    def test_benchmark_1000_practices(self):
+        """Serializing 1,000 practices gives the same dicts as before.
+
+        Timings are logged for comparison, not asserted, since they depend on
+        the load of the machine running the tests.
+        """
+        practices = self.make_practices(1000)
+
+        def compiled():
+            [p.to_client_dict() for p in practices]
+
+        def reference():
+            [reference_client_dict(p) for p in practices]
+
+        compiled_seconds = min(timeit.repeat(compiled, number=1, repeat=3))
+        reference_seconds = min(timeit.repeat(reference, number=1, repeat=3))
+        logging.info("1,000 practices to client dicts: {:.3f}s compiled, "
+                     "{:.3f}s reference.".format(compiled_seconds,
+                                                 reference_seconds))
+        self.assertEqual(
+            [p.to_client_dict().items() for p in practices],
+            [reference_client_dict(p).items() for p in practices])
@@ -0,0 +1,118 @@
+"""Unit tests for the versioned content cache."""
+
+from google.appengine.ext import ndb
+
+from unit_test_helper import ConsistentPopulatedTestCase
+import config
+import content_cache
+
+
+class ContentCacheTest(ConsistentPopulatedTestCase):
+    """Test caching of the navigation tree."""
+
+    def set_up(self):
+        super(ContentCacheTest, self).set_up()
+
+        # Instance memory outlives the testbed, so start fresh.
+        content_cache._local_navigation.clear()
+        content_cache._local_generation = None
+        self.page_cache_variants = config.page_cache_variants
+
+    def tearDown(self):
+        config.page_cache_variants = self.page_cache_variants
+        super(ContentCacheTest, self).tearDown()
+
+    def test_repeat_navigation_is_local_hit(self):
+        """The second request for navigation doesn't touch the datastore."""
+        misses = content_cache.stats['misses']
+        local_hits = content_cache.stats['local_hits']
+
+        courses, teacher_topics = content_cache.get_navigation(
+            self.public_api)
+        courses_again, _ = content_cache.get_navigation(self.public_api)
+
+        self.assertEqual(content_cache.stats['misses'], misses + 1)
+        self.assertEqual(content_cache.stats['local_hits'], local_hits + 1)
+        self.assertEqual(courses, courses_again)
+        self.assertEqual(len(courses[0].topics_list), 1)
+
+    def test_memcache_hit_reassociates_topics(self):
+        """Topics survive the trip through memcache."""
+        content_cache.get_navigation(self.public_api)
+        content_cache._local_navigation.clear()
+        memcache_hits = content_cache.stats['memcache_hits']
+
+        courses, _ = content_cache.get_navigation(self.public_api)
+
+        self.assertEqual(content_cache.stats['memcache_hits'],
+                         memcache_hits + 1)
+        self.assertEqual(len(courses[0].topics_list), 1)
+
+    def test_put_theme_bumps_generation(self):
+        """Changing a theme makes cached navigation stale."""
+        theme = self.populated_entities[1]
+        generation = content_cache.get_generation()
+        content_cache.get_navigation(self.public_api)
+
+        self.admin_api.update(theme.uid, name=u'Renamed Theme')
+
+        self.assertNotEqual(content_cache.get_generation(), generation)
+        courses, _ = content_cache.get_navigation(self.public_api)
+        self.assertEqual(courses[0].name, u'Renamed Theme')
+
+    def test_transaction_bumps_generation_on_commit(self):
+        """Navigation isn't made stale until a transaction's changes are
+        visible, or at all if it fails."""
+        theme = self.populated_entities[1]
+        generation = content_cache.get_generation()
+
+        def rename(name, fail):
+            theme.name = name
+            theme.put()
+            self.assertEqual(content_cache.get_generation(), generation)
+            if fail:
+                raise ndb.Rollback()
+
+        ndb.transaction(lambda: rename(u'Rolled Back', True))
+        self.assertEqual(content_cache.get_generation(), generation)
+        ndb.transaction(lambda: rename(u'Committed', False))
+        self.assertNotEqual(content_cache.get_generation(), generation)
+
+    def test_admin_navigation_cached_separately(self):
+        """Admins see unlisted courses, so they can't share public cache."""
+        self.admin_api.create('Theme', id='unlisted-theme', name=u'Unlisted',
+                              listed=False)
+
+        public_courses, _ = content_cache.get_navigation(self.public_api)
+        admin_courses, _ = content_cache.get_navigation(self.admin_api)
+
+        self.assertNotIn('Theme_unlisted-theme',
+                         [c.uid for c in public_courses])
+        self.assertIn('Theme_unlisted-theme', [c.uid for c in admin_courses])
+
+    def test_page_cache(self):
+        """Cached pages are found until the content generation changes."""
+        url = u'http://localhost/growth-mindset'
+        page = {'body': u'<html></html>', 'etag': 'abc', 'views': []}
+        # With one variant, every request for the url has the same key.
+        config.page_cache_variants = 1
+        key = content_cache.get_page_key(url)
+        self.assertIsNone(content_cache.get_page(key))
+        content_cache.set_page(key, page)
+        self.assertEqual(content_cache.get_page(key), page)
+        self.assertEqual(content_cache.get_page_key(url), key)
+
+        content_cache.bump_generation()
+        self.assertNotEqual(content_cache.get_page_key(url), key)
+
+        # Lessons are only in outlines, which have their own generation.
+        key = content_cache.get_page_key(url)
+        content_cache.bump_generation(content_cache.OUTLINE_GENERATION_KEY)
+        self.assertNotEqual(content_cache.get_page_key(url), key)
+
+    def test_page_cache_variants(self):
+        """Pages are cached in several variants, picked at random."""
+        config.page_cache_variants = 3
+        keys = set(content_cache.get_page_key(u'http://localhost/')
+                   for x in range(100))
+        self.assertEqual(len(keys), 3)
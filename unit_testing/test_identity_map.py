@@ -0,0 +1,46 @@
+"""Unit tests for the request-scoped identity map in Model.get_by_id()."""
+
+from model import Model, Theme
+from unit_test_helper import PopulatedTestCase
+
+
+class IdentityMapTest(PopulatedTestCase):
+    """Test deduplication and freshness of entities fetched by id."""
+
+    def set_up(self):
+        super(IdentityMapTest, self).set_up()
+        Model.begin_identity_map()
+
+    def tearDown(self):
+        Model.end_identity_map()
+        super(IdentityMapTest, self).tearDown()
+
+    def test_repeat_get_is_same_entity(self):
+        """Within a request, an id always gives the same instance."""
+        theme = self.populated_entities[1]
+        first = Model.get_by_id(theme.uid)
+        second = Model.get_by_id([theme.uid, theme.uid])
+        self.assertIs(first, second[0])
+        self.assertIs(first, second[1])
+
+    def test_put_refreshes_map(self):
+        """Entities written during a request are seen by later reads."""
+        theme = self.populated_entities[1]
+        fetched = theme.key.get()
+        fetched.name = u'Changed'
+        fetched.put()
+        self.assertEqual(Model.get_by_id(theme.uid).name, u'Changed')
+
+    def test_missing_then_created(self):
+        """Remembering that an entity doesn't exist doesn't outlive it."""
+        uid = 'Theme_not-yet-created'
+        self.assertIsNone(Model.get_by_id(uid))
+        self.admin_api.create('Theme', id='not-yet-created', name=u'New')
+        self.assertIsNotNone(Model.get_by_id(uid))
+
+    def test_inactive_outside_requests(self):
+        """Without an active map, every read goes to the datastore."""
+        Model.end_identity_map()
+        theme = self.populated_entities[1]
+        self.assertIsNot(Theme.get_by_id(theme.uid),
+                         Theme.get_by_id(theme.uid))
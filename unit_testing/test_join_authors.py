@@ -0,0 +1,36 @@
+"""Unit tests for attaching authors to api listings."""
+
+import webapp2
+
+from unit_test_helper import ConsistentPopulatedTestCase
+import api_handlers
+
+
+class JoinAuthorsTest(ConsistentPopulatedTestCase):
+    """Test ApiHandler.join_authors() for practices and comments."""
+
+    def get_handler(self, klass, url):
+        handler = klass(webapp2.Request.blank(url), webapp2.Response())
+        handler.api = self.normal_api
+        return handler
+
+    def test_practices_with_authors(self):
+        """Each practice comes with its author."""
+        handler = self.get_handler(api_handlers.Practices, '/api/practices')
+        practices = self.normal_api.get('Practice')
+        response = handler.join_authors(practices)
+        self.assertEqual(len(response), len(practices))
+        for practice_dict in response:
+            self.assertIn('user', practice_dict)
+
+    def test_no_practices(self):
+        """An empty listing of practices is an empty list, not an error."""
+        handler = self.get_handler(api_handlers.Practices, '/api/practices')
+        practices = self.normal_api.get('Practice', name=u'No such practice')
+        self.assertEqual(handler.join_authors(practices), [])
+
+    def test_no_comments(self):
+        """An empty listing of comments is an empty list, not an error."""
+        handler = self.get_handler(api_handlers.Comments, '/api/comments')
+        comments = self.normal_api.get('Comment', practice_id='Practice_none')
+        self.assertEqual(handler.join_authors(comments), [])
@@ -0,0 +1,150 @@
+"""Unit tests for theme outlines, which lesson pages navigate with."""
+
+from model import Theme, ThemeOutline
+from unit_test_helper import ConsistentPopulatedTestCase
+import mindsetkit
+
+
+class ThemeOutlineTest(ConsistentPopulatedTestCase):
+    """Test that outlines follow changes made through the api."""
+
+    def set_up(self):
+        super(ThemeOutlineTest, self).set_up()
+
+        self.theme = self.admin_api.create('Theme', name=u'Outlined')
+        self.topics = [
+            self.admin_api.create('Topic', parent=self.theme,
+                                  name=u'Topic {}'.format(x))
+            for x in range(2)]
+        self.lessons = [
+            self.admin_api.create('Lesson', parent=self.topics[x // 2],
+                                  name=u'Lesson {}'.format(x))
+            for x in range(4)]
+
+    def get_outline(self):
+        return ThemeOutline.get_by_id(self.theme.uid)
+
+    def test_outline_in_order(self):
+        """Creating content with parents outlines it."""
+        outline = self.get_outline()
+        self.assertEqual([t.uid for t in outline.topics],
+                         [t.uid for t in self.topics])
+        self.assertEqual([l.uid for l in outline.topics[0].lessons],
+                         [l.uid for l in self.lessons[:2]])
+
+    def test_navigation(self):
+        """Lessons lead to the next lesson, and the last to the next topic."""
+        outline = self.get_outline()
+
+        navigation = outline.get_navigation(self.topics[0].uid,
+                                            self.lessons[0].uid)
+        self.assertEqual(navigation['lesson_index'], 0)
+        self.assertEqual(navigation['next_lesson'].uid, self.lessons[1].uid)
+
+        navigation = outline.get_navigation(self.topics[0].uid,
+                                            self.lessons[1].uid)
+        self.assertIsNone(navigation['next_lesson'])
+        self.assertEqual(navigation['next_topic'].uid, self.topics[1].uid)
+        self.assertEqual([t.uid for t in navigation['other_topics']],
+                         [self.topics[1].uid])
+
+        navigation = outline.get_navigation(self.topics[1].uid,
+                                            self.lessons[3].uid)
+        self.assertIsNone(navigation['next_lesson'])
+        self.assertIsNone(navigation['next_topic'])
+
+    def test_reorder_refreshes(self):
+        """Moving a lesson changes the outline's order."""
+        self.admin_api.reorder(self.topics[0], self.lessons[1],
+                               move_up='true')
+        self.assertEqual(
+            [l.uid for l in self.get_outline().topics[0].lessons],
+            [self.lessons[1].uid, self.lessons[0].uid])
+
+    def test_disassociate_refreshes(self):
+        """Removing a topic from a theme removes it from the outline."""
+        self.admin_api.disassociate(self.theme, self.topics[0])
+        self.assertEqual([t.uid for t in self.get_outline().topics],
+                         [self.topics[1].uid])
+
+    def test_update_and_delete_refresh(self):
+        """Renamed lessons are renamed in the outline, deleted ones leave."""
+        self.admin_api.update(self.lessons[2].uid, name=u'Renamed')
+        self.admin_api.delete(self.lessons[3].uid)
+        lessons = self.get_outline().topics[1].lessons
+        self.assertEqual([l.name for l in lessons], [u'Renamed'])
+
+    def test_missing_outline_built(self):
+        """Outlines are built on demand if they don't exist yet."""
+        self.get_outline().key.delete()
+        outline = ThemeOutline.get_async(self.theme.uid).get_result()
+        self.assertEqual(len(outline.topics), 2)
+        self.assertIsNotNone(self.get_outline())
+
+        # Themes that don't exist have no outline.
+        missing_uid = Theme.get_long_uid('missing')
+        self.assertIsNone(ThemeOutline.get_async(missing_uid).get_result())
+
+    def test_course_page_summaries(self):
+        """Outlines have what course pages list."""
+        outline = self.get_outline()
+        self.assertEqual(outline.lesson_count, 4)
+        self.assertEqual(outline.first_lesson_link, '/{}/{}/{}'.format(
+            self.theme.short_uid, self.topics[0].short_uid,
+            self.lessons[0].short_uid))
+        lesson = outline.topics[0].lessons[0]
+        self.assertEqual(lesson.type, self.lessons[0].type)
+        self.assertEqual(lesson.listed, self.lessons[0].listed)
+
+    def test_write_outside_api_rebuilds(self):
+        """Content written without the api is outlined when next read."""
+        lesson = self.lessons[0]
+        lesson.name = u'Renamed directly'
+        lesson.forbid_post_put_hook = True
+        lesson.put()
+        outline = ThemeOutline.get_async(self.theme.uid).get_result()
+        self.assertEqual(outline.topics[0].lessons[0].name,
+                         u'Renamed directly')
+
+    def test_course_page_shows_lesson_change(self):
+        """Course pages, cached or not, list lessons as they're written,
+        even outside the api."""
+        self.testbed.setup_env(HOSTING_DOMAIN='localhost:8080',
+                               overwrite=True)
+        url = '/{}'.format(self.theme.short_uid)
+
+        response = mindsetkit.application.get_response(url)
+        self.assertEqual(response.status_int, 200)
+        self.assertIn(self.lessons[0].name, response.body.decode('utf-8'))
+
+        lesson = self.lessons[0]
+        lesson.name = u'Renamed directly'
+        lesson.put()
+
+        response = mindsetkit.application.get_response(url)
+        self.assertEqual(response.status_int, 200)
+        self.assertIn(u'Renamed directly', response.body.decode('utf-8'))
+
+    def test_empty_course_links(self):
+        """Courses without topics link nowhere; without lessons, to the
+        course page."""
+        theme = self.admin_api.create('Theme', name=u'Empty')
+        outline = ThemeOutline.get_async(theme.uid).get_result()
+        self.assertEqual(outline.lesson_count, 0)
+        self.assertEqual(outline.first_lesson_link, '')
+
+        topic = self.admin_api.create('Topic', parent=theme, name=u'Empty')
+        outline = ThemeOutline.get_by_id(theme.uid)
+        self.assertEqual([t.uid for t in outline.topics], [topic.uid])
+        self.assertEqual(outline.first_lesson_link,
+                         '/{}'.format(theme.short_uid))
+
+    def test_old_outline_rebuilt(self):
+        """Outlines from before summaries changed are rebuilt when read."""
+        outline = self.get_outline()
+        outline.schema_version = ThemeOutline.SCHEMA_VERSION - 1
+        outline.topics = []
+        outline.put()
+        outline = ThemeOutline.get_async(self.theme.uid).get_result()
+        self.assertEqual(outline.schema_version, ThemeOutline.SCHEMA_VERSION)
+        self.assertEqual(len(outline.topics), 2)
@@ -0,0 +1,121 @@
+"""Unit tests for the pools related practices are sampled from."""
+
+from google.appengine.api import memcache
+
+from model import Practice
+from model.practice import ALL_POOL, POOL_KEY_TEMPLATE, PROMOTED_POOL
+from unit_test_helper import ConsistentPopulatedTestCase
+import config
+
+
+class PracticePoolTest(ConsistentPopulatedTestCase):
+    """Test that pools are cached and kept current as practices are saved."""
+
+    def set_up(self):
+        super(PracticePoolTest, self).set_up()
+
+        self.theme = self.admin_api.create('Theme', name=u'Pooled')
+        self.practices = [
+            self.admin_api.create(
+                'Practice', name=u'Pooled {}'.format(x),
+                associated_content=self.theme.uid, pending=False,
+                listed=True)
+            for x in range(3)]
+
+    def get_cached_uids(self, pool_name):
+        pool = memcache.get(POOL_KEY_TEMPLATE.format(pool_name))
+        return None if pool is None else [uid for created, uid in pool]
+
+    def test_related_practices_sampled_from_pool(self):
+        """Related practices come from the content's cached pool."""
+        related = Practice.get_related_practices(self.theme, 2)
+        self.assertEqual(len(related), 2)
+        self.assertTrue(all(p.associated_content == self.theme.uid
+                            for p in related))
+        # Newest first.
+        self.assertEqual(self.get_cached_uids(self.theme.uid),
+                         [p.uid for p in reversed(self.practices)])
+
+    def test_practice_excludes_itself(self):
+        """A practice's related practices don't include it."""
+        related = Practice.get_related_practices(self.practices[0], 5)
+        self.assertEqual(len(related), 2)
+        self.assertNotIn(self.practices[0].uid, [p.uid for p in related])
+
+    def test_saving_updates_pool(self):
+        """New, unlisted, and deleted practices update cached pools."""
+        Practice.get_related_practices(self.theme, 1)
+
+        new_practice = self.admin_api.create(
+            'Practice', name=u'Pooled new', associated_content=self.theme.uid,
+            pending=False, listed=True)
+        self.assertEqual(self.get_cached_uids(self.theme.uid)[0],
+                         new_practice.uid)
+
+        self.admin_api.update(self.practices[0].uid, listed=False)
+        self.admin_api.delete(self.practices[1].uid)
+        self.assertEqual(self.get_cached_uids(self.theme.uid),
+                         [new_practice.uid, self.practices[2].uid])
+
+    def test_pool_size_limited(self):
+        """Pools hold only the most recent practices."""
+        pool_size = config.related_practice_pool_size
+        config.related_practice_pool_size = 2
+        try:
+            Practice.get_related_practices(self.theme, 1)
+            self.assertEqual(len(self.get_cached_uids(self.theme.uid)), 2)
+            self.admin_api.create(
+                'Practice', name=u'Pooled new',
+                associated_content=self.theme.uid, pending=False,
+                listed=True)
+            self.assertEqual(len(self.get_cached_uids(self.theme.uid)), 2)
+        finally:
+            config.related_practice_pool_size = pool_size
+
+    def test_popular_practices_promoted(self):
+        """Popular practices come from the promoted pool."""
+        self.admin_api.update(self.practices[0].uid, promoted=True)
+        popular = Practice.get_popular_practices()
+        self.assertIn(self.practices[0].uid, [p.uid for p in popular])
+        self.assertTrue(all(p.promoted for p in popular))
+        self.assertIn(self.practices[0].uid,
+                      self.get_cached_uids(PROMOTED_POOL))
+
+    def test_empty_pool_rebuilt(self):
+        """An empty cached pool is queried again on read."""
+        memcache.set(POOL_KEY_TEMPLATE.format(self.theme.uid), [])
+        related = Practice.get_related_practices(self.theme, 2)
+        self.assertEqual(len(related), 2)
+        self.assertEqual(len(self.get_cached_uids(self.theme.uid)), 3)
+
+    def test_stale_pool_rebuilt(self):
+        """Sampling a practice that no longer exists has the pool rebuilt."""
+        pool = Practice.get_pool_async(self.theme.uid).get_result()
+        # E.g. deleted on another instance without the pool hearing about it.
+        pool.append((pool[-1][0], Practice.get_long_uid('missing')))
+        memcache.set(POOL_KEY_TEMPLATE.format(self.theme.uid), pool)
+        related = Practice.get_related_practices(self.theme, 4)
+        self.assertEqual(len(related), 3)
+        self.assertIsNone(self.get_cached_uids(self.theme.uid))
+
+    def test_hard_delete_leaves_pools(self):
+        """Deleting a practice's entity removes it from cached pools."""
+        Practice.get_pool_async(ALL_POOL).get_result()
+        self.assertIn(self.practices[0].uid, self.get_cached_uids(ALL_POOL))
+        self.practices[0].key.delete()
+        # Either removed from the pool, or the pool is left to be rebuilt.
+        pool = Practice.get_pool_async(ALL_POOL).get_result()
+        self.assertNotIn(self.practices[0].uid, [uid for c, uid in pool])
+
+    def test_full_pool_refilled(self):
+        """A full pool that loses a practice is rebuilt to stay full."""
+        pool_size = config.related_practice_pool_size
+        config.related_practice_pool_size = 2
+        try:
+            Practice.get_related_practices(self.theme, 1)
+            self.admin_api.update(self.practices[2].uid, listed=False)
+            related = Practice.get_related_practices(self.theme, 2)
+            self.assertEqual([p.uid for p in related],
+                             [self.practices[1].uid, self.practices[0].uid])
+        finally:
+            config.related_practice_pool_size = pool_size
@@ -0,0 +1,75 @@
+"""Unit tests for how Api.get() runs queries with many IN filters."""
+
+from api import Api
+from unit_test_helper import ConsistentPopulatedTestCase
+import config
+
+
+class QueryPlanTest(ConsistentPopulatedTestCase):
+    """Test splitting and post-processing of oversized IN filters."""
+
+    def set_up(self):
+        super(QueryPlanTest, self).set_up()
+
+        self.subjects = ['s{}'.format(x) for x in range(4)]
+        self.tags = ['t{}'.format(x) for x in range(20)]
+        for x in range(30):
+            self.admin_api.create(
+                'Practice', name=u'Planned {}'.format(x),
+                subjects=[self.subjects[x % 4]], tags=[self.tags[x % 20]],
+                pending=False, listed=True)
+
+    def test_plan_splits_and_post_filters(self):
+        """Small filters go to the datastore, the next is split, and the rest
+        are handled in python."""
+        grades = range(14)
+        plan = Api.plan_query({'subjects': self.subjects, 'tags': self.tags,
+                               'min_grade': grades, 'listed': True})
+        self.assertEqual(plan.filters,
+                         {'subjects': self.subjects, 'listed': True})
+        self.assertEqual(plan.split_property, 'min_grade')
+        self.assertEqual(len(plan.split_values), 2)
+        self.assertEqual(plan.post_filters, {'tags': self.tags})
+
+    def test_plan_post_filters_when_too_many_splits(self):
+        """Filters that would need too many queries aren't split."""
+        tags = ['x{}'.format(x) for x in range(
+            config.max_parallel_queries * 30 + 1)]
+        plan = Api.plan_query({'tags': tags})
+        self.assertIsNone(plan.split_property)
+        self.assertEqual(plan.post_filters, {'tags': tags})
+
+    def test_post_filtered_page_is_full(self):
+        """Post-processing doesn't make pages short."""
+        # 4 * 20 = 80 subqueries, so tags are split.
+        results = self.admin_api.get('Practice', n=10, subjects=self.subjects,
+                                     tags=self.tags)
+        self.assertEqual(len(results), 10)
+
+        # Only half the practices have these tags, so they're post-filtered
+        # out of the first few query results.
+        tags = self.tags[:10] + ['y{}'.format(x) for x in range(150)]
+        results = self.admin_api.get('Practice', n=10, subjects=self.subjects,
+                                     tags=tags, order='name')
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(p.tags[0] in tags for p in results))
+
+    def test_split_results_ordered(self):
+        """Results of split queries are merged in the requested order."""
+        results = self.admin_api.get('Practice', n=30, subjects=self.subjects,
+                                     tags=self.tags, order='-name')
+        names = [p.name for p in results]
+        self.assertEqual(len(names), 30)
+        self.assertEqual(names, sorted(names, reverse=True))
+
+    def test_post_filter_continues_past_first_batch(self):
+        """Matches beyond the first batch read are found, once each."""
+        # Too many tags to split, so they're all post-filtered. Only 2 of the
+        # 30 practices match, and the last is past the first batch of 20.
+        tags = self.tags[:1] + ['y{}'.format(x) for x in range(200)]
+        plan = Api.plan_query({'subjects': self.subjects, 'tags': tags})
+        self.assertEqual(plan.post_filters, {'tags': tags})
+        results = self.admin_api.get('Practice', n=5, subjects=self.subjects,
+                                     tags=tags, order='-name')
+        self.assertEqual([p.name for p in results],
+                         [u'Planned 20', u'Planned 0'])
@@ -1,12 +1,16 @@
 """Unit tests related to indexed searching."""
 
 from google.appengine.api import search
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
 import unittest
 
 from cron import Cron
-from model import (Model, Indexer, User, Lesson, Practice, Assessment)
+from model import (Model, Indexer, User, Lesson, Practice, Assessment,
+                   ContentIndex, Vote)
 from unit_test_helper import PopulatedTestCase
 import config
+import content_cache
 import util
 
 
@@ -28,7 +32,9 @@ class ConsistentSearchTest(PopulatedTestCase):
         # index.
         self.cron = Cron(self.admin_api)
         indexer = Indexer.get_or_insert('the-indexer')
-        indexer.delete_all_content()  # fresh start, no pre-populated stuff
+        # Fresh start, no pre-populated stuff, queued or indexed.
+        self.cron.index_queued()
+        indexer.delete_all_content()
         self.search_index = indexer.get_index()
 
     def test_index_excludes_users(self):
@@ -58,6 +64,7 @@ class ConsistentSearchTest(PopulatedTestCase):
             json_properties={'a': u'\xeb', 'b': [1, 2, 3]},
             listed=False,
         )
+        self.cron.index_queued()
 
         result_dicts = [util.search_document_to_dict(doc)
                         for doc in self.search_index.get_range()]
@@ -78,6 +85,7 @@ class ConsistentSearchTest(PopulatedTestCase):
             json_properties={'a': u'\xeb', 'b': [1, 2, 3]},
             listed=True,
         )
+        self.cron.index_queued()
 
         result_dicts = [util.search_document_to_dict(doc)
                         for doc in self.search_index.get_range()]
@@ -101,6 +109,7 @@ class ConsistentSearchTest(PopulatedTestCase):
             pending=False,
             listed=True,
         )
+        self.cron.index_queued()
 
         result_dicts = [util.search_document_to_dict(doc)
                         for doc in self.search_index.get_range()]
@@ -117,12 +126,224 @@ class ConsistentSearchTest(PopulatedTestCase):
             num_phases=2,
             listed=True,
         )
+        self.cron.index_queued()
 
         result_dicts = [util.search_document_to_dict(doc)
                         for doc in self.search_index.get_range()]
         result_kinds = [Model.get_kind(d['uid']) for d in result_dicts]
         self.assertIn('Assessment', result_kinds)
 
+    def test_queued_indexing(self):
+        """Puts don't wait on search, and repeated puts are indexed once."""
+        lesson = self.admin_api.create(
+            'Lesson',
+            id='queued-lesson',
+            name=u'Queued Lesson',
+            listed=True,
+        )
+        lesson.put()
+        self.assertIsNone(self.search_index.get(lesson.uid))
+
+        self.assertEqual(self.cron.index_queued(), 1)
+        self.assertIsNotNone(self.search_index.get(lesson.uid))
+
+        # Unlisting removes it from search, once the queue is processed.
+        self.admin_api.update(lesson.uid, listed=False)
+        self.cron.index_queued()
+        self.assertIsNone(self.search_index.get(lesson.uid))
+
+    def test_index_changed_content(self):
+        """Content saved without the put hook is indexed incrementally."""
+        self.cron.index()
+        lessons = [Lesson.create(name=u'Bulk Lesson {}'.format(x), listed=True)
+                   for x in range(3)]
+        for lesson in lessons:
+            lesson.forbid_post_put_hook = True
+        ndb.put_multi(lessons)
+
+        stats = self.cron.index()
+        self.assertEqual(stats['num_indexed'], 3)
+        self.assertTrue(stats['complete'])
+        for lesson in lessons:
+            self.assertIsNotNone(self.search_index.get(lesson.uid))
+
+        # The watermark means nothing is indexed twice.
+        self.assertEqual(self.cron.index()['num_indexed'], 0)
+
+    def test_queue_and_scan_index_once(self):
+        """Content indexed from the queue isn't indexed again by the scan for
+        changes, or the other way around."""
+        self.cron.index()
+
+        queued_first = self.admin_api.create(
+            'Lesson', id='queued-first', name=u'Queued First', listed=True)
+        self.assertEqual(self.cron.index_queued(), 1)
+        self.assertEqual(self.cron.index()['num_indexed'], 0)
+
+        scanned_first = self.admin_api.create(
+            'Lesson', id='scanned-first', name=u'Scanned First', listed=True)
+        self.assertEqual(self.cron.index()['num_indexed'], 1)
+        self.assertEqual(self.cron.index_queued(), 0)
+
+        for lesson in (queued_first, scanned_first):
+            self.assertIsNotNone(self.search_index.get(lesson.uid))
+
+    def get_rebuild_tasks(self, url):
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return taskqueue_stub.get_filtered_tasks(url=url,
+                                                 queue_names='index-all')
+
+    def test_rebuild_switches_index(self):
+        """Rebuilding indexes all listed content into a new index, then
+        searches use it."""
+        self.cron.index_queued()
+        old_name = self.search_index.name
+
+        result = self.cron.index_all()
+        self.assertNotEqual(result['index_name'], old_name)
+        self.assertEqual(ContentIndex.get().active_name, old_name)
+
+        # Content changed during the rebuild goes into both indexes.
+        lesson = self.admin_api.create(
+            'Lesson', id='rebuild-lesson', name=u'Rebuild Lesson',
+            listed=True)
+        self.cron.index_queued()
+
+        tasks = self.get_rebuild_tasks('/cron/index_all/shard')
+        self.assertEqual(len(tasks), result['num_shards'])
+        for task in tasks:
+            self.cron.index_all_shard(**task.extract_params())
+        # A retried shard task changes nothing.
+        self.cron.index_all_shard(**tasks[-1].extract_params())
+
+        new_index = Indexer.get_or_insert('the-indexer').get_index()
+        self.assertEqual(new_index.name, result['index_name'])
+        self.assertIsNotNone(new_index.get(lesson.uid))
+        listed_uids = [e.uid for e in self.populated_entities
+                       if Model.get_kind(e) in config.indexed_models and
+                       e.listed]
+        for uid in listed_uids:
+            self.assertIsNotNone(new_index.get(uid))
+        # The old index is emptied, by a task that can be retried.
+        tasks = self.get_rebuild_tasks('/cron/index_all/cleanup')
+        self.assertEqual([t.extract_params() for t in tasks],
+                         [{'index_name': old_name}])
+        self.assertGreater(self.cron.index_all_cleanup(old_name), 0)
+        self.assertEqual(self.cron.index_all_cleanup(old_name), 0)
+        old_documents = self.search_index.get_range(ids_only=True)
+        self.assertEqual(len(old_documents.results), 0)
+
+    def test_abandoned_rebuild_cleaned_up(self):
+        """Starting a rebuild queues deletion of an abandoned one's index,
+        and indexes in use are never deleted."""
+        abandoned_name = self.cron.index_all()['index_name']
+        task = self.get_rebuild_tasks('/cron/index_all/shard')[0]
+        self.cron.index_all_shard(**task.extract_params())
+        abandoned_index = search.Index(name=abandoned_name)
+
+        result = self.cron.index_all()
+        self.assertNotEqual(result['index_name'], abandoned_name)
+        tasks = self.get_rebuild_tasks('/cron/index_all/cleanup')
+        self.assertEqual([t.extract_params() for t in tasks],
+                         [{'index_name': abandoned_name}])
+        self.cron.index_all_cleanup(abandoned_name)
+        self.assertEqual(
+            len(abandoned_index.get_range(ids_only=True).results), 0)
+
+        # The active index and the new rebuild are left alone.
+        self.assertEqual(
+            self.cron.index_all_cleanup(self.search_index.name), 0)
+        self.assertEqual(
+            self.cron.index_all_cleanup(result['index_name']), 0)
+        self.assertEqual(ContentIndex.get().rebuild_name,
+                         result['index_name'])
+
+    def test_search_results_cached(self):
+        """Repeated searches skip the search service until the index
+        changes."""
+        self.cron.index()
+        hits = content_cache.stats['search_hits']
+
+        first = self.public_api.search_content({'tags': ['tagone', 'super']})
+        # Same search, different order of tags.
+        second = self.public_api.search_content({'tags': ['super', 'tagone']})
+        self.assertEqual(content_cache.stats['search_hits'], hits + 1)
+        self.assertEqual(first, second)
+
+        self.normal_api.create('Practice', name=u'New Practice',
+                               tags=['tagone'], pending=False, listed=True)
+        self.cron.index_queued()
+        third = self.public_api.search_content({'tags': ['tagone', 'super']})
+        self.assertEqual(content_cache.stats['search_hits'], hits + 1)
+        self.assertEqual(len(third), len(first) + 1)
+
+    def test_cursor_pagination(self):
+        """Following cursors visits every result once, for both queries and
+        searches."""
+        for x in range(21):
+            self.normal_api.create('Practice', name=u'Paged {}'.format(x),
+                                   tags=['paged'], pending=False, listed=True)
+        self.cron.index_queued()
+
+        first = self.public_api.search_content({'tags': ['paged']})
+        self.assertEqual(len(first), 20)
+        self.assertIsNotNone(first.cursor)
+        second = self.public_api.search_content(
+            {'tags': ['paged'], 'cursor': first.cursor})
+        self.assertEqual(len(second), 1)
+        self.assertIsNone(second.cursor)
+        uids = set([d['uid'] for d in first + second])
+        self.assertEqual(len(uids), 21)
+
+        uids = set()
+        cursor = None
+        while True:
+            page = self.admin_api.get('Practice', n=5, cursor=cursor)
+            uids.update([p.uid for p in page])
+            cursor = page.cursor
+            if cursor is None:
+                break
+        self.assertEqual(
+            len(uids), Practice.query(Practice.deleted == False).count())
+
+    def test_annotate_user_interactions(self):
+        """Search results show the author and whether the current user voted
+        for or commented on each, as votes come and go."""
+        self.cron.index()
+
+        def search_practice():
+            results = self.normal_api.search_content({'tags': ['tagone']})
+            return [d for d in results
+                    if Model.get_kind(d['uid']) == 'Practice'][0]
+
+        practice_dict = search_practice()
+        self.assertEqual(practice_dict['user']['uid'], self.normal_user.uid)
+        self.assertTrue(practice_dict.get('user_commented_on'))
+        self.assertNotIn('user_voted_for', practice_dict)
+
+        vote = self.normal_api.create('Vote', practice_id=practice_dict['uid'])
+        self.assertTrue(search_practice().get('user_voted_for'))
+
+        self.normal_api.delete(vote.uid)
+        self.assertNotIn('user_voted_for', search_practice())
+
+    def test_rolled_back_vote_not_an_interaction(self):
+        """Votes saved in a transaction that rolls back aren't cached as the
+        user's interactions."""
+        practice = self.normal_api.get('Practice')[0]
+        self.assertNotIn(practice.uid,
+                         self.normal_user.get_content_interactions()['Vote'])
+        vote = Vote.create(parent=self.normal_user, practice_id=practice.uid)
+
+        @ndb.transactional
+        def vote_then_roll_back():
+            vote.put()
+            raise ndb.Rollback()
+
+        vote_then_roll_back()
+        self.assertNotIn(practice.uid,
+                         self.normal_user.get_content_interactions()['Vote'])
+
     def test_assessment_url_name_validation(self):
         """Assessment url names must adhere to a regex, else Exception."""
         def invalid_assessment():
@@ -0,0 +1,57 @@
+"""Unit tests for the shared jinja environment."""
+
+from cron import Cron
+from model import Lesson
+from unit_test_helper import PertsTestCase, ConsistentPopulatedTestCase
+import templating
+
+
+class TemplatingTest(PertsTestCase):
+    """Test that pages share one environment, with all our filters."""
+
+    def test_environment_shared(self):
+        """Templates compiled for one request are reused by the next."""
+        environment = templating.get_environment()
+        self.assertIs(templating.get_environment(),
+                      environment)
+        template = environment.get_template('404.html')
+        self.assertIs(environment.get_template('404.html'), template)
+
+    def test_filters(self):
+        """Filters are registered once, with the environment."""
+        environment = templating.get_environment()
+        template = environment.from_string(
+            u'{{ value|to_json }} {{ type|filetype }}')
+        self.assertEqual(
+            template.render(value={'a': 1}, type='application/pdf'),
+            u'{"a": 1} pdf file')
+
+
+class LessonTemplateTest(ConsistentPopulatedTestCase):
+    """Test the registry of lesson templates."""
+
+    def set_up(self):
+        super(LessonTemplateTest, self).set_up()
+        self.lesson = [e for e in self.populated_entities
+                       if isinstance(e, Lesson)][0]
+
+    def tearDown(self):
+        # The registry is normally read from disk once per instance.
+        templating._lesson_templates = None
+        super(LessonTemplateTest, self).tearDown()
+
+    def test_check_lesson_templates(self):
+        """Mismatched lessons and templates are reported."""
+        templating._lesson_templates = {
+            'orphaned-template': 'lessons/orphaned-template.html'}
+        report = Cron(self.admin_api).check_lesson_templates()
+        self.assertIn(self.lesson.short_uid,
+                      report['lessons_without_templates'])
+        self.assertEqual(report['templates_without_lessons'],
+                         ['orphaned-template'])
+
+        templating._lesson_templates[self.lesson.short_uid] = (
+            'lessons/{}.html'.format(self.lesson.short_uid))
+        report = Cron(self.admin_api).check_lesson_templates()
+        self.assertNotIn(self.lesson.short_uid,
+                         report['lessons_without_templates'])
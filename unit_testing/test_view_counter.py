@@ -0,0 +1,155 @@
+"""Unit tests for the sharded view counter."""
+
+from google.appengine.api import memcache
+
+import view_counter
+from unit_test_helper import PertsTestCase
+
+
+class ViewCounterTest(PertsTestCase):
+    """Test buffered and direct counting of views."""
+
+    def set_up(self):
+        self.testbed.init_datastore_v3_stub()
+        # Instance memory outlives the testbed, so start fresh.
+        view_counter._shard_configs.clear()
+        self.buffer_view_counts = view_counter.config.buffer_view_counts
+        view_counter.config.buffer_view_counts = True
+
+    def tearDown(self):
+        view_counter.config.buffer_view_counts = self.buffer_view_counts
+        super(ViewCounterTest, self).tearDown()
+
+    def shard_total(self, name):
+        keys = view_counter.ViewCounterShardConfig.all_keys(name)
+        return sum(s.count for s in view_counter.ndb.get_multi(keys) if s)
+
+    def test_buffered_views_are_flushed(self):
+        """Buffered views count immediately and reach shards on flush."""
+        for x in range(3):
+            view_counter.increment('Topic_one')
+        view_counter.increment('Topic_two')
+
+        self.assertEqual(view_counter.get_count('Topic_one'), 3)
+        self.assertEqual(self.shard_total('Topic_one'), 0)
+
+        deltas = view_counter.flush()
+
+        self.assertEqual(deltas, {'Topic_one': 3, 'Topic_two': 1})
+        self.assertEqual(self.shard_total('Topic_one'), 3)
+        self.assertEqual(self.shard_total('Topic_two'), 1)
+        self.assertEqual(view_counter.get_count('Topic_one'), 3)
+
+    def test_views_after_flush_are_registered_again(self):
+        """A counter flushed once is flushed again when it gets more views."""
+        view_counter.increment('Topic_one')
+        view_counter.flush()
+        view_counter.increment('Topic_one')
+
+        self.assertEqual(view_counter.flush(), {'Topic_one': 1})
+        self.assertEqual(self.shard_total('Topic_one'), 2)
+        self.assertEqual(view_counter.flush(), {})
+
+    def test_direct_views_skip_buffer(self):
+        """With buffering off, views go straight to the shards."""
+        view_counter.config.buffer_view_counts = False
+        view_counter.increment('Topic_one')
+        self.assertEqual(self.shard_total('Topic_one'), 1)
+        self.assertEqual(view_counter.flush(), {})
+
+    def test_get_counts(self):
+        """Bulk reads include flushed and buffered views of each counter."""
+        view_counter.increment('Topic_one')
+        view_counter.flush()
+        view_counter.increment('Topic_one')
+        view_counter.increment('Topic_two')
+
+        self.assertEqual(
+            view_counter.get_counts(['Topic_one', 'Topic_two', 'Topic_none']),
+            {'Topic_one': 2, 'Topic_two': 1, 'Topic_none': 0})
+
+    def test_rank(self):
+        """Rankings only have counters with the prefix, most viewed first."""
+        for name, views in [('Lesson_a', 1), ('Lesson_b', 3),
+                            ('Topic_c', 5), ('Theme_d:Topic_c:Lesson_a', 2)]:
+            for x in range(views):
+                view_counter.increment(name)
+        view_counter.flush()
+
+        view_counter.rank('Lesson_')
+
+        self.assertEqual(view_counter.get_ranking('Lesson_'),
+                         [('Lesson_b', 3), ('Lesson_a', 1)])
+        self.assertEqual(view_counter.get_ranking('Lesson_', limit=1),
+                         [('Lesson_b', 3)])
+        self.assertEqual(view_counter.get_ranking('Topic_'), [])
+
+    def test_rank_skips_composite_counters(self):
+        """Lessons viewed within a topic don't rank as topics."""
+        for name, views in [('Topic_c', 1), ('Topic_c:Lesson_a', 4),
+                            ('Topic_c:Lesson_b', 2)]:
+            for x in range(views):
+                view_counter.increment(name)
+        view_counter.flush()
+
+        view_counter.rank('Topic_')
+
+        self.assertEqual(view_counter.get_ranking('Topic_'), [('Topic_c', 1)])
+
+    def test_contention_adds_shards(self):
+        """Enough retried increments double a counter's shards."""
+        view_counter.config.buffer_view_counts = False
+        view_counter.increment('Topic_one')
+        num_shards = view_counter.ViewCounterShardConfig.get_num_shards(
+            'Topic_one')
+
+        threshold = view_counter.config.view_shard_contention_threshold
+        for x in range(threshold):
+            view_counter._record_contention_async(
+                'Topic_one', num_shards, 1).get_result()
+
+        self.assertEqual(
+            view_counter.ViewCounterShardConfig.get_num_shards('Topic_one'),
+            num_shards * 2)
+        self.assertEqual(view_counter.get_count('Topic_one'), 1)
+
+    def test_compact_cold_counter(self):
+        """Cold counters end up with one shard, without losing views."""
+        view_counter.config.buffer_view_counts = False
+        for x in range(30):
+            view_counter.increment('Topic_one')
+        shard_config = view_counter.ViewCounterShardConfig.get_by_id(
+            'Topic_one')
+
+        # The first run only notes the count; the counter might be hot.
+        self.assertEqual(view_counter.compact(), [])
+        # Then it stops writing to, and merges, the other shards.
+        self.assertEqual(view_counter.compact(), ['Topic_one'])
+        self.assertEqual(self.shard_total('Topic_one'), 30)
+        self.assertEqual(len([s for s in view_counter.ndb.get_multi(
+            view_counter.ViewCounterShardConfig.all_keys('Topic_one')) if s]),
+            1)
+        # Then it stops reading them.
+        self.assertEqual(view_counter.compact(), ['Topic_one'])
+        self.assertEqual(shard_config.key.get().read_shards, 1)
+        self.assertEqual(view_counter.compact(), [])
+
+        memcache.flush_all()
+        self.assertEqual(view_counter.get_count('Topic_one'), 30)
+
+    def test_compact_pages_through_configs(self):
+        """Counters on every page of configs are compacted."""
+        view_counter.config.buffer_view_counts = False
+        names = ['Topic_{}'.format(x) for x in range(5)]
+        for name in names:
+            view_counter.increment(name)
+
+        page_size = view_counter.COMPACT_PAGE_SIZE
+        view_counter.COMPACT_PAGE_SIZE = 2
+        try:
+            self.assertEqual(view_counter.compact(), [])
+            self.assertEqual(sorted(view_counter.compact()), names)
+        finally:
+            view_counter.COMPACT_PAGE_SIZE = page_size
+        for name in names:
+            self.assertEqual(self.shard_total(name), 1)
@@ -5,6 +5,7 @@ from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 import logging
+import os
 import unittest
 
 from api import Api
@@ -119,6 +120,10 @@ class PopulatedTestCase(PertsTestCase):
         # for simulating search
         self.testbed.init_search_stub()
 
+        # for simulating the search indexing queue, defined in queue.yaml
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))
+
         # Since we have to be able to run these tests from cron, where there's
         # no true sense of a current user making a request, invent an admin
         # to run the populate script.
@@ -147,3 +152,15 @@ class PopulatedTestCase(PertsTestCase):
         self.normal_api = Api(self.normal_user)
 
         self.public_api = Api(None)
+
+
+class ConsistentPopulatedTestCase(PopulatedTestCase):
+    """A PopulatedTestCase where eventually consistent queries always see
+    recent writes.
+
+    For tests about what results are, e.g. how they're cached, merged, or
+    serialized, rather than whether a query sees them yet. Any test of
+    consistency should use PopulatedTestCase.
+    """
+
+    consistency_probability = 1
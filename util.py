@@ -107,6 +107,22 @@ def hash_password(password):
     return passlib_hash.sha256_crypt.encrypt(password)  # 80,000 rounds
 
 
+def index_by(l, p):
+    """Turn a list of objects into a dictionary of objects, keyed by p.
+
+    Like list_by(), but for unique keys, e.g. uids, so that looking up many
+    objects takes one pass over the list rather than one per lookup. Later
+    objects replace earlier ones with the same key, and Nones are skipped.
+
+    Example: Given list of topic entities and 'uid', returns
+    {
+        'Topic_ABC': topic1,
+        'Topic_DEF': topic2,
+    }
+    """
+    return {getattr(x, p): x for x in l if x is not None}
+
+
 def is_development():
     """Localhost OR the mindsetkit-staging app are development.
 
@@ -1,31 +1,173 @@
-"""A module implementing a sharded counter for views."""
+"""A module implementing a sharded counter for views.
 
+Views can be counted in one of two modes (see config.buffer_view_counts):
 
+* Direct: each view transactionally increments a random shard.
+* Buffered: each view only increments a delta in memcache. The cron job
+  /cron/flush_view_counts periodically moves the accumulated deltas into the
+  shards with a single put_multi(), so page views cost no datastore writes.
+  The trade off is that views buffered in memcache may be lost if memcache is
+  flushed before they are.
+
+Shards are only added for contention in direct mode. In buffered mode, the
+one running flush is the only writer, so shards aren't contended and keep
+the number they have.
+
+To find buffered counters without being able to list memcache keys, the first
+view of each counter since the last flush registers the counter's name in a
+numbered slot; flushing reads every slot registered since the last flush.
+"""
+
+
+import collections
+import logging
 import random
+import time
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+import config
+
+
+SHARD_KEY_PREFIX = 'shard-view:'
+SHARD_KEY_TEMPLATE = SHARD_KEY_PREFIX + '{}-{:d}'
+
+# Memcache keys for buffered views.
+DELTA_KEY_TEMPLATE = 'view-delta:{}'
+PENDING_SLOT_KEY_TEMPLATE = 'view-pending:{:d}'
+PENDING_COUNT_KEY = 'view-pending-count'
+FLUSHED_COUNT_KEY = 'view-flushed-count'
+FLUSH_LOCK_KEY = 'view-flush-lock'
+
+CONTENTION_KEY_TEMPLATE = 'view-contention:{}'
+
+# Where compact() continues when it runs out of time. See CompactViewCounts.
+COMPACT_URL = '/cron/compact_view_counts'
+# How many shard configs compact() reads at a time.
+COMPACT_PAGE_SIZE = 100
 
-SHARD_KEY_TEMPLATE = 'shard-view:{}-{:d}'
+# Instance memory cache of shard configs, by counter name, as tuples of
+# (num_shards, read_shards, time cached). Other instances may change a config,
+# so entries expire after config.view_shard_config_cache_seconds.
+_shard_configs = {}
 
 
 class ViewCounterShardConfig(ndb.Model):
-    """Tracks the number of shards for each named counter."""
+    """Tracks the number of shards for each named counter.
+
+    Hot counters get more shards as they see contention, and cold counters
+    are compacted into one shard. See increment_async() and compact().
+    """
+    # Shards that views are written to.
     num_shards = ndb.IntegerProperty(default=20)
+    # Shards that may still hold views after a compaction lowered num_shards.
+    max_shards = ndb.IntegerProperty(default=0, indexed=False)
+    # The count when compact() last checked, to tell if a counter is cold.
+    last_total = ndb.IntegerProperty(indexed=False)
+
+    @property
+    def read_shards(self):
+        """Number of shards which must be read to get the count."""
+        return max(self.num_shards, self.max_shards)
+
+    @classmethod
+    def _cache(cls, name, shard_config):
+        """Cache a config, or the defaults if there is none, in memory."""
+        if shard_config is None:
+            shard_config = cls()
+        _shard_configs[name] = (shard_config.num_shards,
+                                shard_config.read_shards,
+                                time.time())
+        return _shard_configs[name]
+
+    @classmethod
+    def _get_cached(cls, name):
+        """The cached (num_shards, read_shards, time) of a config, or None."""
+        cached = _shard_configs.get(name)
+        if cached and (time.time() - cached[2] <
+                       config.view_shard_config_cache_seconds):
+            return cached
+        return None
+
+    @classmethod
+    def get_num_shards(cls, name):
+        """Number of shards to write to, cached in instance memory.
+        Args:
+            name: The name of the counter.
+        """
+        return cls.get_num_shards_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_num_shards_async(cls, name):
+        """Asynchronous version of get_num_shards(); returns a future."""
+        cached = cls._get_cached(name)
+        if cached is None:
+            shard_config = yield cls.get_or_insert_async(name)
+            cached = cls._cache(name, shard_config)
+        raise ndb.Return(cached[0])
+
+    @classmethod
+    def _get_cached_multi(cls, names):
+        """The (num_shards, read_shards, time) of many configs, reading any
+        not cached with one get_multi().
+
+        Doesn't create configs which don't exist yet; they have the defaults.
+        """
+        cached = {name: cls._get_cached(name) for name in set(names)}
+        missing = [name for name, c in cached.items() if c is None]
+        if missing:
+            configs = ndb.get_multi([ndb.Key(cls, name) for name in missing])
+            for name, shard_config in zip(missing, configs):
+                cached[name] = cls._cache(name, shard_config)
+        return cached
+
+    @classmethod
+    def get_num_shards_multi(cls, names):
+        """Number of shards to write to for many counters, with one datastore
+        read. Unlike get_num_shards(), doesn't create missing configs.
+
+        Args:
+            names: List of counter names.
+        Returns:
+            Dictionary of number of shards, by counter name.
+        """
+        cached = cls._get_cached_multi(names)
+        return {name: cached[name][0] for name in names}
 
     @classmethod
-    def all_keys(cls, name):
+    def get_read_shards_multi(cls, names):
+        """Number of shards to read for many counters, with one datastore read.
+
+        Unlike get_num_shards(), doesn't create configs which don't exist yet;
+        such counters have never been incremented, so have the default number.
+
+        Args:
+            names: List of counter names.
+        Returns:
+            Dictionary of number of shards, by counter name.
+        """
+        cached = cls._get_cached_multi(names)
+        return {name: cached[name][1] for name in names}
+
+    @classmethod
+    def all_keys(cls, name, num_shards=None):
         """Returns all possible keys for the counter name given the config.
         Args:
             name: The name of the counter.
+            num_shards: int, optional, how many shards to read, if already
+                known.
         Returns:
             The full list of ndb.Key values corresponding to all the possible
                 counter shards that could exist.
         """
-        config = cls.get_or_insert(name)
+        if num_shards is None:
+            num_shards = cls.get_read_shards_multi([name])[name]
         shard_key_strings = [SHARD_KEY_TEMPLATE.format(name, index)
-                             for index in range(config.num_shards)]
+                             for index in range(num_shards)]
         return [ndb.Key(ViewCounterShard, shard_key_string)
                 for shard_key_string in shard_key_strings]
 
@@ -35,23 +177,108 @@ class ViewCounterShard(ndb.Model):
     count = ndb.IntegerProperty(default=0)
 
 
+class ViewCounterRanking(ndb.Model):
+    """The most viewed counters with names beginning with a given prefix.
+
+    Materialized periodically by rank() so that popular content can be shown
+    without reading every counter. The id is the prefix, e.g. 'Lesson_'.
+    """
+    names = ndb.StringProperty(repeated=True, indexed=False)
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+
 def get_count(name):
     """Retrieve the value for a given sharded counter.
     Args:
         name: The name of the counter.
     Returns:
         Integer; the cumulative count of all sharded counters for the given
-            counter name.
+            counter name, including views not yet flushed from memcache.
+    """
+    return get_counts([name])[name]
+
+
+def get_counts(names):
+    """Retrieve the values of many sharded counters at once.
+
+    Counters not in memcache are summed from one get_multi() of all their
+    shards, rather than a read per counter.
+
+    Args:
+        names: List of counter names.
+    Returns:
+        Dictionary of counts, by counter name. See get_count().
+    """
+    totals = memcache.get_multi(names)
+    missing = [name for name in set(names) if name not in totals]
+    if missing:
+        num_shards = ViewCounterShardConfig.get_read_shards_multi(missing)
+        shard_keys = [key for name in missing for key in
+                      ViewCounterShardConfig.all_keys(name, num_shards[name])]
+        deltas = memcache.get_multi(missing,
+                                    key_prefix=DELTA_KEY_TEMPLATE.format(''))
+        new_totals = {name: deltas.get(name, 0) for name in missing}
+        for shard in ndb.get_multi(shard_keys):
+            if shard is not None:
+                new_totals[_shard_counter_name(shard.key)] += shard.count
+        memcache.add_multi(new_totals, 60)
+        totals.update(new_totals)
+    return {name: totals[name] for name in names}
+
+
+def _shard_counter_name(shard_key):
+    """The name of the counter a shard belongs to."""
+    return shard_key.id()[len(SHARD_KEY_PREFIX):].rsplit('-', 1)[0]
+
+
+def rank(prefix, limit=100):
+    """Materialize the most viewed counters beginning with a prefix.
+
+    Scans the shards in key order, so the cost is proportional to the number
+    of shards with that prefix. Meant to be called by a cron job.
+
+    Composite counters, e.g. 'Topic_x:Lesson_y' for a lesson viewed within a
+    topic, share the prefix of their first part but aren't ranked with it.
+
+    Args:
+        prefix: str, e.g. 'Lesson_' to rank lessons.
+        limit: int, how many counters to keep.
+    Returns:
+        The saved ViewCounterRanking.
     """
-    total = memcache.get(name)
-    if total is None:
-        total = 0
-        all_keys = ViewCounterShardConfig.all_keys(name)
-        for counter in ndb.get_multi(all_keys):
-            if counter is not None:
-                total += counter.count
-        memcache.add(name, total, 60)
-    return total
+    start = ndb.Key(ViewCounterShard, SHARD_KEY_PREFIX + prefix)
+    end = ndb.Key(ViewCounterShard, SHARD_KEY_PREFIX + prefix + u'\ufffd')
+    query = ViewCounterShard.query(ViewCounterShard.key >= start,
+                                   ViewCounterShard.key < end)
+    totals = collections.Counter()
+    for shard in query.iter(batch_size=1000):
+        name = _shard_counter_name(shard.key)
+        if ':' not in name:
+            totals[name] += shard.count
+
+    top = totals.most_common(limit)
+    ranking = ViewCounterRanking(
+        id=prefix,
+        names=[name for name, count in top],
+        counts=[count for name, count in top],
+    )
+    ranking.put()
+    return ranking
+
+
+def get_ranking(prefix, limit=None):
+    """The most viewed counters as of the last call to rank().
+    Args:
+        prefix: str, e.g. 'Lesson_'.
+        limit: int, optional, how many counters to return.
+    Returns:
+        List of (name, count) tuples, most viewed first.
+    """
+    ranking = ViewCounterRanking.get_by_id(prefix)
+    if ranking is None:
+        return []
+    return zip(ranking.names, ranking.counts)[:limit]
 
 
 def increment(name):
@@ -59,30 +286,192 @@ def increment(name):
     Args:
         name: The name of the counter.
     """
-    config = ViewCounterShardConfig.get_or_insert(name)
-    _increment(name, config.num_shards)
+    increment_async(name).get_result()
 
 
-@ndb.transactional
-def _increment(name, num_shards):
+@ndb.tasklet
+def increment_async(name):
+    """Asynchronous version of increment(); returns a future.
+    Args:
+        name: The name of the counter.
+    """
+    if config.buffer_view_counts:
+        yield _buffer_increment_async(name)
+    else:
+        num_shards = yield ViewCounterShardConfig.get_num_shards_async(name)
+        # Each attempt of the transaction adds to this list, so retries show
+        # that shards are contended.
+        attempts = []
+        try:
+            yield _increment_async(name, num_shards, attempts)
+        except datastore_errors.TransactionFailedError as e:
+            yield _record_contention_async(name, num_shards, len(attempts))
+            raise e
+        # Memcache increment does nothing if the name is not a key in memcache
+        memcache.incr(name)
+        if len(attempts) > 1:
+            yield _record_contention_async(name, num_shards, len(attempts) - 1)
+
+
+@ndb.tasklet
+def _buffer_increment_async(name):
+    """Count a view in memcache, to be flushed to the shards later.
+    Args:
+        name: The name of the counter.
+    """
+    context = ndb.get_context()
+    delta, _ = yield (
+        context.memcache_incr(DELTA_KEY_TEMPLATE.format(name),
+                              initial_value=0),
+        # Memcache increment does nothing if the name is not a key in memcache
+        context.memcache_incr(name),
+    )
+    # Only the first view since the counter was last flushed sees a delta of
+    # one, so each counter is registered once per flush.
+    if delta == 1:
+        yield _register_pending_async(name)
+
+
+@ndb.tasklet
+def _register_pending_async(name):
+    """Record that a counter has views waiting to be flushed."""
+    context = ndb.get_context()
+    slot = yield context.memcache_incr(PENDING_COUNT_KEY, initial_value=0)
+    if slot is None:
+        logging.error("Could not register view counter {} for flushing."
+                      .format(name))
+    else:
+        yield context.memcache_set(PENDING_SLOT_KEY_TEMPLATE.format(slot),
+                                   name)
+
+
+@ndb.transactional_tasklet
+def _increment_async(name, num_shards, attempts):
     """Transactional helper to increment the value for a given sharded counter.
     Also takes a number of shards to determine which shard will be used.
     Args:
         name: The name of the counter.
         num_shards: How many shards to use.
+        attempts: List, appended to on each attempt of the transaction.
     """
+    attempts.append(True)
     index = random.randint(0, num_shards - 1)
     shard_key_string = SHARD_KEY_TEMPLATE.format(name, index)
-    counter = ViewCounterShard.get_by_id(shard_key_string)
+    counter = yield ViewCounterShard.get_by_id_async(shard_key_string)
     if counter is None:
         counter = ViewCounterShard(id=shard_key_string)
     counter.count += 1
-    counter.put()
-    # Memcache increment does nothing if the name is not a key in memcache
-    memcache.incr(name)
+    yield counter.put_async()
+
+
+@ndb.tasklet
+def _record_contention_async(name, num_shards, retries):
+    """Count retried increments, and add shards if there are too many.
+
+    Only direct increments retry, so only they add shards. See the module
+    docstring.
+
+    Retries are counted in memcache over a window of
+    config.view_shard_contention_seconds. Reaching
+    config.view_shard_contention_threshold within a window doubles the
+    counter's shards, up to config.max_view_shards.
+
+    Args:
+        name: The name of the counter.
+        num_shards: How many shards the counter was using.
+        retries: int, how many times the increment was retried.
+    """
+    context = ndb.get_context()
+    key = CONTENTION_KEY_TEMPLATE.format(name)
+    yield context.memcache_add(key, 0,
+                               time=config.view_shard_contention_seconds)
+    contention = yield context.memcache_incr(key, delta=retries)
+    if (contention >= config.view_shard_contention_threshold and
+            num_shards < config.max_view_shards):
+        yield context.memcache_delete(key)
+        new_num_shards = min(num_shards * 2, config.max_view_shards)
+        logging.info("View counter {} is contended; increasing shards to {}."
+                     .format(name, new_num_shards))
+        yield increase_shards_async(name, new_num_shards)
+
+
+def _get_pending_slots():
+    """Get the slots registered since the last flush.
+
+    Returns:
+        Tuple of (the highest slot number, dictionary of slot keys to names).
+    """
+    flushed = memcache.get(FLUSHED_COUNT_KEY) or 0
+    pending = memcache.get(PENDING_COUNT_KEY) or 0
+    if pending < flushed:
+        # Memcache lost the pending count and started over.
+        flushed = 0
+    slot_keys = [PENDING_SLOT_KEY_TEMPLATE.format(slot)
+                 for slot in range(flushed + 1, pending + 1)]
+    return (pending, memcache.get_multi(slot_keys))
+
+
+def flush():
+    """Move views buffered in memcache into the datastore shards.
+
+    Meant to be called by a cron job. Only one flush runs at a time, so shards
+    can be written in a batch without transactions. Deltas are only cleared
+    after the shards are saved, so a failed flush is retried by the next one.
+
+    Returns:
+        Dictionary of the number of views flushed, by counter name.
+    """
+    if not memcache.add(FLUSH_LOCK_KEY, True, 60):
+        logging.info("view_counter.flush() already running.")
+        return {}
+
+    try:
+        pending, slots = _get_pending_slots()
+        names = list(set(slots.values()))
+        delta_keys = {name: DELTA_KEY_TEMPLATE.format(name) for name in names}
+        cached_deltas = memcache.get_multi(delta_keys.values())
+        deltas = {name: cached_deltas[delta_keys[name]] for name in names
+                  if cached_deltas.get(delta_keys[name])}
+
+        # Add each delta to a random shard.
+        num_shards = ViewCounterShardConfig.get_num_shards_multi(
+            deltas.keys())
+        shard_keys = {}
+        for name in deltas:
+            index = random.randint(0, num_shards[name] - 1)
+            shard_keys[name] = ndb.Key(
+                ViewCounterShard, SHARD_KEY_TEMPLATE.format(name, index))
+        flushed_names = deltas.keys()
+        shards = ndb.get_multi([shard_keys[name] for name in flushed_names])
+        to_put = []
+        for name, shard in zip(flushed_names, shards):
+            if shard is None:
+                shard = ViewCounterShard(key=shard_keys[name])
+            shard.count += deltas[name]
+            to_put.append(shard)
+        ndb.put_multi(to_put)
+
+        # Until the deltas are decremented, get_counts() may count them in
+        # both the shards and memcache. That's bounded by the flushed views of
+        # counters whose totals weren't cached, read in this short window.
+        # Dropping the totals afterwards keeps such a count from lingering.
+        for name, delta in deltas.items():
+            remaining = memcache.decr(delta_keys[name], delta)
+            if remaining:
+                # Views arrived between reading and decrementing the delta.
+                # Those views didn't register the name, so do it for them.
+                _register_pending_async(name).get_result()
+        memcache.delete_multi(flushed_names)
+
+        memcache.delete_multi(slots.keys())
+        memcache.set(FLUSHED_COUNT_KEY, pending)
+    finally:
+        memcache.delete(FLUSH_LOCK_KEY)
+
+    logging.info("Flushed views for {} counters.".format(len(deltas)))
+    return deltas
 
 
-@ndb.transactional
 def increase_shards(name, num_shards):
     """Increase the number of shards for a given sharded counter.
     Will never decrease the number of shards.
@@ -90,7 +479,110 @@ def increase_shards(name, num_shards):
         name: The name of the counter.
         num_shards: How many shards to use.
     """
-    config = ViewCounterShardConfig.get_or_insert(name)
-    if config.num_shards < num_shards:
-        config.num_shards = num_shards
-        config.put()
\ No newline at end of file
+    increase_shards_async(name, num_shards).get_result()
+
+
+@ndb.transactional_tasklet
+def increase_shards_async(name, num_shards):
+    """Asynchronous version of increase_shards(); returns a future."""
+    shard_config = yield ViewCounterShardConfig.get_or_insert_async(name)
+    if shard_config.num_shards < num_shards:
+        shard_config.num_shards = num_shards
+        yield shard_config.put_async()
+    _shard_configs.pop(name, None)
+
+
+def compact(cursor=None, time_limit=300):
+    """Merge the shards of cold counters, to make them cheaper to read.
+
+    A counter is cold if its count hasn't changed since the last compaction,
+    which is meant to be run by a daily cron job. Compacting takes place over
+    successive runs, because other instances cache shard configs for
+    config.view_shard_config_cache_seconds:
+
+    1. Views stop being written to all but the first shard. Any others are
+       merged into it, but keep being read.
+    2. Once no other shards are found, they stop being read.
+
+    Configs are read a page at a time, with the shards of a whole page read
+    together. If the time limit passes, a task is queued to continue from the
+    cursor, so no request runs too long to finish.
+
+    Args:
+        cursor: str, optional, urlsafe cursor to resume from.
+        time_limit: int, seconds after which to continue in a new task.
+    Returns:
+        List of names of counters which were compacted.
+    """
+    compacted = []
+    query = ViewCounterShardConfig.query()
+    start_time = time.time()
+    cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    more = True
+    while more:
+        if time.time() - start_time > time_limit:
+            taskqueue.add(url=COMPACT_URL, params={'cursor': cursor.urlsafe()})
+            break
+        shard_configs, cursor, more = query.fetch_page(
+            COMPACT_PAGE_SIZE, start_cursor=cursor)
+        keys = [ViewCounterShardConfig.all_keys(c.key.id(), c.read_shards)
+                for c in shard_configs]
+        shards = ndb.get_multi([k for config_keys in keys
+                                for k in config_keys])
+        for shard_config, config_keys in zip(shard_configs, keys):
+            config_shards = shards[:len(config_keys)]
+            shards = shards[len(config_keys):]
+            if _compact_one(shard_config, config_keys, config_shards):
+                compacted.append(shard_config.key.id())
+
+    logging.info("Compacted {} view counters.".format(len(compacted)))
+    return compacted
+
+
+def _compact_one(shard_config, keys, shards):
+    """Take the next compaction step for one counter. See compact().
+
+    Args:
+        shard_config: ViewCounterShardConfig
+        keys: list of the keys of the shards the counter reads
+        shards: list of those shards, None where they don't exist
+    Returns:
+        True if the counter was compacted.
+    """
+    name = shard_config.key.id()
+    total = sum(shard.count for shard in shards if shard is not None)
+    extra_keys = [shard.key for shard in shards[1:] if shard is not None]
+
+    if total != shard_config.last_total:
+        _update_shard_config(name, last_total=total)
+    elif shard_config.num_shards > 1 or extra_keys:
+        _update_shard_config(name, num_shards=1,
+                             max_shards=shard_config.read_shards)
+        # Cross-group transactions can include up to 25 entity groups.
+        for i in range(0, len(extra_keys), 24):
+            _merge_shards(keys[0], extra_keys[i:i + 24])
+        return True
+    elif shard_config.max_shards > shard_config.num_shards:
+        _update_shard_config(name, max_shards=0)
+        return True
+    return False
+
+
+@ndb.transactional
+def _update_shard_config(name, **kwargs):
+    """Set properties of a counter's shard config."""
+    shard_config = ViewCounterShardConfig.get_by_id(name)
+    shard_config.populate(**kwargs)
+    shard_config.put()
+    _shard_configs.pop(name, None)
+
+
+@ndb.transactional(xg=True)
+def _merge_shards(first_key, other_keys):
+    """Add the counts of other shards to the first, deleting the others."""
+    first = first_key.get() or ViewCounterShard(key=first_key)
+    for shard in ndb.get_multi(other_keys):
+        if shard is not None:
+            first.count += shard.count
+    first.put()
+    ndb.delete_multi(other_keys)